@@ -1,32 +1,69 @@
+import base64
+import functools
+import hashlib
+import hmac
+import json
+import threading
+import time
+from calendar import timegm
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from typing import Optional
 
 import bcrypt
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from cachetools import TTLCache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError, jwt
-from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from sqlalchemy import select
+import jwt
+from sqlalchemy.orm import Session, joinedload
 
 from .config import settings
 from .db import get_db
-from .models import User, Role
+from .models import User, UserPlan, Role
 
 
 # ──────────────────────────────────────────────────────────────
-# Password hashing (usando bcrypt directamente)
+# Password hashing (argon2; hashes bcrypt legacy se verifican y se re-hashean al login)
 # ──────────────────────────────────────────────────────────────
+# Parámetros desde settings: al cambiarlos, los hashes existentes se re-hashean en el
+# siguiente login (password_needs_rehash)
+_password_hasher = PasswordHasher(
+    time_cost=settings.ARGON2_TIME_COST,
+    memory_cost=settings.ARGON2_MEMORY_KIB,
+    parallelism=settings.ARGON2_PARALLELISM,
+)
+
+
+def _is_bcrypt_hash(hashed_password: str) -> bool:
+    return hashed_password.startswith(("$2a$", "$2b$", "$2y$"))
+
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(
-        plain_password.encode("utf-8"),
-        hashed_password.encode("utf-8")
-    )
+    if _is_bcrypt_hash(hashed_password):
+        return bcrypt.checkpw(
+            plain_password.encode("utf-8"),
+            hashed_password.encode("utf-8")
+        )
+    try:
+        return _password_hasher.verify(hashed_password, plain_password)
+    except (VerificationError, InvalidHashError):
+        return False
 
 
 def get_password_hash(password: str) -> str:
-    salt = bcrypt.gensalt()
-    return bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
+    return _password_hasher.hash(password)
+
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    """True si el hash es bcrypt (legacy) o argon2 con parámetros distintos a los actuales."""
+    if _is_bcrypt_hash(hashed_password):
+        return True
+    try:
+        return _password_hasher.check_needs_rehash(hashed_password)
+    except InvalidHashError:
+        return True
 
 
 # ──────────────────────────────────────────────────────────────
@@ -34,40 +71,136 @@ def get_password_hash(password: str) -> str:
 # ──────────────────────────────────────────────────────────────
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
+# Clave preparada una sola vez (bytes para HS*, objeto de clave para RS*/ES* con PEM)
+_JWT_KEY = jwt.get_algorithm_by_name(settings.ALGORITHM).prepare_key(settings.SECRET_KEY)
+_JWT_VERIFY_KEY = _JWT_KEY.public_key() if hasattr(_JWT_KEY, "public_key") else _JWT_KEY
+_JWT_ALGORITHMS = [settings.ALGORITHM]
+
 
-class TokenData(BaseModel):
+@dataclass(slots=True, frozen=True)
+class TokenData:
     user_id: int
     email: str
     role: str
 
 
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+# Para HS*: segmento de header ya codificado y HMAC ya inicializado con la clave;
+# cada token solo copia ese estado y firma el payload (mismo resultado que jwt.encode).
+_HMAC_DIGESTS = {"HS256": hashlib.sha256, "HS384": hashlib.sha384, "HS512": hashlib.sha512}
+if settings.ALGORITHM in _HMAC_DIGESTS:
+    _JWT_HEADER_SEGMENT = _b64url(
+        json.dumps({"alg": settings.ALGORITHM, "typ": "JWT"}, separators=(",", ":")).encode()
+    )
+    _JWT_HMAC = hmac.new(_JWT_KEY, digestmod=_HMAC_DIGESTS[settings.ALGORITHM])
+else:
+    _JWT_HMAC = None
+
+
+# Claims de tiempo que jwt.encode acepta como datetime y convierte a epoch
+_JWT_TIME_CLAIMS = ("exp", "iat", "nbf")
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
+    """Firma un JWT con los claims de data más exp.
+
+    Mismo contrato que jwt.encode: exp/iat/nbf pueden venir como datetime (se pasan a epoch
+    en segundos); el resto de valores deben ser serializables a JSON.
+    """
     to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
+    for claim in _JWT_TIME_CLAIMS:
+        if isinstance(to_encode.get(claim), datetime):
+            to_encode[claim] = timegm(to_encode[claim].utctimetuple())
+    ttl_sec = int(expires_delta.total_seconds()) if expires_delta else settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    to_encode["exp"] = int(time.time()) + ttl_sec
+    if _JWT_HMAC is None:
+        return jwt.encode(to_encode, _JWT_KEY, algorithm=settings.ALGORITHM)
+
+    payload_segment = _b64url(json.dumps(to_encode, separators=(",", ":")).encode())
+    signing_input = _JWT_HEADER_SEGMENT + b"." + payload_segment
+    mac = _JWT_HMAC.copy()
+    mac.update(signing_input)
+    return (signing_input + b"." + _b64url(mac.digest())).decode()
+
+
+# Cache de tokens ya validados: evita re-verificar la firma en cada request.
+# Clave = hash del token (no se guarda el token en claro); valor = (TokenData, exp).
+JWT_CACHE_TTL_SEC = 30
+_jwt_cache: TTLCache = TTLCache(maxsize=10000, ttl=JWT_CACHE_TTL_SEC)
+_jwt_cache_lock = threading.Lock()
+
+
+def _token_cache_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode("utf-8"), digest_size=16, person=b"jwt-cache").digest()
 
 
 def decode_token(token: str) -> Optional[TokenData]:
+    key = _token_cache_key(token)
+    now = time.time()
+    with _jwt_cache_lock:
+        cached = _jwt_cache.get(key)
+    if cached is not None:
+        token_data, exp = cached
+        if exp is None or exp > now:
+            return token_data
+
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        user_id = payload.get("sub")
-        return TokenData(
-            user_id=int(user_id) if user_id else 0,
-            email=payload.get("email"),
-            role=payload.get("role"),
-        )
-    except JWTError:
+        payload = jwt.decode(token, _JWT_VERIFY_KEY, algorithms=_JWT_ALGORITHMS)
+        token_data = TokenData(int(payload["sub"]), payload["email"], payload["role"])
+    except (jwt.InvalidTokenError, KeyError, TypeError, ValueError):
         return None
 
+    # Nunca cachear más allá del propio exp del token
+    exp = payload.get("exp")
+    with _jwt_cache_lock:
+        _jwt_cache[key] = (token_data, exp)
+    return token_data
+
+
+# ──────────────────────────────────────────────────────────────
+# User cache
+# ──────────────────────────────────────────────────────────────
+# Copias desacopladas (detached) del User por id, para no ir a la BD en cada request.
+# Se cargan junto con user_plan → plan (un solo SELECT). Sirven para identidad, rol e
+# is_active; invalidate_user_cache() solo limpia la caché del proceso que lo llama, así que
+# con varios workers un cambio de rol o is_active tarda hasta USER_CACHE_TTL_SEC en verse.
+# Por eso el saldo (credits_balance) y el plan no se leen ni se escriben desde este User:
+# los endpoints los consultan en la BD y los créditos se descuentan con UPDATE en SQL.
+USER_CACHE_TTL_SEC = 60
+_user_cache: TTLCache = TTLCache(maxsize=5000, ttl=USER_CACHE_TTL_SEC)
+_user_cache_lock = threading.Lock()
+
+
+_USER_CACHE_LOAD = [joinedload(User.user_plan).joinedload(UserPlan.plan)]
+
+
+def invalidate_user_cache(user_id: int) -> None:
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+
+
+def clear_user_cache() -> None:
+    """Vacía la caché completa (p.ej. al editar un plan, que viaja con cada usuario cacheado)."""
+    with _user_cache_lock:
+        _user_cache.clear()
+
 
 # ──────────────────────────────────────────────────────────────
 # Dependencies
 # ──────────────────────────────────────────────────────────────
-async def get_current_user(
+def get_current_user(
     token: str = Depends(oauth2_scheme),
     db: Session = Depends(get_db),
 ) -> User:
+    """Usuario del token, desde la caché de usuarios (TTL USER_CACHE_TTL_SEC).
+
+    La caché es por proceso: cambios de rol o is_active hechos en otro worker tardan hasta
+    USER_CACHE_TTL_SEC en aplicarse aquí. credits_balance y user_plan del User devuelto
+    pueden estar desactualizados: no usarlos para decidir ni escribirlos de vuelta.
+    """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Credenciales inválidas",
@@ -78,18 +211,35 @@ async def get_current_user(
     if token_data is None:
         raise credentials_exception
 
-    user = db.execute(select(User).where(User.id == token_data.user_id)).scalar_one_or_none()
-    if user is None or not user.is_active:
+    with _user_cache_lock:
+        cached = _user_cache.get(token_data.user_id)
+
+    if cached is None:
+        user = db.get(User, token_data.user_id, options=_USER_CACHE_LOAD)
+        if user is None or not user.is_active:
+            raise credentials_exception
+        db.expunge(user)
+        with _user_cache_lock:
+            _user_cache[token_data.user_id] = user
+        cached = user
+
+    if not cached.is_active:
         raise credentials_exception
 
-    return user
+    # Re-adjuntar a la sesión del request sin SELECT (user_plan/plan se copian ya cargados)
+    return db.merge(cached, load=False)
+
 
+@functools.lru_cache(maxsize=32)
+def require_roles(allowed_roles: tuple[Role, ...]):
+    """Dependency factory para requerir roles específicos.
 
-def require_roles(allowed_roles: list[Role]):
-    """Dependency factory para requerir roles específicos."""
+    Cacheada: el mismo set de roles devuelve siempre el mismo callable.
+    """
+    allowed = frozenset(allowed_roles)
 
-    async def role_checker(current_user: User = Depends(get_current_user)) -> User:
-        if current_user.role not in allowed_roles:
+    def role_checker(current_user: User = Depends(get_current_user)) -> User:
+        if current_user.role not in allowed:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="No tienes permisos para esta acción",
@@ -101,5 +251,5 @@ def require_roles(allowed_roles: list[Role]):
 
 # Shortcuts
 require_auth = get_current_user  # Cualquier usuario autenticado
-require_admin = require_roles([Role.admin, Role.superadmin])
-require_superadmin = require_roles([Role.superadmin])
+require_admin = require_roles((Role.admin, Role.superadmin))
+require_superadmin = require_roles((Role.superadmin,))
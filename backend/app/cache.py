@@ -0,0 +1,51 @@
+"""
+Caché de respuestas en memoria del proceso (TTL) para endpoints de lectura costosos.
+
+Cada worker mantiene su propia caché: la invalidación explícita solo afecta al
+proceso que hizo la escritura y el TTL acota lo desactualizado en los demás.
+"""
+
+import functools
+import threading
+from collections import defaultdict
+
+from cachetools import TTLCache
+
+
+_lock = threading.Lock()
+_caches: dict[str, list[TTLCache]] = defaultdict(list)
+# Se incrementa en cada invalidación: un resultado calculado antes no se guarda después
+_generations: dict[str, int] = defaultdict(int)
+
+
+def cached_response(namespace: str, ttl: int, key_params: tuple[str, ...] = (), maxsize: int = 256):
+    """Cachea el resultado de un endpoint síncrono según los parámetros indicados en key_params."""
+    def decorator(func):
+        cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        with _lock:
+            _caches[namespace].append(cache)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = tuple(kwargs.get(p) for p in key_params)
+            with _lock:
+                hit = cache.get(key)
+                generation = _generations[namespace]
+            if hit is not None:
+                return hit
+            result = func(*args, **kwargs)
+            with _lock:
+                if _generations[namespace] == generation:
+                    cache[key] = result
+            return result
+
+        return wrapper
+    return decorator
+
+
+def invalidate(namespace: str) -> None:
+    """Descarta todas las respuestas cacheadas del namespace (llamar tras escribir)."""
+    with _lock:
+        _generations[namespace] += 1
+        for cache in _caches.get(namespace, ()):
+            cache.clear()
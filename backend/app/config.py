@@ -1,25 +1,70 @@
-from pydantic_settings import BaseSettings
+from typing import Annotated
+
+from pydantic import field_validator
+from pydantic_settings import BaseSettings, NoDecode
 
 
 class Settings(BaseSettings):
     # Base de datos
     DATABASE_URL: str = "mysql+pymysql://root:@127.0.0.1:3306/panel_kryon?charset=utf8mb4"
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 40
+    DB_POOL_RECYCLE_SEC: int = 1800
+    DB_POOL_TIMEOUT_SEC: int = 30
+    # Detrás de PgBouncer (transaction pooling) el pool lo lleva PgBouncer: True = NullPool
+    DB_EXTERNAL_POOL: bool = False
+    # Caché de SQL compilado de SQLAlchemy (entradas por engine)
+    DB_QUERY_CACHE_SIZE: int = 1200
 
     # Seguridad
     SECRET_KEY: str = "change-me-to-a-random-string"
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 1440  # 24 horas
+    # Hash de contraseñas (argon2id). Mínimo recomendado por OWASP: t=2, m=19456 KiB, p=1;
+    # más memoria = más resistente pero cada login/alta de usuario cuesta más CPU y RAM
+    ARGON2_TIME_COST: int = 2
+    ARGON2_MEMORY_KIB: int = 65536
+    ARGON2_PARALLELISM: int = 2
 
     # CORS
-    CORS_ORIGINS: str = "http://localhost:5173,http://127.0.0.1:5173,http://[::1]:5173,http://localhost:3000,http://127.0.0.1:3000,http://[::1]:3000"
+    # En .env se escribe separado por comas; se parsea una sola vez al cargar settings
+    CORS_ORIGINS: Annotated[list[str], NoDecode] = [
+        "http://localhost:5173",
+        "http://127.0.0.1:5173",
+        "http://[::1]:5173",
+        "http://localhost:3000",
+        "http://127.0.0.1:3000",
+        "http://[::1]:3000",
+    ]
 
     # Media
     MEDIA_DIR: str = "./media"
+    # Si se define (p.ej. "/_protected_media/"), /media/* responde con X-Accel-Redirect
+    # y nginx sirve el archivo; vacío = servir con StaticFiles (desarrollo)
+    MEDIA_ACCEL_REDIRECT_PREFIX: str = ""
+    # Tamaño máximo por archivo subido (audio/video), en MB; 0 = sin límite
+    MAX_UPLOAD_MB: int = 0
+
+    # Reportes Excel generados en segundo plano (vacío = carpeta temporal del sistema)
+    REPORTS_DIR: str = ""
+    REPORT_JOB_TTL_SEC: int = 3600
+
+    # Roll-ups de analytics (daily_stats / hourly_therapy_stats)
+    # Cada cuánto se recalculan (0 = desactivado) y cuántos días cerrados se refrescan
+    ROLLUP_INTERVAL_SEC: int = 3600
+    ROLLUP_REFRESH_DAYS: int = 2
 
     # Superadmin inicial
     SUPERADMIN_EMAIL: str = "admin@cabina.local"
     SUPERADMIN_PASSWORD: str = "admin123"
 
+    @field_validator("CORS_ORIGINS", mode="before")
+    @classmethod
+    def _split_cors_origins(cls, v):
+        if isinstance(v, str):
+            return [o.strip() for o in v.split(",") if o.strip()]
+        return v
+
     class Config:
         env_file = ".env"
         extra = "ignore"
@@ -1,5 +1,6 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
+from sqlalchemy.pool import NullPool, StaticPool
 
 from .config import settings
 
@@ -17,16 +18,45 @@ def get_engine():
     
     if db_url.startswith("sqlite"):
         # SQLite: requiere check_same_thread=False para FastAPI
+        if ":memory:" in db_url or db_url.rstrip("/") == "sqlite:":
+            # En memoria: una sola conexión compartida, si no cada conexión ve otra BD
+            return create_engine(
+                db_url,
+                echo=False,
+                query_cache_size=settings.DB_QUERY_CACHE_SIZE,
+                connect_args={"check_same_thread": False},
+                poolclass=StaticPool,
+            )
         return create_engine(
             db_url,
+            echo=False,
+            query_cache_size=settings.DB_QUERY_CACHE_SIZE,
             connect_args={"check_same_thread": False}
         )
-    elif db_url.startswith("postgresql"):
-        # PostgreSQL: pool_pre_ping para detectar conexiones caídas
-        return create_engine(db_url, pool_pre_ping=True)
-    else:
-        # MySQL y otros: pool_pre_ping por defecto
-        return create_engine(db_url, pool_pre_ping=True)
+
+    if settings.DB_EXTERNAL_POOL:
+        # PgBouncer ya reutiliza las conexiones al servidor: un pool local encima solo
+        # retendría conexiones del pooler sin necesidad
+        return create_engine(
+            db_url,
+            echo=False,
+            query_cache_size=settings.DB_QUERY_CACHE_SIZE,
+            poolclass=NullPool,
+        )
+
+    # MySQL / PostgreSQL: pool dimensionado para concurrencia, pool_pre_ping para
+    # detectar conexiones caídas y pool_recycle para no reutilizar conexiones que
+    # el servidor ya cerró por inactividad (wait_timeout en MySQL)
+    return create_engine(
+        db_url,
+        echo=False,
+        query_cache_size=settings.DB_QUERY_CACHE_SIZE,
+        pool_pre_ping=True,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_recycle=settings.DB_POOL_RECYCLE_SEC,
+        pool_timeout=settings.DB_POOL_TIMEOUT_SEC,
+    )
 
 
 engine = get_engine()
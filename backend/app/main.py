@@ -1,13 +1,17 @@
-from pathlib import Path
+import asyncio
+from pathlib import Path, PurePosixPath
 from contextlib import asynccontextmanager
+from urllib.parse import quote
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 
 from .config import settings
 from .db import SessionLocal
 from .migrations import run_migrations
+from .rollups import rollup_loop
 from .seed import run_seed
 
 from .routers import auth, users, plans, therapies, playlists, sessions, analytics, categories
@@ -44,9 +48,16 @@ async def lifespan(app: FastAPI):
     else:
         print("⚠️  Seed omitido (BD no disponible)")
 
+    # Roll-ups de analytics en segundo plano
+    rollup_task = None
+    if migrations_ok and settings.ROLLUP_INTERVAL_SEC > 0:
+        rollup_task = asyncio.create_task(rollup_loop())
+
     yield
 
     # Shutdown
+    if rollup_task:
+        rollup_task.cancel()
     print("👋 Cerrando Panel Kryon API...")
 
 
@@ -58,13 +69,13 @@ app = FastAPI(
     description="API para el sistema de terapias Cabina AQ",
     version="2.0.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # CORS
-origins = [o.strip() for o in settings.CORS_ORIGINS.split(",") if o.strip()]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=origins,
+    allow_origins=settings.CORS_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -73,7 +84,18 @@ app.add_middleware(
 # Static files (media)
 media_path = Path(settings.MEDIA_DIR).resolve()
 media_path.mkdir(parents=True, exist_ok=True)
-app.mount("/media", StaticFiles(directory=str(media_path)), name="media")
+if settings.MEDIA_ACCEL_REDIRECT_PREFIX:
+    # Producción: nginx entrega los bytes (sendfile); la app solo valida la ruta
+    accel_prefix = settings.MEDIA_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/"
+
+    @app.get("/media/{path:path}", include_in_schema=False)
+    def media_accel_redirect(path: str):
+        parts = PurePosixPath(path).parts
+        if len(parts) != 2 or parts[0] not in ("audio", "video") or parts[1] in ("..", "."):
+            raise HTTPException(status_code=404, detail="Not Found")
+        return Response(headers={"X-Accel-Redirect": f"{accel_prefix}{parts[0]}/{quote(parts[1])}"})
+else:
+    app.mount("/media", StaticFiles(directory=str(media_path), check_dir=False), name="media")
 
 # Routers
 app.include_router(auth.router)
@@ -1,17 +1,188 @@
-from sqlalchemy import inspect, text
+from sqlalchemy import CheckConstraint, Enum, inspect, text
+from sqlalchemy.schema import AddConstraint
 
 from .db import Base, engine
 
 
-def _add_column_if_missing(conn, table: str, column: str, ddl: str, backfill_sql: list[str] | None = None) -> None:
-    existing_cols = {c["name"] for c in inspect(conn).get_columns(table)}
-    if column in existing_cols:
+# (columna, DDL, backfill) para la tabla therapies.
+# Cada backfill es una única sentencia UPDATE por columna.
+THERAPY_COLUMN_MIGRATIONS: list[tuple[str, str, str | None]] = [
+    (
+        "default_intensity",
+        "ALTER TABLE therapies ADD COLUMN default_intensity INT DEFAULT 50",
+        "UPDATE therapies SET default_intensity = 50 WHERE default_intensity IS NULL",
+    ),
+    (
+        "audio_corto_path",
+        "ALTER TABLE therapies ADD COLUMN audio_corto_path VARCHAR(500) DEFAULT NULL",
+        None,
+    ),
+    (
+        "audio_mediano_path",
+        "ALTER TABLE therapies ADD COLUMN audio_mediano_path VARCHAR(500) DEFAULT NULL",
+        None,
+    ),
+    (
+        "audio_largo_path",
+        "ALTER TABLE therapies ADD COLUMN audio_largo_path VARCHAR(500) DEFAULT NULL",
+        None,
+    ),
+    (
+        "duration_corto_sec",
+        "ALTER TABLE therapies ADD COLUMN duration_corto_sec INT DEFAULT 300",
+        "UPDATE therapies SET duration_corto_sec = 300 WHERE duration_corto_sec IS NULL",
+    ),
+    (
+        "duration_mediano_sec",
+        "ALTER TABLE therapies ADD COLUMN duration_mediano_sec INT DEFAULT 1200",
+        "UPDATE therapies SET duration_mediano_sec = 1200 WHERE duration_mediano_sec IS NULL",
+    ),
+    (
+        "duration_largo_sec",
+        "ALTER TABLE therapies ADD COLUMN duration_largo_sec INT DEFAULT 10800",
+        "UPDATE therapies SET duration_largo_sec = 10800 WHERE duration_largo_sec IS NULL",
+    ),
+    (
+        "duration_labels",
+        "ALTER TABLE therapies ADD COLUMN duration_labels TEXT DEFAULT NULL",
+        None,
+    ),
+    (
+        "arduino_config",
+        "ALTER TABLE therapies ADD COLUMN arduino_config TEXT DEFAULT NULL",
+        None,
+    ),
+    (
+        "media_type",
+        "ALTER TABLE therapies ADD COLUMN media_type VARCHAR(10)",
+        """
+        UPDATE therapies
+        SET media_type = CASE
+            WHEN video_path IS NOT NULL AND (
+                audio_corto_path IS NOT NULL OR audio_mediano_path IS NOT NULL OR audio_largo_path IS NOT NULL OR audio_path IS NOT NULL
+            ) THEN 'both'
+            WHEN video_path IS NOT NULL THEN 'video'
+            WHEN (
+                audio_corto_path IS NOT NULL OR audio_mediano_path IS NOT NULL OR audio_largo_path IS NOT NULL OR audio_path IS NOT NULL
+            ) THEN 'audio'
+            ELSE 'audio'
+        END
+        WHERE media_type IS NULL
+        """,
+    ),
+    (
+        "access_level",
+        "ALTER TABLE therapies ADD COLUMN access_level VARCHAR(10)",
+        "UPDATE therapies SET access_level = 'basic' WHERE access_level IS NULL",
+    ),
+]
+
+
+def _existing_columns(conn, table: str) -> set[str]:
+    """Nombres de columnas de una tabla con una sola consulta liviana."""
+    dialect = conn.dialect.name
+    if dialect == "mysql":
+        rows = conn.execute(
+            text(
+                "SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table"
+            ),
+            {"table": table},
+        )
+        return set(rows.scalars())
+    if dialect == "postgresql":
+        rows = conn.execute(
+            text(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_schema = current_schema() AND table_name = :table"
+            ),
+            {"table": table},
+        )
+        return set(rows.scalars())
+    if dialect == "sqlite":
+        return {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+    return {c["name"] for c in inspect(conn).get_columns(table)}
+
+
+def _add_missing_columns(conn, table: str, migrations: list[tuple[str, str, str | None]]) -> None:
+    """Consulta las columnas de la tabla una sola vez y aplica solo los ALTER pendientes."""
+    existing_cols = _existing_columns(conn, table)
+
+    pending = [m for m in migrations if m[0] not in existing_cols]
+    for _, ddl, _ in pending:
+        conn.execute(text(ddl))
+    for _, _, backfill_sql in pending:
+        if backfill_sql:
+            conn.execute(text(backfill_sql))
+
+
+# Columnas que antes eran ENUM nativo y ahora son VARCHAR (ver models.EnumString)
+ENUM_TO_VARCHAR_COLUMNS: list[tuple[str, str]] = [
+    ("users", "role"),
+    ("therapy_sessions", "status"),
+]
+
+
+def _convert_enum_columns(conn) -> None:
+    """Convierte columnas ENUM nativas (MySQL/PostgreSQL) a VARCHAR(16)."""
+    dialect = conn.dialect.name
+    if dialect not in ("mysql", "postgresql"):
         return
 
-    conn.execute(text(ddl))
-    if backfill_sql:
-        for stmt in backfill_sql:
-            conn.execute(text(stmt))
+    inspector = inspect(conn)
+    existing_tables = set(inspector.get_table_names())
+    for table, column in ENUM_TO_VARCHAR_COLUMNS:
+        if table not in existing_tables:
+            continue
+        col = next((c for c in inspector.get_columns(table) if c["name"] == column), None)
+        if col is None or not isinstance(col["type"], Enum):
+            continue
+        if dialect == "mysql":
+            conn.execute(text(f"ALTER TABLE {table} MODIFY COLUMN {column} VARCHAR(16) NOT NULL"))
+        else:
+            conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE VARCHAR(16) USING {column}::text"))
+
+
+def _add_missing_check_constraints(conn) -> None:
+    """Agrega los CHECK de los modelos (p.ej. enum_check) que falten en tablas ya existentes.
+
+    create_all() solo los crea con tablas nuevas. SQLite no admite ADD CONSTRAINT: en
+    instalaciones SQLite actualizadas los CHECK quedan solo en tablas creadas desde cero.
+    """
+    if conn.dialect.name not in ("mysql", "postgresql"):
+        return
+
+    inspector = inspect(conn)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_checks = {ck["name"] for ck in inspector.get_check_constraints(table.name)}
+        for constraint in table.constraints:
+            if not isinstance(constraint, CheckConstraint) or constraint.name in existing_checks:
+                continue
+            # Savepoint: si hay filas que no cumplen el CHECK se omite sin abortar el resto
+            try:
+                with conn.begin_nested():
+                    conn.execute(AddConstraint(constraint))
+            except Exception as e:
+                print(f"⚠️  CHECK {constraint.name} no agregado: {e}")
+
+
+def _create_missing_indexes(conn) -> None:
+    """Crea los índices declarados en los modelos que falten en tablas ya existentes.
+
+    create_all() solo crea índices junto con tablas nuevas.
+    """
+    inspector = inspect(conn)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_indexes = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(conn)
 
 
 def run_migrations() -> bool:
@@ -20,111 +191,13 @@ def run_migrations() -> bool:
         # Crear tablas faltantes
         Base.metadata.create_all(bind=engine)
 
-        inspector = inspect(engine)
-        if not inspector.has_table("therapies"):
-            return True
-
         with engine.begin() as conn:
-            _add_column_if_missing(
-                conn,
-                "therapies",
-                "default_intensity",
-                "ALTER TABLE therapies ADD COLUMN default_intensity INT DEFAULT 50",
-                [
-                    "UPDATE therapies SET default_intensity = 50 WHERE default_intensity IS NULL",
-                ],
-            )
-
-            _add_column_if_missing(
-                conn,
-                "therapies",
-                "audio_corto_path",
-                "ALTER TABLE therapies ADD COLUMN audio_corto_path VARCHAR(500) DEFAULT NULL",
-            )
-            _add_column_if_missing(
-                conn,
-                "therapies",
-                "audio_mediano_path",
-                "ALTER TABLE therapies ADD COLUMN audio_mediano_path VARCHAR(500) DEFAULT NULL",
-            )
-            _add_column_if_missing(
-                conn,
-                "therapies",
-                "audio_largo_path",
-                "ALTER TABLE therapies ADD COLUMN audio_largo_path VARCHAR(500) DEFAULT NULL",
-            )
-
-            _add_column_if_missing(
-                conn,
-                "therapies",
-                "duration_corto_sec",
-                "ALTER TABLE therapies ADD COLUMN duration_corto_sec INT DEFAULT 300",
-                [
-                    "UPDATE therapies SET duration_corto_sec = 300 WHERE duration_corto_sec IS NULL",
-                ],
-            )
-            _add_column_if_missing(
-                conn,
-                "therapies",
-                "duration_mediano_sec",
-                "ALTER TABLE therapies ADD COLUMN duration_mediano_sec INT DEFAULT 1200",
-                [
-                    "UPDATE therapies SET duration_mediano_sec = 1200 WHERE duration_mediano_sec IS NULL",
-                ],
-            )
-            _add_column_if_missing(
-                conn,
-                "therapies",
-                "duration_largo_sec",
-                "ALTER TABLE therapies ADD COLUMN duration_largo_sec INT DEFAULT 10800",
-                [
-                    "UPDATE therapies SET duration_largo_sec = 10800 WHERE duration_largo_sec IS NULL",
-                ],
-            )
-            _add_column_if_missing(
-                conn,
-                "therapies",
-                "duration_labels",
-                "ALTER TABLE therapies ADD COLUMN duration_labels TEXT DEFAULT NULL",
-            )
-            _add_column_if_missing(
-                conn,
-                "therapies",
-                "arduino_config",
-                "ALTER TABLE therapies ADD COLUMN arduino_config TEXT DEFAULT NULL",
-            )
-
-            _add_column_if_missing(
-                conn,
-                "therapies",
-                "media_type",
-                "ALTER TABLE therapies ADD COLUMN media_type VARCHAR(10)",
-                [
-                    """
-                    UPDATE therapies
-                    SET media_type = CASE
-                        WHEN video_path IS NOT NULL AND (
-                            audio_corto_path IS NOT NULL OR audio_mediano_path IS NOT NULL OR audio_largo_path IS NOT NULL OR audio_path IS NOT NULL
-                        ) THEN 'both'
-                        WHEN video_path IS NOT NULL THEN 'video'
-                        WHEN (
-                            audio_corto_path IS NOT NULL OR audio_mediano_path IS NOT NULL OR audio_largo_path IS NOT NULL OR audio_path IS NOT NULL
-                        ) THEN 'audio'
-                        ELSE 'audio'
-                    END
-                    WHERE media_type IS NULL
-                    """,
-                ],
-            )
-            _add_column_if_missing(
-                conn,
-                "therapies",
-                "access_level",
-                "ALTER TABLE therapies ADD COLUMN access_level VARCHAR(10)",
-                [
-                    "UPDATE therapies SET access_level = 'basic' WHERE access_level IS NULL",
-                ],
-            )
+            if not inspect(conn).has_table("therapies"):
+                return True
+            _add_missing_columns(conn, "therapies", THERAPY_COLUMN_MIGRATIONS)
+            _convert_enum_columns(conn)
+            _add_missing_check_constraints(conn)
+            _create_missing_indexes(conn)
         return True
     except Exception as e:
         # No romper startup por un ALTER TABLE (por ejemplo, si la tabla aún no existe)
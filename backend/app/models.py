@@ -2,7 +2,8 @@ import enum
 from datetime import datetime
 from typing import Optional
 
-from sqlalchemy import String, Integer, DateTime, Enum, ForeignKey, Text, Boolean
+from sqlalchemy import String, Integer, DateTime, ForeignKey, Text, Boolean, Index, CheckConstraint, text
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from .db import Base
@@ -11,6 +12,37 @@ from .db import Base
 # ──────────────────────────────────────────────────────────────
 # Enums
 # ──────────────────────────────────────────────────────────────
+class EnumString(TypeDecorator):
+    """Guarda un enum.Enum como VARCHAR y lo devuelve como miembro del enum al cargar.
+
+    Evita el tipo ENUM nativo (ALTERs costosos en MySQL para agregar valores).
+    La integridad se valida con un CheckConstraint (ver enum_check()).
+    """
+
+    impl = String
+    cache_ok = True
+
+    def __init__(self, enum_cls: type[enum.Enum], length: int = 16):
+        super().__init__(length)
+        self.enum_cls = enum_cls
+        self._by_value = {m.value: m for m in enum_cls}
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, enum.Enum):
+            return value.value
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return self._by_value.get(value, value)
+
+
+def enum_check(column: str, enum_cls: type[enum.Enum], name: str) -> CheckConstraint:
+    values = ", ".join(f"'{m.value}'" for m in enum_cls)
+    return CheckConstraint(f"{column} IN ({values})", name=name)
+
+
 class Role(str, enum.Enum):
     superadmin = "superadmin"
     admin = "admin"
@@ -22,12 +54,15 @@ class Role(str, enum.Enum):
 # ──────────────────────────────────────────────────────────────
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        enum_check("role", Role, "ck_users_role"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     email: Mapped[str] = mapped_column(String(255), unique=True, index=True)
     password_hash: Mapped[str] = mapped_column(String(255))
     name: Mapped[Optional[str]] = mapped_column(String(200), nullable=True)
-    role: Mapped[Role] = mapped_column(Enum(Role), default=Role.user)
+    role: Mapped[Role] = mapped_column(EnumString(Role), default=Role.user)
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
     credits_balance: Mapped[int] = mapped_column(Integer, default=0)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
@@ -75,6 +110,11 @@ class UserPlan(Base):
 # ──────────────────────────────────────────────────────────────
 class CreditLedger(Base):
     __tablename__ = "credit_ledger"
+    __table_args__ = (
+        Index("ix_ledger_user_created", "user_id", "created_at"),
+        # Rangos de fecha en /credits/flow y el reporte (INCLUDE solo aplica en PostgreSQL)
+        Index("ix_ledger_created_delta", "created_at", "delta"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
@@ -126,6 +166,13 @@ class LightMode(Base):
 # ──────────────────────────────────────────────────────────────
 class Therapy(Base):
     __tablename__ = "therapies"
+    __table_args__ = (
+        # Listado de terapias activas: parcial en PostgreSQL/SQLite (solo filas activas);
+        # en MySQL queda como índice simple sobre is_active
+        Index("ix_therapies_active", "is_active",
+              postgresql_where=text("is_active"),
+              sqlite_where=text("is_active = 1")),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String(200), index=True)
@@ -213,6 +260,23 @@ class SessionStatus(str, enum.Enum):
 class TherapySession(Base):
     """Registro de cada sesión de terapia realizada."""
     __tablename__ = "therapy_sessions"
+    __table_args__ = (
+        Index("ix_sessions_user_started", "user_id", "started_at"),
+        Index("ix_sessions_therapy_status", "therapy_id", "status"),
+        # Sesión activa del usuario (/sessions/active): parcial en PostgreSQL/SQLite, donde
+        # solo indexa las filas 'started'; en MySQL queda como índice compuesto completo
+        Index("ix_sessions_user_active", "user_id", "status", "started_at",
+              postgresql_where=text("status = 'started'"),
+              sqlite_where=text("status = 'started'")),
+        # Agregados de analytics por rango de started_at (INCLUDE solo aplica en PostgreSQL)
+        Index("ix_sessions_started_status", "started_at", "status",
+              postgresql_include=["duration_actual_sec", "credits_consumed"]),
+        Index("ix_sessions_started_therapy", "started_at", "therapy_id",
+              postgresql_include=["credits_consumed", "duration_actual_sec"]),
+        Index("ix_sessions_started_user", "started_at", "user_id",
+              postgresql_include=["credits_consumed"]),
+        enum_check("status", SessionStatus, "ck_sessions_status"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
@@ -226,7 +290,7 @@ class TherapySession(Base):
     duration_actual_sec: Mapped[int] = mapped_column(Integer, default=0)
     
     # Status
-    status: Mapped[SessionStatus] = mapped_column(Enum(SessionStatus), default=SessionStatus.started)
+    status: Mapped[SessionStatus] = mapped_column(EnumString(SessionStatus), default=SessionStatus.started)
     
     # Créditos consumidos en esta sesión
     credits_consumed: Mapped[int] = mapped_column(Integer, default=0)
@@ -246,6 +310,9 @@ class TherapySession(Base):
 class ActivityLog(Base):
     """Log de actividades del sistema para auditoría."""
     __tablename__ = "activity_logs"
+    __table_args__ = (
+        Index("ix_activity_user_created", "user_id", "created_at"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[Optional[int]] = mapped_column(ForeignKey("users.id"), nullable=True, index=True)
@@ -288,3 +355,21 @@ class DailyStats(Base):
     # Top terapia del día
     top_therapy_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     top_therapy_count: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class HourlyTherapyStats(Base):
+    """Roll-up de sesiones por (día, hora, terapia). Lo llena app.rollups."""
+    __tablename__ = "hourly_therapy_stats"
+    __table_args__ = (
+        Index("ix_hourly_stats_date_therapy_hour", "date", "therapy_id", "hour", unique=True),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    date: Mapped[datetime] = mapped_column(DateTime)
+    hour: Mapped[int] = mapped_column(Integer)
+    therapy_id: Mapped[int] = mapped_column(ForeignKey("therapies.id"))
+
+    total_sessions: Mapped[int] = mapped_column(Integer, default=0)
+    completed_sessions: Mapped[int] = mapped_column(Integer, default=0)
+    total_duration_sec: Mapped[int] = mapped_column(Integer, default=0)
+    credits_consumed: Mapped[int] = mapped_column(Integer, default=0)
@@ -0,0 +1,197 @@
+"""
+Roll-ups de analytics: pre-agrega días cerrados en daily_stats (totales por día)
+y hourly_therapy_stats (sesiones por día/hora/terapia).
+
+Los endpoints leen los días ya consolidados de estas tablas y calculan en vivo
+solo el tramo pendiente (normalmente el día de hoy). Idempotente: cada corrida
+borra y re-inserta el rango que recalcula.
+"""
+
+import asyncio
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import Integer, select, delete, func, extract, case, cast
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .config import settings
+from .db import SessionLocal
+from .models import (
+    User, TherapySession, SessionStatus, CreditLedger, DailyStats, HourlyTherapyStats
+)
+
+
+def _as_day(value) -> datetime:
+    """Normaliza el resultado de func.date() (str en SQLite, date en MySQL/PostgreSQL)."""
+    if isinstance(value, str):
+        return datetime.strptime(value[:10], "%Y-%m-%d")
+    if isinstance(value, datetime):
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    raise TypeError(f"Fecha no soportada: {value!r}")
+
+
+def rolled_until(db: Session) -> datetime | None:
+    """Primer día NO consolidado (los anteriores están en daily_stats), o None si no hay roll-ups."""
+    last = db.scalar(select(func.max(DailyStats.date)))
+    return _as_day(last) + timedelta(days=1) if last is not None else None
+
+
+def rollup_range(db: Session, start: datetime, end: datetime) -> int:
+    """Recalcula los roll-ups de [start, end) (días completos). Devuelve los días escritos."""
+    db.execute(delete(HourlyTherapyStats).where(HourlyTherapyStats.date >= start, HourlyTherapyStats.date < end))
+    db.execute(delete(DailyStats).where(DailyStats.date >= start, DailyStats.date < end))
+
+    session_day = func.date(TherapySession.started_at)
+    session_hour = cast(extract("hour", TherapySession.started_at), Integer)
+    in_range = TherapySession.started_at >= start, TherapySession.started_at < end
+
+    hourly_rows = db.execute(
+        select(
+            session_day.label("day"),
+            session_hour.label("hour"),
+            TherapySession.therapy_id,
+            func.count(TherapySession.id).label("total"),
+            func.sum(case((TherapySession.status == SessionStatus.completed, 1), else_=0)).label("completed"),
+            func.sum(case((TherapySession.status == SessionStatus.cancelled, 1), else_=0)).label("cancelled"),
+            func.coalesce(func.sum(TherapySession.duration_actual_sec), 0).label("duration"),
+            func.coalesce(func.sum(TherapySession.credits_consumed), 0).label("credits"),
+        )
+        .where(*in_range)
+        .group_by(session_day, session_hour, TherapySession.therapy_id)
+    ).all()
+
+    unique_users = {
+        _as_day(row.day): row.count for row in db.execute(
+            select(session_day.label("day"), func.count(func.distinct(TherapySession.user_id)).label("count"))
+            .where(*in_range)
+            .group_by(session_day)
+        )
+    }
+
+    user_day = func.date(User.created_at)
+    new_users = {
+        _as_day(row.day): row.count for row in db.execute(
+            select(user_day.label("day"), func.count(User.id).label("count"))
+            .where(User.created_at >= start, User.created_at < end)
+            .group_by(user_day)
+        )
+    }
+
+    # Créditos: agregados y descontados según el ledger (mismo criterio que /credits/flow)
+    ledger_day = func.date(CreditLedger.created_at)
+    ledger = {
+        _as_day(row.day): (row.added, row.consumed) for row in db.execute(
+            select(
+                ledger_day.label("day"),
+                func.coalesce(func.sum(case((CreditLedger.delta > 0, CreditLedger.delta), else_=0)), 0).label("added"),
+                func.coalesce(func.sum(case((CreditLedger.delta < 0, -CreditLedger.delta), else_=0)), 0).label("consumed"),
+            )
+            .where(CreditLedger.created_at >= start, CreditLedger.created_at < end)
+            .group_by(ledger_day)
+        )
+    }
+
+    daily: dict[datetime, dict] = {}
+    per_therapy: dict[datetime, dict[int, int]] = {}
+    hourly_stats = []
+    for row in hourly_rows:
+        day = _as_day(row.day)
+        hourly_stats.append(HourlyTherapyStats(
+            date=day,
+            hour=row.hour,
+            therapy_id=row.therapy_id,
+            total_sessions=row.total,
+            completed_sessions=int(row.completed),
+            total_duration_sec=int(row.duration),
+            credits_consumed=int(row.credits),
+        ))
+        totals = daily.setdefault(day, {"total": 0, "completed": 0, "cancelled": 0, "duration": 0})
+        totals["total"] += row.total
+        totals["completed"] += int(row.completed)
+        totals["cancelled"] += int(row.cancelled)
+        totals["duration"] += int(row.duration)
+        therapy_counts = per_therapy.setdefault(day, {})
+        therapy_counts[row.therapy_id] = therapy_counts.get(row.therapy_id, 0) + row.total
+
+    # Una fila por día del rango, aunque no haya actividad: marca el día como consolidado
+    daily_stats = []
+    day = start
+    while day < end:
+        totals = daily.get(day, {})
+        added, consumed = ledger.get(day, (0, 0))
+        therapy_counts = per_therapy.get(day, {})
+        top_therapy_id = max(therapy_counts, key=therapy_counts.get) if therapy_counts else None
+        daily_stats.append(DailyStats(
+            date=day,
+            total_sessions=totals.get("total", 0),
+            completed_sessions=totals.get("completed", 0),
+            cancelled_sessions=totals.get("cancelled", 0),
+            total_duration_min=totals.get("duration", 0) // 60,
+            total_credits_consumed=int(consumed),
+            total_credits_added=int(added),
+            unique_users=unique_users.get(day, 0),
+            new_users=new_users.get(day, 0),
+            top_therapy_id=top_therapy_id,
+            top_therapy_count=therapy_counts.get(top_therapy_id, 0) if top_therapy_id else 0,
+        ))
+        day += timedelta(days=1)
+
+    db.add_all(hourly_stats)
+    db.add_all(daily_stats)
+    return len(daily_stats)
+
+
+def refresh_rollups(db: Session, now: datetime | None = None) -> int:
+    """Consolida los días cerrados pendientes y refresca los últimos ROLLUP_REFRESH_DAYS.
+
+    Se refrescan días ya consolidados porque una sesión iniciada antes de medianoche
+    puede completarse (y consumir créditos) después.
+    """
+    today_start = (now or datetime.utcnow()).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    start = rolled_until(db)
+    if start is None:
+        first_dates = [
+            db.scalar(select(func.min(TherapySession.started_at))),
+            db.scalar(select(func.min(CreditLedger.created_at))),
+        ]
+        first_dates = [d for d in first_dates if d is not None]
+        if not first_dates:
+            return 0
+        start = _as_day(min(first_dates))
+    else:
+        start = min(start, today_start - timedelta(days=settings.ROLLUP_REFRESH_DAYS))
+
+    if start >= today_start:
+        return 0
+
+    try:
+        days = rollup_range(db, start, today_start)
+        db.commit()
+    except IntegrityError:
+        # Otro worker consolidó el mismo rango en paralelo
+        db.rollback()
+        return 0
+    return days
+
+
+def _refresh_once() -> None:
+    db = SessionLocal()
+    try:
+        days = refresh_rollups(db)
+        if days:
+            print(f"✅ Roll-ups de analytics: {days} día(s) consolidados")
+    except Exception as e:
+        db.rollback()
+        print(f"⚠️  Roll-ups de analytics omitidos: {e}")
+    finally:
+        db.close()
+
+
+async def rollup_loop() -> None:
+    """Tarea de fondo: consolida al iniciar y luego cada ROLLUP_INTERVAL_SEC."""
+    while True:
+        await asyncio.to_thread(_refresh_once)
+        await asyncio.sleep(settings.ROLLUP_INTERVAL_SEC)
@@ -1,30 +1,91 @@
-from datetime import datetime, timedelta
-import io
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+import os
+from pathlib import Path
+import re
+import tempfile
+import time
+import uuid
 from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, Path as FastAPIPath
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from sqlalchemy import select, func, and_, or_, desc, extract, case
+from starlette.background import BackgroundTask
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import DateTime, Integer, String, bindparam, literal_column, select, func, and_, or_, desc, extract, case, cast, type_coerce
 
-from ..db import get_db
+from ..db import SessionLocal, engine, get_db
 from ..models import (
     User, Therapy, TherapySession, SessionStatus,
-    CreditLedger, ActivityLog, DailyStats, Plan, UserPlan
+    CreditLedger, ActivityLog, DailyStats, HourlyTherapyStats, Plan, UserPlan
 )
 from ..auth import require_superadmin
+from ..cache import cached_response
+from ..config import settings
+from ..rollups import rolled_until
+
+try:
+    import xlsxwriter
+except ImportError:  # solo lo necesita el reporte Excel
+    xlsxwriter = None
 
 router = APIRouter(prefix="/api/analytics", tags=["analytics"])
 
 
-def _iso(dt: datetime | None) -> str | None:
-    return dt.isoformat() if dt else None
+# TTL de la caché de respuestas (segundos); se invalida al registrar sesiones o movimientos de créditos
+DASHBOARD_CACHE_TTL = 60
+SERIES_CACHE_TTL = 300
 
 
 def _safe_div(n: float, d: float) -> float:
     return round(n / d, 2) if d else 0.0
 
 
+def _in_range(column, start: datetime, end: datetime):
+    """Rango semiabierto [start, end): acota el índice por ambos lados y no duplica bordes."""
+    return and_(column >= start, column < end)
+
+
+# Literales numéricos en línea (no parámetros float): en PostgreSQL ROUND(x, n) solo acepta numeric
+_SIXTY = literal_column("60.0")
+_HUNDRED = literal_column("100.0")
+
+
+def _round1(expr):
+    return func.round(expr, 1)
+
+
+def _count_if(condition):
+    """COUNT condicional portable (equivale a COUNT(*) FILTER (WHERE ...))."""
+    return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+
+
+def _sum_if(condition, column):
+    """SUM condicional portable (equivale a SUM(col) FILTER (WHERE ...))."""
+    return func.coalesce(func.sum(case((condition, column), else_=0)), 0)
+
+
+# Agregados independientes en paralelo, cada uno en su propia conexión del pool.
+# SQLite serializa las lecturas (y en memoria comparte una sola conexión): ahí se ejecutan en secuencia.
+_PARALLEL_QUERIES = engine.dialect.name != "sqlite"
+_query_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="analytics-query")
+
+
+def _fetch_all(stmt) -> list:
+    with SessionLocal() as session:
+        return session.execute(stmt).all()
+
+
+def _execute_concurrently(db: Session, *stmts) -> list[list]:
+    """Ejecuta consultas de solo lectura independientes; la latencia total ≈ la de la más lenta."""
+    if not _PARALLEL_QUERIES or len(stmts) < 2:
+        return [db.execute(stmt).all() for stmt in stmts]
+    return list(_query_executor.map(_fetch_all, stmts))
+
+
 # ──────────────────────────────────────────────────────────────
 # Schemas
 # ──────────────────────────────────────────────────────────────
@@ -104,35 +165,128 @@ class ActivityLogItem(BaseModel):
 # ──────────────────────────────────────────────────────────────
 # Helper Functions
 # ──────────────────────────────────────────────────────────────
-def get_date_range(period: str) -> tuple[datetime, datetime]:
-    """Obtener rango de fechas según periodo."""
-    now = datetime.utcnow()
-    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+@lru_cache(maxsize=64)
+def _date_range_for(period: str, today: date) -> tuple[datetime, datetime]:
+    """Rango [inicio, fin) del periodo para un día dado (solo cambia al cambiar de día)."""
+    today_start = datetime(today.year, today.month, today.day)
+    end = today_start + timedelta(days=1)
     
     if period == "today":
-        return today_start, now
+        return today_start, end
     elif period == "week":
         week_start = today_start - timedelta(days=today_start.weekday())
-        return week_start, now
+        return week_start, end
     elif period == "month":
         month_start = today_start.replace(day=1)
-        return month_start, now
+        return month_start, end
     elif period == "quarter":
         quarter_month = ((today_start.month - 1) // 3) * 3 + 1
         quarter_start = today_start.replace(month=quarter_month, day=1)
-        return quarter_start, now
+        return quarter_start, end
     elif period == "year":
         year_start = today_start.replace(month=1, day=1)
-        return year_start, now
+        return year_start, end
     else:  # all time
-        return datetime(2020, 1, 1), now
+        return datetime(2020, 1, 1), end
+
+
+def get_date_range(period: str) -> tuple[datetime, datetime]:
+    """Obtener rango de fechas según periodo: [inicio, fin) con fin = inicio de mañana."""
+    return _date_range_for(period, datetime.utcnow().date())
+
+
+def _live_from(db: Session, start_date: datetime) -> datetime:
+    """Inicio del tramo que se calcula en vivo; [start_date, live_from) sale de los roll-ups."""
+    until = rolled_until(db)
+    return max(start_date, until) if until else start_date
+
+
+# ──────────────────────────────────────────────────────────────
+# Consultas de series por periodo
+# Se construyen una sola vez con bindparam: cada request solo cambia los
+# parámetros y SQLAlchemy reutiliza el SQL compilado de su caché.
+# ──────────────────────────────────────────────────────────────
+_START = bindparam("start", type_=DateTime())
+_LIVE_FROM = bindparam("live_from", type_=DateTime())
+_END = bindparam("end", type_=DateTime())
+
+# Fechas como 'YYYY-MM-DD' y horas como entero desde SQL: las filas llegan listas para JSON
+# (EXTRACT devuelve double precision/numeric en PostgreSQL)
+_session_day = func.date(TherapySession.started_at)
+_session_date = cast(_session_day, String)
+_ledger_day = func.date(CreditLedger.created_at)
+_session_hour = cast(extract("hour", TherapySession.started_at), Integer).label("hour")
+
+TIMELINE_ROLLED_STMT = (
+    select(cast(func.date(DailyStats.date), String).label("date"), DailyStats.total_sessions)
+    .where(DailyStats.date >= _START, DailyStats.date < _LIVE_FROM, DailyStats.total_sessions > 0)
+    .order_by(DailyStats.date)
+)
+TIMELINE_LIVE_STMT = (
+    select(_session_date.label("date"), func.count(TherapySession.id).label("count"))
+    .where(_in_range(TherapySession.started_at, _LIVE_FROM, _END))
+    .group_by(_session_day)
+    .order_by(_session_day)
+)
+
+CREDITS_ROLLED_STMT = (
+    select(
+        cast(func.date(DailyStats.date), String).label("date"),
+        DailyStats.total_credits_added.label("credits_added"),
+        DailyStats.total_credits_consumed.label("credits_consumed"),
+        (DailyStats.total_credits_added - DailyStats.total_credits_consumed).label("net_change"),
+    )
+    .where(
+        DailyStats.date >= _START,
+        DailyStats.date < _LIVE_FROM,
+        or_(DailyStats.total_credits_added > 0, DailyStats.total_credits_consumed > 0),
+    )
+    .order_by(DailyStats.date)
+)
+CREDITS_LIVE_STMT = (
+    select(
+        cast(_ledger_day, String).label("date"),
+        _sum_if(CreditLedger.delta > 0, CreditLedger.delta).label("credits_added"),
+        _sum_if(CreditLedger.delta < 0, func.abs(CreditLedger.delta)).label("credits_consumed"),
+        # agregados - consumidos = suma de todos los movimientos
+        func.coalesce(func.sum(CreditLedger.delta), 0).label("net_change"),
+    )
+    .where(_in_range(CreditLedger.created_at, _LIVE_FROM, _END))
+    .group_by(_ledger_day)
+    .order_by(_ledger_day)
+)
+
+CATEGORIES_ROLLED_STMT = (
+    select(Therapy.category, func.sum(HourlyTherapyStats.total_sessions).label("count"))
+    .join(Therapy, HourlyTherapyStats.therapy_id == Therapy.id)
+    .where(HourlyTherapyStats.date >= _START, HourlyTherapyStats.date < _LIVE_FROM)
+    .group_by(Therapy.category)
+)
+CATEGORIES_LIVE_STMT = (
+    select(Therapy.category, func.count(TherapySession.id).label("count"))
+    .join(Therapy, TherapySession.therapy_id == Therapy.id)
+    .where(_in_range(TherapySession.started_at, _LIVE_FROM, _END))
+    .group_by(Therapy.category)
+)
+
+HOURS_ROLLED_STMT = (
+    select(HourlyTherapyStats.hour, func.sum(HourlyTherapyStats.total_sessions).label("count"))
+    .where(HourlyTherapyStats.date >= _START, HourlyTherapyStats.date < _LIVE_FROM)
+    .group_by(HourlyTherapyStats.hour)
+)
+HOURS_LIVE_STMT = (
+    select(_session_hour, func.count(TherapySession.id).label("count"))
+    .where(_in_range(TherapySession.started_at, _LIVE_FROM, _END))
+    .group_by(_session_hour)
+)
 
 
 # ──────────────────────────────────────────────────────────────
 # Endpoints
 # ──────────────────────────────────────────────────────────────
 @router.get("/dashboard", response_model=DashboardStats)
-async def get_dashboard_stats(
+@cached_response("analytics", ttl=DASHBOARD_CACHE_TTL)
+def get_dashboard_stats(
     db: Session = Depends(get_db),
     _: User = Depends(require_superadmin),
 ):
@@ -141,82 +295,60 @@ async def get_dashboard_stats(
     today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
     week_start = today_start - timedelta(days=7)
     month_start = today_start - timedelta(days=30)
-    
-    # Usuarios
-    total_users = db.execute(select(func.count(User.id))).scalar() or 0
-    
-    # Usuarios activos (con sesiones)
-    active_today = db.execute(
-        select(func.count(func.distinct(TherapySession.user_id)))
-        .where(TherapySession.started_at >= today_start)
-    ).scalar() or 0
-    
-    active_week = db.execute(
-        select(func.count(func.distinct(TherapySession.user_id)))
-        .where(TherapySession.started_at >= week_start)
-    ).scalar() or 0
-    
-    # Terapias
-    total_therapies = db.execute(
-        select(func.count(Therapy.id)).where(Therapy.is_active == True)
-    ).scalar() or 0
-    
-    # Sesiones
-    total_sessions = db.execute(select(func.count(TherapySession.id))).scalar() or 0
-    
-    sessions_today = db.execute(
-        select(func.count(TherapySession.id))
-        .where(TherapySession.started_at >= today_start)
-    ).scalar() or 0
-    
-    sessions_week = db.execute(
-        select(func.count(TherapySession.id))
-        .where(TherapySession.started_at >= week_start)
-    ).scalar() or 0
-    
-    sessions_month = db.execute(
-        select(func.count(TherapySession.id))
-        .where(TherapySession.started_at >= month_start)
-    ).scalar() or 0
-    
-    # Créditos consumidos
-    credits_today = db.execute(
-        select(func.coalesce(func.sum(TherapySession.credits_consumed), 0))
-        .where(TherapySession.started_at >= today_start)
-    ).scalar() or 0
-    
-    credits_week = db.execute(
-        select(func.coalesce(func.sum(TherapySession.credits_consumed), 0))
-        .where(TherapySession.started_at >= week_start)
-    ).scalar() or 0
-    
-    credits_month = db.execute(
-        select(func.coalesce(func.sum(TherapySession.credits_consumed), 0))
-        .where(TherapySession.started_at >= month_start)
-    ).scalar() or 0
-    
-    # Créditos agregados este mes
-    credits_added = db.execute(
-        select(func.coalesce(func.sum(CreditLedger.delta), 0))
-        .where(and_(
-            CreditLedger.created_at >= month_start,
-            CreditLedger.delta > 0
-        ))
-    ).scalar() or 0
-    
-    # Duración promedio
-    avg_duration = db.execute(
-        select(func.avg(TherapySession.duration_actual_sec))
-        .where(TherapySession.status == SessionStatus.completed)
-    ).scalar() or 0
-    avg_duration_min = round(avg_duration / 60, 1) if avg_duration else 0
-    
-    # Tasa de completado
-    completed = db.execute(
-        select(func.count(TherapySession.id))
-        .where(TherapySession.status == SessionStatus.completed)
-    ).scalar() or 0
-    completion_rate = round((completed / total_sessions * 100), 1) if total_sessions > 0 else 0
+
+    started_at = TherapySession.started_at
+    is_completed = TherapySession.status == SessionStatus.completed
+
+    # Sesiones: un solo recorrido de therapy_sessions con agregados condicionales
+    # (SUM(CASE ...) en vez de FILTER para que también funcione en MySQL)
+    sessions_stmt = (
+        select(
+            func.count(TherapySession.id).label("total_sessions"),
+            _count_if(started_at >= today_start).label("sessions_today"),
+            _count_if(started_at >= week_start).label("sessions_week"),
+            _count_if(started_at >= month_start).label("sessions_month"),
+            func.count(func.distinct(case((started_at >= today_start, TherapySession.user_id)))).label("active_today"),
+            func.count(func.distinct(case((started_at >= week_start, TherapySession.user_id)))).label("active_week"),
+            _sum_if(started_at >= today_start, TherapySession.credits_consumed).label("credits_today"),
+            _sum_if(started_at >= week_start, TherapySession.credits_consumed).label("credits_week"),
+            _sum_if(started_at >= month_start, TherapySession.credits_consumed).label("credits_month"),
+            _count_if(is_completed).label("completed"),
+            _round1(func.avg(case((is_completed, TherapySession.duration_actual_sec))) / _SIXTY).label("avg_duration_min"),
+            _round1(_HUNDRED * _count_if(is_completed) / func.nullif(func.count(TherapySession.id), 0)).label("completion_rate"),
+        )
+    )
+
+    # Totales de otras tablas en una sola consulta (subconsultas escalares)
+    totals_stmt = (
+        select(
+            select(func.count(User.id)).scalar_subquery().label("total_users"),
+            select(func.count(Therapy.id)).where(Therapy.is_active == True).scalar_subquery().label("total_therapies"),
+            select(func.coalesce(func.sum(CreditLedger.delta), 0))
+            .where(and_(CreditLedger.created_at >= month_start, CreditLedger.delta > 0))
+            .scalar_subquery()
+            .label("credits_added"),
+        )
+    )
+
+    (sessions_row,), (totals_row,) = _execute_concurrently(db, sessions_stmt, totals_stmt)
+
+    total_users = totals_row.total_users or 0
+    total_therapies = totals_row.total_therapies or 0
+    credits_added = int(totals_row.credits_added or 0)
+
+    total_sessions = sessions_row.total_sessions or 0
+    active_today = sessions_row.active_today or 0
+    active_week = sessions_row.active_week or 0
+    sessions_today = int(sessions_row.sessions_today or 0)
+    sessions_week = int(sessions_row.sessions_week or 0)
+    sessions_month = int(sessions_row.sessions_month or 0)
+    credits_today = int(sessions_row.credits_today or 0)
+    credits_week = int(sessions_row.credits_week or 0)
+    credits_month = int(sessions_row.credits_month or 0)
+
+    # Promedio y tasa ya vienen redondeados desde SQL (NULL si no hay sesiones)
+    avg_duration_min = float(sessions_row.avg_duration_min or 0)
+    completion_rate = float(sessions_row.completion_rate or 0)
     
     return DashboardStats(
         total_users=total_users,
@@ -237,7 +369,7 @@ async def get_dashboard_stats(
 
 
 @router.get("/therapies/usage", response_model=list[TherapyUsageItem])
-async def get_therapy_usage(
+def get_therapy_usage(
     period: str = Query("month", regex="^(today|week|month|quarter|year|all)$"),
     limit: int = Query(20, ge=1, le=100),
     db: Session = Depends(get_db),
@@ -249,49 +381,48 @@ async def get_therapy_usage(
     # Subquery para estadísticas de sesiones
     stmt = (
         select(
-            TherapySession.therapy_id,
+            Therapy.id.label("therapy_id"),
+            Therapy.name.label("therapy_name"),
+            Therapy.category,
             func.count(TherapySession.id).label("total_sessions"),
             func.sum(
                 case((TherapySession.status == SessionStatus.completed, 1), else_=0)
             ).label("completed_sessions"),
             func.coalesce(func.sum(TherapySession.duration_actual_sec), 0).label("total_duration"),
             func.coalesce(func.sum(TherapySession.credits_consumed), 0).label("credits_consumed"),
+            _round1(func.sum(TherapySession.duration_actual_sec) / _SIXTY / func.count(TherapySession.id)).label("avg_duration_min"),
+            _round1(_HUNDRED * _count_if(TherapySession.status == SessionStatus.completed) / func.count(TherapySession.id)).label("completion_rate"),
         )
-        .where(TherapySession.started_at.between(start_date, end_date))
-        .group_by(TherapySession.therapy_id)
+        .join(Therapy, Therapy.id == TherapySession.therapy_id)
+        .where(_in_range(TherapySession.started_at, start_date, end_date))
+        .group_by(Therapy.id, Therapy.name, Therapy.category)
         .order_by(desc("total_sessions"))
         .limit(limit)
     )
     
     results = db.execute(stmt).all()
     
+    # Tipos ya garantizados por SQL (SUM puede llegar como Decimal en MySQL, de ahí los int()):
+    # model_construct evita validar cada fila
     items = []
     for row in results:
-        therapy = db.get(Therapy, row.therapy_id)
-        if not therapy:
-            continue
-        
-        total = row.total_sessions or 0
-        completed = row.completed_sessions or 0
-        duration = row.total_duration or 0
-        
-        items.append(TherapyUsageItem(
-            therapy_id=therapy.id,
-            therapy_name=therapy.name,
-            category=therapy.category,
-            total_sessions=total,
-            completed_sessions=completed,
-            total_duration_min=duration // 60,
-            credits_consumed=row.credits_consumed or 0,
-            avg_duration_min=round(duration / total / 60, 1) if total > 0 else 0,
-            completion_rate=round(completed / total * 100, 1) if total > 0 else 0,
+        items.append(TherapyUsageItem.model_construct(
+            therapy_id=row.therapy_id,
+            therapy_name=row.therapy_name,
+            category=row.category,
+            total_sessions=row.total_sessions,
+            completed_sessions=int(row.completed_sessions or 0),
+            total_duration_min=int(row.total_duration) // 60,
+            credits_consumed=int(row.credits_consumed),
+            avg_duration_min=float(row.avg_duration_min or 0),
+            completion_rate=float(row.completion_rate or 0),
         ))
     
     return items
 
 
 @router.get("/users/activity", response_model=list[UserActivityItem])
-async def get_user_activity(
+def get_user_activity(
     period: str = Query("month", regex="^(today|week|month|quarter|year|all)$"),
     limit: int = Query(20, ge=1, le=100),
     db: Session = Depends(get_db),
@@ -302,14 +433,18 @@ async def get_user_activity(
     
     stmt = (
         select(
-            TherapySession.user_id,
+            User.id.label("user_id"),
+            User.email,
+            User.name,
+            User.credits_balance,
             func.count(TherapySession.id).label("total_sessions"),
             func.coalesce(func.sum(TherapySession.duration_actual_sec), 0).label("total_duration"),
             func.coalesce(func.sum(TherapySession.credits_consumed), 0).label("credits_consumed"),
             func.max(TherapySession.started_at).label("last_session"),
         )
-        .where(TherapySession.started_at.between(start_date, end_date))
-        .group_by(TherapySession.user_id)
+        .join(User, User.id == TherapySession.user_id)
+        .where(_in_range(TherapySession.started_at, start_date, end_date))
+        .group_by(User.id, User.email, User.name, User.credits_balance)
         .order_by(desc("total_sessions"))
         .limit(limit)
     )
@@ -318,18 +453,14 @@ async def get_user_activity(
     
     items = []
     for row in results:
-        user = db.get(User, row.user_id)
-        if not user:
-            continue
-        
-        items.append(UserActivityItem(
-            user_id=user.id,
-            user_email=user.email,
-            user_name=user.name,
-            total_sessions=row.total_sessions or 0,
-            total_duration_min=(row.total_duration or 0) // 60,
-            credits_consumed=row.credits_consumed or 0,
-            credits_balance=user.credits_balance,
+        items.append(UserActivityItem.model_construct(
+            user_id=row.user_id,
+            user_email=row.email,
+            user_name=row.name,
+            total_sessions=row.total_sessions,
+            total_duration_min=int(row.total_duration) // 60,
+            credits_consumed=int(row.credits_consumed),
+            credits_balance=row.credits_balance,
             last_session=row.last_session,
         ))
     
@@ -337,72 +468,54 @@ async def get_user_activity(
 
 
 @router.get("/sessions/timeline", response_model=list[TimeSeriesPoint])
-async def get_sessions_timeline(
+@cached_response("analytics", ttl=SERIES_CACHE_TTL, key_params=("period",))
+def get_sessions_timeline(
     period: str = Query("month", regex="^(week|month|quarter|year)$"),
     db: Session = Depends(get_db),
     _: User = Depends(require_superadmin),
 ):
     """Serie temporal de sesiones por día."""
     start_date, end_date = get_date_range(period)
+    live_from = _live_from(db, start_date)
     
-    stmt = (
-        select(
-            func.date(TherapySession.started_at).label("date"),
-            func.count(TherapySession.id).label("count"),
-        )
-        .where(TherapySession.started_at.between(start_date, end_date))
-        .group_by(func.date(TherapySession.started_at))
-        .order_by("date")
-    )
+    points = []
+    if live_from > start_date:
+        points = [
+            TimeSeriesPoint.model_construct(date=row.date, value=row.total_sessions)
+            for row in db.execute(TIMELINE_ROLLED_STMT, {"start": start_date, "live_from": live_from})
+        ]
     
-    results = db.execute(stmt).all()
+    results = db.execute(TIMELINE_LIVE_STMT, {"live_from": live_from, "end": end_date}).all()
     
-    return [
-        TimeSeriesPoint(date=str(row.date), value=row.count)
+    return points + [
+        TimeSeriesPoint.model_construct(date=row.date, value=row.count)
         for row in results
     ]
 
 
 @router.get("/credits/flow", response_model=list[CreditFlowItem])
-async def get_credits_flow(
+@cached_response("analytics", ttl=SERIES_CACHE_TTL, key_params=("period",))
+def get_credits_flow(
     period: str = Query("month", regex="^(week|month|quarter|year)$"),
     db: Session = Depends(get_db),
     _: User = Depends(require_superadmin),
 ):
     """Flujo de créditos (agregados vs consumidos) por día."""
     start_date, end_date = get_date_range(period)
+    live_from = _live_from(db, start_date)
     
-    # Créditos agregados por día
-    added_stmt = (
-        select(
-            func.date(CreditLedger.created_at).label("date"),
-            func.coalesce(func.sum(
-                case((CreditLedger.delta > 0, CreditLedger.delta), else_=0)
-            ), 0).label("added"),
-            func.coalesce(func.sum(
-                case((CreditLedger.delta < 0, func.abs(CreditLedger.delta)), else_=0)
-            ), 0).label("consumed"),
-        )
-        .where(CreditLedger.created_at.between(start_date, end_date))
-        .group_by(func.date(CreditLedger.created_at))
-        .order_by("date")
-    )
-    
-    results = db.execute(added_stmt).all()
+    items = []
+    if live_from > start_date:
+        rolled = db.execute(CREDITS_ROLLED_STMT, {"start": start_date, "live_from": live_from})
+        items = [CreditFlowItem(**row._mapping) for row in rolled]
     
-    return [
-        CreditFlowItem(
-            date=str(row.date),
-            credits_added=row.added,
-            credits_consumed=row.consumed,
-            net_change=row.added - row.consumed,
-        )
-        for row in results
-    ]
+    # Tramo aún no consolidado
+    live = db.execute(CREDITS_LIVE_STMT, {"live_from": live_from, "end": end_date})
+    return items + [CreditFlowItem(**row._mapping) for row in live]
 
 
 @router.get("/sessions/recent", response_model=list[SessionLogItem])
-async def get_recent_sessions(
+def get_recent_sessions(
     limit: int = Query(50, ge=1, le=200),
     status: Optional[str] = Query(None),
     db: Session = Depends(get_db),
@@ -411,6 +524,7 @@ async def get_recent_sessions(
     """Sesiones recientes con detalles."""
     stmt = (
         select(TherapySession)
+        .options(selectinload(TherapySession.user), selectinload(TherapySession.therapy))
         .order_by(desc(TherapySession.started_at))
         .limit(limit)
     )
@@ -422,10 +536,10 @@ async def get_recent_sessions(
     
     items = []
     for s in sessions:
-        user = db.get(User, s.user_id)
-        therapy = db.get(Therapy, s.therapy_id)
+        user = s.user
+        therapy = s.therapy
         
-        items.append(SessionLogItem(
+        items.append(SessionLogItem.model_construct(
             id=s.id,
             user_email=user.email if user else "Unknown",
             user_name=user.name if user else None,
@@ -441,7 +555,7 @@ async def get_recent_sessions(
 
 
 @router.get("/activity/log", response_model=list[ActivityLogItem])
-async def get_activity_log(
+def get_activity_log(
     limit: int = Query(100, ge=1, le=500),
     action: Optional[str] = Query(None),
     db: Session = Depends(get_db),
@@ -450,6 +564,7 @@ async def get_activity_log(
     """Log de actividad del sistema."""
     stmt = (
         select(ActivityLog)
+        .options(selectinload(ActivityLog.user))
         .order_by(desc(ActivityLog.created_at))
         .limit(limit)
     )
@@ -461,9 +576,9 @@ async def get_activity_log(
     
     items = []
     for log in logs:
-        user = db.get(User, log.user_id) if log.user_id else None
+        user = log.user
         
-        items.append(ActivityLogItem(
+        items.append(ActivityLogItem.model_construct(
             id=log.id,
             user_email=user.email if user else None,
             action=log.action,
@@ -476,64 +591,141 @@ async def get_activity_log(
 
 
 @router.get("/categories/distribution")
-async def get_category_distribution(
+@cached_response("analytics", ttl=SERIES_CACHE_TTL, key_params=("period",))
+def get_category_distribution(
     period: str = Query("month", regex="^(today|week|month|quarter|year|all)$"),
     db: Session = Depends(get_db),
     _: User = Depends(require_superadmin),
 ):
     """Distribución de sesiones por categoría de terapia."""
     start_date, end_date = get_date_range(period)
+    live_from = _live_from(db, start_date)
     
-    stmt = (
-        select(
-            Therapy.category,
-            func.count(TherapySession.id).label("count"),
-        )
-        .join(Therapy, TherapySession.therapy_id == Therapy.id)
-        .where(TherapySession.started_at.between(start_date, end_date))
-        .group_by(Therapy.category)
-        .order_by(desc("count"))
-    )
+    category_counts: dict[str | None, int] = {}
+    if live_from > start_date:
+        for row in db.execute(CATEGORIES_ROLLED_STMT, {"start": start_date, "live_from": live_from}):
+            category_counts[row.category] = int(row.count)
     
-    results = db.execute(stmt).all()
+    for row in db.execute(CATEGORIES_LIVE_STMT, {"live_from": live_from, "end": end_date}):
+        category_counts[row.category] = category_counts.get(row.category, 0) + row.count
     
     return [
-        {"category": row.category or "Sin categoría", "count": row.count}
-        for row in results
+        {"category": category or "Sin categoría", "count": count}
+        for category, count in sorted(category_counts.items(), key=lambda item: item[1], reverse=True)
     ]
 
 
 @router.get("/hours/distribution")
-async def get_hours_distribution(
+@cached_response("analytics", ttl=SERIES_CACHE_TTL, key_params=("period",))
+def get_hours_distribution(
     period: str = Query("month", regex="^(today|week|month|quarter|year|all)$"),
     db: Session = Depends(get_db),
     _: User = Depends(require_superadmin),
 ):
     """Distribución de sesiones por hora del día."""
     start_date, end_date = get_date_range(period)
+    live_from = _live_from(db, start_date)
     
-    stmt = (
+    hour_counts = [0] * 24
+    if live_from > start_date:
+        for row in db.execute(HOURS_ROLLED_STMT, {"start": start_date, "live_from": live_from}):
+            hour_counts[row.hour] = int(row.count)
+    
+    for row in db.execute(HOURS_LIVE_STMT, {"live_from": live_from, "end": end_date}):
+        hour_counts[row.hour] += row.count
+    
+    # Horas sin sesiones quedan en 0
+    return [
+        {"hour": h, "count": count}
+        for h, count in enumerate(hour_counts)
+    ]
+
+
+# Columnas del export de sesiones (JSON y CSV)
+EXPORT_COLUMNS = [
+    "id", "user_email", "user_name", "therapy_name", "therapy_category",
+    "started_at", "ended_at", "duration_planned_sec", "duration_actual_sec",
+    "status", "credits_consumed", "arduino_connected", "color_mode_used",
+]
+EXPORT_CSV_BATCH = 1000
+
+
+def _export_stmt(start_date: datetime, end_date: datetime):
+    """Sesiones del rango con usuario y terapia en una sola consulta de columnas (sin ORM)."""
+    return (
         select(
-            extract("hour", TherapySession.started_at).label("hour"),
-            func.count(TherapySession.id).label("count"),
+            TherapySession.id,
+            User.email.label("user_email"),
+            User.name.label("user_name"),
+            Therapy.name.label("therapy_name"),
+            Therapy.category.label("therapy_category"),
+            TherapySession.started_at,
+            TherapySession.ended_at,
+            TherapySession.duration_planned_sec,
+            TherapySession.duration_actual_sec,
+            TherapySession.status,
+            TherapySession.credits_consumed,
+            TherapySession.arduino_connected,
+            TherapySession.color_mode_used,
         )
-        .where(TherapySession.started_at.between(start_date, end_date))
-        .group_by("hour")
-        .order_by("hour")
+        .outerjoin(User, TherapySession.user_id == User.id)
+        .outerjoin(Therapy, TherapySession.therapy_id == Therapy.id)
+        .where(_in_range(TherapySession.started_at, start_date, end_date))
+        .order_by(TherapySession.started_at)
     )
-    
-    results = db.execute(stmt).all()
-    
-    # Llenar horas faltantes con 0
-    hour_counts = {int(row.hour): row.count for row in results}
+
+
+def _export_values(row) -> list:
+    """Valores de una fila en el orden de EXPORT_COLUMNS."""
     return [
-        {"hour": h, "count": hour_counts.get(h, 0)}
-        for h in range(24)
+        row.id,
+        row.user_email,
+        row.user_name,
+        row.therapy_name,
+        row.therapy_category,
+        row.started_at.isoformat(),
+        row.ended_at.isoformat() if row.ended_at else None,
+        row.duration_planned_sec,
+        row.duration_actual_sec,
+        row.status.value,
+        row.credits_consumed,
+        row.arduino_connected,
+        row.color_mode_used,
     ]
 
 
+_CSV_NEEDS_QUOTE = re.compile(r'[",\r\n]')
+
+
+def _csv_field(value) -> str:
+    """Campo CSV con las mismas reglas que csv.writer (QUOTE_MINIMAL)."""
+    if value is None:
+        return ""
+    text = str(value)
+    if _CSV_NEEDS_QUOTE.search(text):
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+
+def _csv_line(values) -> str:
+    return ",".join(map(_csv_field, values)) + "\r\n"
+
+
+def _stream_sessions_csv(stmt):
+    """Genera el CSV por lotes con un cursor del lado del servidor (memoria constante).
+
+    Usa su propia sesión: la del request se cierra antes de que termine el streaming.
+    """
+    yield _csv_line(EXPORT_COLUMNS).encode()
+
+    with SessionLocal() as session:
+        result = session.execute(stmt.execution_options(stream_results=True, yield_per=EXPORT_CSV_BATCH))
+        for partition in result.partitions():
+            yield "".join(_csv_line(_export_values(row)) for row in partition).encode()
+
+
 @router.get("/export/sessions")
-async def export_sessions(
+def export_sessions(
     start_date: datetime = Query(...),
     end_date: datetime = Query(...),
     format: str = Query("json", regex="^(json|csv)$"),
@@ -541,219 +733,198 @@ async def export_sessions(
     _: User = Depends(require_superadmin),
 ):
     """Exportar sesiones para análisis externo."""
-    stmt = (
-        select(TherapySession)
-        .where(TherapySession.started_at.between(start_date, end_date))
-        .order_by(TherapySession.started_at)
-    )
-    
-    sessions = db.execute(stmt).scalars().all()
-    
-    data = []
-    for s in sessions:
-        user = db.get(User, s.user_id)
-        therapy = db.get(Therapy, s.therapy_id)
-        
-        data.append({
-            "id": s.id,
-            "user_email": user.email if user else None,
-            "user_name": user.name if user else None,
-            "therapy_name": therapy.name if therapy else None,
-            "therapy_category": therapy.category if therapy else None,
-            "started_at": s.started_at.isoformat(),
-            "ended_at": s.ended_at.isoformat() if s.ended_at else None,
-            "duration_planned_sec": s.duration_planned_sec,
-            "duration_actual_sec": s.duration_actual_sec,
-            "status": s.status.value,
-            "credits_consumed": s.credits_consumed,
-            "arduino_connected": s.arduino_connected,
-            "color_mode_used": s.color_mode_used,
-        })
+    stmt = _export_stmt(start_date, end_date)
     
     if format == "csv":
-        import csv
-        import io
-        from fastapi.responses import StreamingResponse
-        
-        output = io.StringIO()
-        if data:
-            writer = csv.DictWriter(output, fieldnames=data[0].keys())
-            writer.writeheader()
-            writer.writerows(data)
-        
-        output.seek(0)
         return StreamingResponse(
-            iter([output.getvalue()]),
+            _stream_sessions_csv(stmt),
             media_type="text/csv",
             headers={"Content-Disposition": f"attachment; filename=sessions_{start_date.date()}_{end_date.date()}.csv"}
         )
     
-    return {"sessions": data, "count": len(data)}
+    # Datos ya planos: se serializan directo con orjson, sin pasar por jsonable_encoder
+    data = [dict(zip(EXPORT_COLUMNS, _export_values(row))) for row in db.execute(stmt)]
+    return ORJSONResponse({"sessions": data, "count": len(data)})
 
 
-@router.get("/export/report")
-async def export_analytics_report(
-    start_date: datetime = Query(...),
-    end_date: datetime = Query(...),
-    db: Session = Depends(get_db),
-    _: User = Depends(require_superadmin),
-):
-    """Exportación profesional de analíticas (Excel con múltiples hojas y gráficas)."""
-    try:
-        from openpyxl import Workbook
-        from openpyxl.styles import Font, Alignment, PatternFill
-        from openpyxl.chart import LineChart, BarChart, Reference
-        from openpyxl.utils import get_column_letter
-        from openpyxl.formatting.rule import CellIsRule
-    except Exception:
-        raise HTTPException(status_code=500, detail="Dependencia openpyxl no disponible")
-
-    # ── KPIs principales
-    total_users = db.execute(select(func.count(User.id))).scalar() or 0
-    total_therapies = db.execute(select(func.count(Therapy.id))).scalar() or 0
-    total_sessions = db.execute(
-        select(func.count(TherapySession.id))
-        .where(TherapySession.started_at.between(start_date, end_date))
-    ).scalar() or 0
-    active_users = db.execute(
-        select(func.count(func.distinct(TherapySession.user_id)))
-        .where(TherapySession.started_at.between(start_date, end_date))
-    ).scalar() or 0
-    completed_sessions = db.execute(
-        select(func.count(TherapySession.id))
-        .where(
-            and_(
-                TherapySession.started_at.between(start_date, end_date),
-                TherapySession.status == SessionStatus.completed,
-            )
-        )
-    ).scalar() or 0
-    credits_added = db.execute(
-        select(func.coalesce(func.sum(CreditLedger.delta), 0))
-        .where(
-            and_(
-                CreditLedger.created_at.between(start_date, end_date),
-                CreditLedger.delta > 0,
-            )
-        )
-    ).scalar() or 0
-    credits_consumed = db.execute(
-        select(func.coalesce(func.sum(TherapySession.credits_consumed), 0))
-        .where(TherapySession.started_at.between(start_date, end_date))
-    ).scalar() or 0
-    avg_duration = db.execute(
-        select(func.avg(TherapySession.duration_actual_sec))
-        .where(
-            and_(
-                TherapySession.started_at.between(start_date, end_date),
-                TherapySession.status == SessionStatus.completed,
-            )
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def _write_iso(worksheet, row: int, col: int, value: datetime, *args):
+    """Handler de xlsxwriter: las fechas se escriben como texto ISO (igual que el export JSON/CSV)."""
+    return worksheet.write_string(row, col, value.isoformat(), *args)
+
+
+def _write_report(db: Session, start_date: datetime, end_date: datetime, path: str, charts: bool = True) -> None:
+    """Genera el reporte Excel del rango en `path` (descarga directa y jobs en segundo plano).
+
+    Con charts=False omite las gráficas (solo datos tabulares, archivo más liviano).
+    """
+    if xlsxwriter is None:
+        raise HTTPException(status_code=500, detail="Dependencia xlsxwriter no disponible")
+
+    # ── KPIs principales: una sola consulta (agregados de sesiones + subconsultas escalares)
+    is_completed = TherapySession.status == SessionStatus.completed
+    kpi = db.execute(
+        select(
+            select(func.count(User.id)).scalar_subquery().label("total_users"),
+            select(func.count(Therapy.id)).scalar_subquery().label("total_therapies"),
+            select(func.coalesce(func.sum(CreditLedger.delta), 0))
+            .where(_in_range(CreditLedger.created_at, start_date, end_date), CreditLedger.delta > 0)
+            .scalar_subquery()
+            .label("credits_added"),
+            func.count(TherapySession.id).label("total_sessions"),
+            func.count(func.distinct(TherapySession.user_id)).label("active_users"),
+            _count_if(is_completed).label("completed_sessions"),
+            func.coalesce(func.sum(TherapySession.credits_consumed), 0).label("credits_consumed"),
+            func.avg(case((is_completed, TherapySession.duration_actual_sec))).label("avg_duration"),
         )
-    ).scalar() or 0
-    avg_duration_min = round((avg_duration or 0) / 60, 2)
+        .where(_in_range(TherapySession.started_at, start_date, end_date))
+    ).one()
+    total_users = kpi.total_users or 0
+    total_therapies = kpi.total_therapies or 0
+    total_sessions = kpi.total_sessions or 0
+    active_users = kpi.active_users or 0
+    completed_sessions = int(kpi.completed_sessions or 0)
+    credits_added = int(kpi.credits_added or 0)
+    credits_consumed = int(kpi.credits_consumed or 0)
+    avg_duration = float(kpi.avg_duration or 0)
+    avg_duration_min = round(avg_duration / 60, 2)
 
     # ── Time series sesiones
     timeline_stmt = (
         select(
-            func.date(TherapySession.started_at).label("date"),
+            _session_date.label("date"),
             func.count(TherapySession.id).label("count"),
         )
-        .where(TherapySession.started_at.between(start_date, end_date))
-        .group_by(func.date(TherapySession.started_at))
+        .where(_in_range(TherapySession.started_at, start_date, end_date))
+        .group_by(_session_day)
         .order_by("date")
     )
-    timeline = db.execute(timeline_stmt).all()
 
     # ── Flow créditos
     credits_stmt = (
         select(
-            func.date(CreditLedger.created_at).label("date"),
+            cast(_ledger_day, String).label("date"),
             func.coalesce(func.sum(case((CreditLedger.delta > 0, CreditLedger.delta), else_=0)), 0).label("added"),
             func.coalesce(func.sum(case((CreditLedger.delta < 0, func.abs(CreditLedger.delta)), else_=0)), 0).label("consumed"),
+            func.coalesce(func.sum(CreditLedger.delta), 0).label("net"),
         )
-        .where(CreditLedger.created_at.between(start_date, end_date))
-        .group_by(func.date(CreditLedger.created_at))
+        .where(_in_range(CreditLedger.created_at, start_date, end_date))
+        .group_by(_ledger_day)
         .order_by("date")
     )
-    credits_flow = db.execute(credits_stmt).all()
 
     # ── Top terapias
     usage_stmt = (
         select(
-            TherapySession.therapy_id,
+            Therapy.name,
+            Therapy.category,
             func.count(TherapySession.id).label("total_sessions"),
             func.coalesce(func.sum(TherapySession.duration_actual_sec), 0).label("total_duration"),
             func.coalesce(func.sum(TherapySession.credits_consumed), 0).label("credits_consumed"),
         )
-        .where(TherapySession.started_at.between(start_date, end_date))
-        .group_by(TherapySession.therapy_id)
+        .join(Therapy, TherapySession.therapy_id == Therapy.id)
+        .where(_in_range(TherapySession.started_at, start_date, end_date))
+        .group_by(Therapy.id, Therapy.name, Therapy.category)
         .order_by(desc("total_sessions"))
         .limit(20)
     )
-    usage_rows = db.execute(usage_stmt).all()
 
     # ── Top usuarios
     users_stmt = (
         select(
-            TherapySession.user_id,
+            User.name,
+            User.email,
             func.count(TherapySession.id).label("total_sessions"),
             func.coalesce(func.sum(TherapySession.duration_actual_sec), 0).label("total_duration"),
             func.coalesce(func.sum(TherapySession.credits_consumed), 0).label("credits_consumed"),
             func.max(TherapySession.started_at).label("last_session"),
         )
-        .where(TherapySession.started_at.between(start_date, end_date))
-        .group_by(TherapySession.user_id)
+        .outerjoin(User, TherapySession.user_id == User.id)
+        .where(_in_range(TherapySession.started_at, start_date, end_date))
+        .group_by(TherapySession.user_id, User.name, User.email)
         .order_by(desc("total_sessions"))
         .limit(20)
     )
-    top_users = db.execute(users_stmt).all()
 
     # ── Distribución por categoría
     categories_stmt = (
         select(
-            Therapy.category,
+            func.coalesce(Therapy.category, "Sin categoría").label("category"),
             func.count(TherapySession.id).label("count"),
         )
         .join(Therapy, TherapySession.therapy_id == Therapy.id)
-        .where(TherapySession.started_at.between(start_date, end_date))
+        .where(_in_range(TherapySession.started_at, start_date, end_date))
         .group_by(Therapy.category)
         .order_by(desc("count"))
     )
-    categories_dist = db.execute(categories_stmt).all()
 
     # ── Distribución por hora
     hours_stmt = (
         select(
-            extract("hour", TherapySession.started_at).label("hour"),
+            _session_hour,
             func.count(TherapySession.id).label("count"),
         )
-        .where(TherapySession.started_at.between(start_date, end_date))
+        .where(_in_range(TherapySession.started_at, start_date, end_date))
         .group_by("hour")
         .order_by("hour")
     )
-    hours_dist = db.execute(hours_stmt).all()
 
-    # ── Sesiones detalle
-    sessions = db.execute(
-        select(TherapySession)
-        .where(TherapySession.started_at.between(start_date, end_date))
-        .order_by(TherapySession.started_at)
-    ).scalars().all()
+    # Los agregados anteriores son independientes entre sí
+    timeline, credits_flow, usage_rows, top_users, categories_dist, hours_dist = _execute_concurrently(
+        db, timeline_stmt, credits_stmt, usage_stmt, users_stmt, categories_stmt, hours_stmt
+    )
 
     # ── Workbook
-    wb = Workbook()
-    ws_summary = wb.active
-    ws_summary.title = "Resumen"
-
-    title_font = Font(size=16, bold=True)
-    header_font = Font(bold=True, color="FFFFFF")
-    header_fill = PatternFill("solid", fgColor="111827")
-    accent_fill = PatternFill("solid", fgColor="1F2937")
-
-    ws_summary["A1"] = "Reporte Profesional de Analíticas"
-    ws_summary["A1"].font = title_font
-    ws_summary["A2"] = f"Periodo: {start_date.date()} → {end_date.date()}"
-    ws_summary["A3"] = f"Generado: {datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')}"
+    # xlsxwriter en modo constant_memory: cada fila se vuelca al archivo al escribirla
+    wb = xlsxwriter.Workbook(path, {
+        "constant_memory": True,
+        "use_zip64": True,
+        # Nombres/emails se escriben tal cual (sin fórmulas ni hipervínculos)
+        "strings_to_formulas": False,
+        "strings_to_urls": False,
+    })
+
+    title_fmt = wb.add_format({"bold": True, "font_size": 16})
+    header_fmt = wb.add_format({"bold": True, "font_color": "#FFFFFF", "bg_color": "#111827"})
+    header_center_fmt = wb.add_format({"bold": True, "font_color": "#FFFFFF", "bg_color": "#111827", "align": "center"})
+    accent_fmt = wb.add_format({"bg_color": "#1F2937"})
+
+    def add_sheet(name: str, headers: list[str], rows) -> tuple:
+        """Hoja con encabezado, filas y panel congelado. Devuelve (hoja, índice de la última fila)."""
+        ws = wb.add_worksheet(name)
+        ws.add_write_handler(datetime, _write_iso)
+        ws.write_row(0, 0, headers, header_fmt)
+        last_row = 0
+        for last_row, row in enumerate(rows, start=1):
+            ws.write_row(last_row, 0, row)
+        ws.freeze_panes(1, 0)
+        ws.set_column(0, len(headers) - 1, 22)
+        return ws, last_row
+
+    def add_chart(ws, name: str, kind: str, title: str, x_title: str, y_title: str,
+                  anchor: str, last_row: int, value_cols: tuple[int, ...] = (1,)) -> None:
+        """Gráfica con una serie por columna de valores; categorías en la columna A."""
+        if not charts:
+            return
+        chart = wb.add_chart({"type": kind})
+        for col in value_cols:
+            chart.add_series({
+                "name": [name, 0, col],
+                "categories": [name, 1, 0, max(last_row, 1), 0],
+                "values": [name, 1, col, max(last_row, 1), col],
+            })
+        chart.set_title({"name": title})
+        chart.set_x_axis({"name": x_title})
+        chart.set_y_axis({"name": y_title})
+        ws.insert_chart(anchor, chart)
+
+    # ── Hoja: Resumen
+    ws_summary = wb.add_worksheet("Resumen")
+    ws_summary.write(0, 0, "Reporte Profesional de Analíticas", title_fmt)
+    ws_summary.write(1, 0, f"Periodo: {start_date.date()} → {end_date.date()}")
+    ws_summary.write(2, 0, f"Generado: {datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')}")
 
     summary_rows = [
         ("Usuarios totales", total_users),
@@ -768,230 +939,277 @@ async def export_analytics_report(
         ("Duración promedio (min)", avg_duration_min),
     ]
 
-    ws_summary.append(["Métrica", "Valor"])
-    ws_summary["A5"].font = header_font
-    ws_summary["B5"].font = header_font
-    ws_summary["A5"].fill = header_fill
-    ws_summary["B5"].fill = header_fill
-    ws_summary["A5"].alignment = Alignment(horizontal="center")
-    ws_summary["B5"].alignment = Alignment(horizontal="center")
-
-    for label, value in summary_rows:
-        ws_summary.append([label, value])
+    ws_summary.write_row(4, 0, ["Métrica", "Valor"], header_center_fmt)
+    for i, (label, value) in enumerate(summary_rows, start=5):
+        ws_summary.write_row(i, 0, [label, value])
+    ws_summary.freeze_panes(5, 0)
+    ws_summary.set_column(0, 1, 32)
 
-    ws_summary.freeze_panes = "A6"
-
-    for col in range(1, 3):
-        ws_summary.column_dimensions[get_column_letter(col)].width = 32
+    # Las filas de SQL ya vienen en el orden y tipo de cada hoja (xlsxwriter acepta
+    # Decimal): se escriben tal cual, sin reconstruir listas por fila
 
     # ── Hoja: Sesiones timeline
-    ws_timeline = wb.create_sheet("Sesiones (timeline)")
-    ws_timeline.append(["Fecha", "Sesiones"])
-    ws_timeline["A1"].font = header_font
-    ws_timeline["B1"].font = header_font
-    ws_timeline["A1"].fill = header_fill
-    ws_timeline["B1"].fill = header_fill
-    ws_timeline.freeze_panes = "A2"
-
-    for row in timeline:
-        ws_timeline.append([str(row.date), int(row.count)])
-
-    chart = LineChart()
-    chart.title = "Sesiones por día"
-    chart.y_axis.title = "Sesiones"
-    chart.x_axis.title = "Fecha"
-    data = Reference(ws_timeline, min_col=2, min_row=1, max_row=ws_timeline.max_row)
-    cats = Reference(ws_timeline, min_col=1, min_row=2, max_row=ws_timeline.max_row)
-    chart.add_data(data, titles_from_data=True)
-    chart.set_categories(cats)
-    ws_timeline.add_chart(chart, "D2")
+    name = "Sesiones (timeline)"
+    ws_timeline, last_row = add_sheet(name, ["Fecha", "Sesiones"], timeline)
+    add_chart(ws_timeline, name, "line", "Sesiones por día", "Fecha", "Sesiones", "D2", last_row)
 
     # ── Hoja: Créditos
-    ws_credits = wb.create_sheet("Créditos")
-    ws_credits.append(["Fecha", "Créditos agregados", "Créditos consumidos", "Net"])
-    for col in range(1, 5):
-        cell = ws_credits.cell(row=1, column=col)
-        cell.font = header_font
-        cell.fill = header_fill
-    ws_credits.freeze_panes = "A2"
-
-    for row in credits_flow:
-        added = int(row.added or 0)
-        consumed = int(row.consumed or 0)
-        ws_credits.append([str(row.date), added, consumed, added - consumed])
-
-    credits_chart = LineChart()
-    credits_chart.title = "Flujo de créditos"
-    credits_chart.y_axis.title = "Créditos"
-    credits_chart.x_axis.title = "Fecha"
-    data = Reference(ws_credits, min_col=2, min_row=1, max_col=4, max_row=ws_credits.max_row)
-    cats = Reference(ws_credits, min_col=1, min_row=2, max_row=ws_credits.max_row)
-    credits_chart.add_data(data, titles_from_data=True)
-    credits_chart.set_categories(cats)
-    ws_credits.add_chart(credits_chart, "F2")
+    name = "Créditos"
+    ws_credits, last_row = add_sheet(
+        name, ["Fecha", "Créditos agregados", "Créditos consumidos", "Net"], credits_flow,
+    )
+    add_chart(ws_credits, name, "line", "Flujo de créditos", "Fecha", "Créditos", "F2", last_row, (1, 2, 3))
 
     # ── Hoja: Top Terapias
-    ws_therapies = wb.create_sheet("Top terapias")
-    ws_therapies.append(["Terapia", "Categoría", "Sesiones", "Duración total (min)", "Créditos"])
-    for col in range(1, 6):
-        cell = ws_therapies.cell(row=1, column=col)
-        cell.font = header_font
-        cell.fill = header_fill
-    ws_therapies.freeze_panes = "A2"
-
-    for row in usage_rows:
-        therapy = db.get(Therapy, row.therapy_id)
-        if not therapy:
-            continue
-        ws_therapies.append([
-            therapy.name,
-            therapy.category or "Sin categoría",
-            int(row.total_sessions or 0),
-            int((row.total_duration or 0) // 60),
-            int(row.credits_consumed or 0),
-        ])
-
-    bar = BarChart()
-    bar.title = "Top terapias por sesiones"
-    bar.y_axis.title = "Sesiones"
-    bar.x_axis.title = "Terapia"
-    data = Reference(ws_therapies, min_col=3, min_row=1, max_row=ws_therapies.max_row)
-    cats = Reference(ws_therapies, min_col=1, min_row=2, max_row=ws_therapies.max_row)
-    bar.add_data(data, titles_from_data=True)
-    bar.set_categories(cats)
-    ws_therapies.add_chart(bar, "G2")
+    name = "Top terapias"
+    ws_therapies, last_row = add_sheet(
+        name, ["Terapia", "Categoría", "Sesiones", "Duración total (min)", "Créditos"],
+        (
+            [
+                row.name,
+                row.category or "Sin categoría",
+                int(row.total_sessions or 0),
+                int((row.total_duration or 0) // 60),
+                int(row.credits_consumed or 0),
+            ]
+            for row in usage_rows
+        ),
+    )
+    add_chart(ws_therapies, name, "column", "Top terapias por sesiones", "Terapia", "Sesiones", "G2",
+              last_row, (2,))
+    ws_therapies.autofilter(0, 0, last_row, 4)
+    # Resaltar valores altos
+    ws_therapies.conditional_format(1, 2, max(last_row, 1), 2, {
+        "type": "cell", "criteria": ">=", "value": 10, "format": accent_fmt,
+    })
 
     # ── Hoja: Top usuarios
-    ws_users = wb.create_sheet("Top usuarios")
-    ws_users.append(["Usuario", "Email", "Sesiones", "Duración total (min)", "Créditos", "Última sesión"])
-    for col in range(1, 7):
-        cell = ws_users.cell(row=1, column=col)
-        cell.font = header_font
-        cell.fill = header_fill
-    ws_users.freeze_panes = "A2"
-
-    for row in top_users:
-        user = db.get(User, row.user_id)
-        ws_users.append([
-            user.name if user else None,
-            user.email if user else None,
-            int(row.total_sessions or 0),
-            int((row.total_duration or 0) // 60),
-            int(row.credits_consumed or 0),
-            _iso(row.last_session),
-        ])
-
-    users_bar = BarChart()
-    users_bar.title = "Top usuarios por sesiones"
-    users_bar.y_axis.title = "Sesiones"
-    users_bar.x_axis.title = "Usuario"
-    data = Reference(ws_users, min_col=3, min_row=1, max_row=ws_users.max_row)
-    cats = Reference(ws_users, min_col=1, min_row=2, max_row=ws_users.max_row)
-    users_bar.add_data(data, titles_from_data=True)
-    users_bar.set_categories(cats)
-    ws_users.add_chart(users_bar, "H2")
+    def user_rows():
+        for row in top_users:
+            yield [
+                row.name,
+                row.email,
+                int(row.total_sessions or 0),
+                int((row.total_duration or 0) // 60),
+                int(row.credits_consumed or 0),
+                row.last_session,
+            ]
+
+    name = "Top usuarios"
+    ws_users, last_row = add_sheet(
+        name, ["Usuario", "Email", "Sesiones", "Duración total (min)", "Créditos", "Última sesión"],
+        user_rows(),
+    )
+    add_chart(ws_users, name, "column", "Top usuarios por sesiones", "Usuario", "Sesiones", "H2",
+              last_row, (2,))
+    ws_users.autofilter(0, 0, last_row, 5)
 
     # ── Hoja: Categorías
-    ws_categories = wb.create_sheet("Categorías")
-    ws_categories.append(["Categoría", "Sesiones"])
-    for col in range(1, 3):
-        cell = ws_categories.cell(row=1, column=col)
-        cell.font = header_font
-        cell.fill = header_fill
-    ws_categories.freeze_panes = "A2"
-
-    for row in categories_dist:
-        ws_categories.append([row.category or "Sin categoría", int(row.count or 0)])
-
-    cat_bar = BarChart()
-    cat_bar.title = "Sesiones por categoría"
-    cat_bar.y_axis.title = "Sesiones"
-    cat_bar.x_axis.title = "Categoría"
-    data = Reference(ws_categories, min_col=2, min_row=1, max_row=ws_categories.max_row)
-    cats = Reference(ws_categories, min_col=1, min_row=2, max_row=ws_categories.max_row)
-    cat_bar.add_data(data, titles_from_data=True)
-    cat_bar.set_categories(cats)
-    ws_categories.add_chart(cat_bar, "D2")
+    name = "Categorías"
+    ws_categories, last_row = add_sheet(name, ["Categoría", "Sesiones"], categories_dist)
+    add_chart(ws_categories, name, "column", "Sesiones por categoría", "Categoría", "Sesiones", "D2", last_row)
+    ws_categories.autofilter(0, 0, last_row, 1)
 
     # ── Hoja: Horas
-    ws_hours = wb.create_sheet("Horas")
-    ws_hours.append(["Hora", "Sesiones"])
-    for col in range(1, 3):
-        cell = ws_hours.cell(row=1, column=col)
-        cell.font = header_font
-        cell.fill = header_fill
-    ws_hours.freeze_panes = "A2"
-
-    hour_counts = {int(r.hour): int(r.count or 0) for r in hours_dist}
-    for h in range(24):
-        ws_hours.append([h, hour_counts.get(h, 0)])
-
-    hours_line = LineChart()
-    hours_line.title = "Sesiones por hora"
-    hours_line.y_axis.title = "Sesiones"
-    hours_line.x_axis.title = "Hora"
-    data = Reference(ws_hours, min_col=2, min_row=1, max_row=ws_hours.max_row)
-    cats = Reference(ws_hours, min_col=1, min_row=2, max_row=ws_hours.max_row)
-    hours_line.add_data(data, titles_from_data=True)
-    hours_line.set_categories(cats)
-    ws_hours.add_chart(hours_line, "D2")
+    hour_counts = [0] * 24
+    for r in hours_dist:
+        hour_counts[r.hour] = r.count
+    name = "Horas"
+    ws_hours, last_row = add_sheet(
+        name, ["Hora", "Sesiones"],
+        ([h, count] for h, count in enumerate(hour_counts)),
+    )
+    add_chart(ws_hours, name, "line", "Sesiones por hora", "Hora", "Sesiones", "D2", last_row)
 
     # ── Hoja: Sesiones (detalle)
-    ws_sessions = wb.create_sheet("Sesiones (detalle)")
-    ws_sessions.append([
-        "ID", "Usuario", "Email", "Terapia", "Categoría", "Inicio", "Fin", "Duración plan (seg)",
-        "Duración real (seg)", "Estado", "Créditos", "Arduino", "Color"
-    ])
-    for col in range(1, 14):
-        cell = ws_sessions.cell(row=1, column=col)
-        cell.font = header_font
-        cell.fill = header_fill
-    ws_sessions.freeze_panes = "A2"
+    # Columnas ya en el orden de la hoja (LEFT JOIN a usuario/terapia, estado como texto):
+    # las filas se escriben tal cual. Se leen por lotes y cada fila se vuelca al archivo
+    # al escribirla, así la memoria no crece con el número de sesiones.
+    sessions_stmt = (
+        select(
+            TherapySession.id,
+            User.name,
+            User.email,
+            Therapy.name,
+            Therapy.category,
+            TherapySession.started_at,
+            TherapySession.ended_at,
+            TherapySession.duration_planned_sec,
+            TherapySession.duration_actual_sec,
+            type_coerce(TherapySession.status, String),
+            TherapySession.credits_consumed,
+            TherapySession.arduino_connected,
+            TherapySession.color_mode_used,
+        )
+        .outerjoin(User, TherapySession.user_id == User.id)
+        .outerjoin(Therapy, TherapySession.therapy_id == Therapy.id)
+        .where(_in_range(TherapySession.started_at, start_date, end_date))
+        .order_by(TherapySession.started_at)
+        .execution_options(yield_per=EXPORT_CSV_BATCH)
+    )
 
-    for s in sessions:
-        user = db.get(User, s.user_id)
-        therapy = db.get(Therapy, s.therapy_id)
-        ws_sessions.append([
-            s.id,
-            user.name if user else None,
-            user.email if user else None,
-            therapy.name if therapy else None,
-            therapy.category if therapy else None,
-            _iso(s.started_at),
-            _iso(s.ended_at),
-            s.duration_planned_sec,
-            s.duration_actual_sec,
-            s.status.value,
-            s.credits_consumed,
-            s.arduino_connected,
-            s.color_mode_used,
-        ])
-
-    # Ajustar ancho de columnas
-    for ws in [ws_timeline, ws_credits, ws_therapies, ws_users, ws_categories, ws_hours, ws_sessions]:
-        for col in range(1, ws.max_column + 1):
-            ws.column_dimensions[get_column_letter(col)].width = 22
-
-    # Formato numérico y filtros
-    ws_sessions.auto_filter.ref = ws_sessions.dimensions
-    ws_therapies.auto_filter.ref = ws_therapies.dimensions
-    ws_users.auto_filter.ref = ws_users.dimensions
-    ws_categories.auto_filter.ref = ws_categories.dimensions
-
-    # Resaltar valores altos en hojas clave
-    ws_therapies.conditional_formatting.add(
-        f"C2:C{ws_therapies.max_row}",
-        CellIsRule(operator="greaterThanOrEqual", formula=["10"], fill=accent_fill),
+    ws_sessions, last_row = add_sheet(
+        "Sesiones (detalle)",
+        [
+            "ID", "Usuario", "Email", "Terapia", "Categoría", "Inicio", "Fin", "Duración plan (seg)",
+            "Duración real (seg)", "Estado", "Créditos", "Arduino", "Color",
+        ],
+        db.execute(sessions_stmt),
     )
+    ws_sessions.autofilter(0, 0, last_row, 12)
+
+    wb.close()
+
+
+def _report_etag(db: Session, start_date: datetime, end_date: datetime, charts: bool) -> str:
+    """Huella de los datos del reporte: cambia si cambian sesiones, ledger, usuarios o terapias.
+
+    Es una huella de agregados (no hay updated_at): renombrar un usuario o una terapia
+    no la modifica, por eso se publica como ETag débil.
+    """
+    row = db.execute(
+        select(
+            func.count(TherapySession.id),
+            func.max(func.coalesce(TherapySession.ended_at, TherapySession.started_at)),
+            func.sum(TherapySession.duration_actual_sec),
+            func.sum(TherapySession.credits_consumed),
+            _count_if(TherapySession.status == SessionStatus.completed),
+            select(func.count(CreditLedger.id))
+            .where(_in_range(CreditLedger.created_at, start_date, end_date))
+            .scalar_subquery(),
+            select(func.max(CreditLedger.id)).scalar_subquery(),
+            select(func.max(User.id)).scalar_subquery(),
+            select(func.count(User.id)).scalar_subquery(),
+            select(func.max(Therapy.id)).scalar_subquery(),
+            select(func.count(Therapy.id)).scalar_subquery(),
+        )
+        .where(_in_range(TherapySession.started_at, start_date, end_date))
+    ).one()
+    key = repr((start_date, end_date, charts, tuple(row))).encode()
+    return f'W/"{hashlib.blake2b(key, digest_size=16).hexdigest()}"'
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+@router.get("/export/report")
+def export_analytics_report(
+    start_date: datetime = Query(...),
+    end_date: datetime = Query(...),
+    charts: bool = Query(True),
+    if_none_match: str | None = Header(None),
+    db: Session = Depends(get_db),
+    _: User = Depends(require_superadmin),
+):
+    """Exportación profesional de analíticas (Excel con múltiples hojas y gráficas).
+
+    Responde 304 sin regenerar el archivo si los datos del rango no cambiaron (If-None-Match).
+    """
+    etag = _report_etag(db, start_date, end_date, charts)
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
 
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
+    fd, tmp_path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        _write_report(db, start_date, end_date, tmp_path, charts)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
     filename = f"analytics_report_{start_date.date()}_{end_date.date()}.xlsx"
-    from fastapi.responses import StreamingResponse
-    return StreamingResponse(
-        iter([output.getvalue()]),
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    return FileResponse(
+        tmp_path,
+        media_type=XLSX_MEDIA_TYPE,
+        headers={"Content-Disposition": f"attachment; filename={filename}", "ETag": etag},
+        background=BackgroundTask(os.unlink, tmp_path),
+    )
+
+
+# ──────────────────────────────────────────────────────────────
+# Reporte en segundo plano
+# ──────────────────────────────────────────────────────────────
+# El estado vive en disco (sirve entre workers del mismo host):
+#   {job_id}.part   → en proceso
+#   {job_id}.error  → falló
+#   analytics_report_{inicio}_{fin}_{job_id}.xlsx → listo
+REPORTS_DIR = Path(settings.REPORTS_DIR or Path(tempfile.gettempdir()) / "panel_kryon_reports")
+_report_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="analytics-report")
+
+
+class ReportJobOut(BaseModel):
+    job_id: str
+    status: str
+    status_url: str
+
+
+def _cleanup_reports() -> None:
+    """Borra reportes (y marcas de estado) más viejos que REPORT_JOB_TTL_SEC."""
+    cutoff = time.time() - settings.REPORT_JOB_TTL_SEC
+    for path in REPORTS_DIR.iterdir():
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _run_report_job(job_id: str, start_date: datetime, end_date: datetime, charts: bool) -> None:
+    part = REPORTS_DIR / f"{job_id}.part"
+    try:
+        with SessionLocal() as db:
+            _write_report(db, start_date, end_date, str(part), charts)
+        part.rename(REPORTS_DIR / f"analytics_report_{start_date.date()}_{end_date.date()}_{job_id}.xlsx")
+    except Exception as e:
+        part.unlink(missing_ok=True)
+        (REPORTS_DIR / f"{job_id}.error").write_text(str(e))
+
+
+@router.post("/export/report/jobs", response_model=ReportJobOut, status_code=202)
+def create_report_job(
+    start_date: datetime = Query(...),
+    end_date: datetime = Query(...),
+    charts: bool = Query(True),
+    _: User = Depends(require_superadmin),
+):
+    """Encola la generación del reporte Excel; se descarga luego desde status_url."""
+    REPORTS_DIR.mkdir(parents=True, exist_ok=True)
+    _cleanup_reports()
+
+    job_id = uuid.uuid4().hex
+    (REPORTS_DIR / f"{job_id}.part").touch()
+    _report_executor.submit(_run_report_job, job_id, start_date, end_date, charts)
+
+    return ReportJobOut(
+        job_id=job_id,
+        status="pending",
+        status_url=f"{router.prefix}/export/report/jobs/{job_id}",
     )
+
+
+@router.get("/export/report/jobs/{job_id}")
+def get_report_job(
+    job_id: str = FastAPIPath(..., pattern="^[0-9a-f]{32}$"),
+    _: User = Depends(require_superadmin),
+):
+    """Descarga el reporte si ya está listo; si no, responde 202 con el estado."""
+    ready = next(REPORTS_DIR.glob(f"analytics_report_*_{job_id}.xlsx"), None)
+    if ready:
+        filename = ready.name.replace(f"_{job_id}", "")
+        return FileResponse(
+            ready,
+            media_type=XLSX_MEDIA_TYPE,
+            headers={"Content-Disposition": f"attachment; filename={filename}"},
+        )
+
+    if (REPORTS_DIR / f"{job_id}.part").exists():
+        return ORJSONResponse({"job_id": job_id, "status": "pending"}, status_code=202)
+
+    if (REPORTS_DIR / f"{job_id}.error").exists():
+        raise HTTPException(status_code=500, detail="No se pudo generar el reporte")
+
+    raise HTTPException(status_code=404, detail="Reporte no encontrado o expirado")
@@ -2,11 +2,18 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import BaseModel, EmailStr
 from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy import bindparam, select, update
 
 from ..db import get_db
-from ..models import User
-from ..auth import verify_password, get_password_hash, create_access_token, get_current_user
+from ..models import User, UserPlan, Plan
+from ..auth import (
+    verify_password,
+    get_password_hash,
+    password_needs_rehash,
+    create_access_token,
+    get_current_user,
+    invalidate_user_cache,
+)
 
 router = APIRouter(prefix="/api/auth", tags=["auth"])
 
@@ -48,14 +55,32 @@ class UserResponse(BaseModel):
 
 
 # ──────────────────────────────────────────────────────────────
-# Endpoints
+# Helpers
 # ──────────────────────────────────────────────────────────────
-@router.post("/login", response_model=TokenResponse)
-async def login(form: LoginRequest, db: Session = Depends(get_db)):
-    """Login de usuario (email + password)."""
-    user = db.execute(select(User).where(User.email == form.email)).scalar_one_or_none()
+# Sentencias construidas una sola vez (SQL compilado reutilizado). El login solo
+# proyecta las columnas que necesita, sin hidratar el User completo.
+_LOGIN_STMT = select(
+    User.id, User.email, User.password_hash, User.is_active, User.role,
+).where(User.email == bindparam("email"))
+_EMAIL_EXISTS_STMT = select(User.id).where(User.email == bindparam("email"))
+
+
+def _rehash_if_needed(db: Session, user, password: str) -> None:
+    """Migrar hashes legacy (bcrypt) a argon2 tras un login exitoso."""
+    if not password_needs_rehash(user.password_hash):
+        return
+    db.execute(
+        update(User).where(User.id == user.id).values(password_hash=get_password_hash(password))
+    )
+    db.commit()
+    invalidate_user_cache(user.id)
 
-    if not user or not verify_password(form.password, user.password_hash):
+
+def _authenticate(db: Session, email: str, password: str) -> TokenResponse:
+    """Valida credenciales y emite el token (común a /login y /login/form)."""
+    user = db.execute(_LOGIN_STMT, {"email": email}).one_or_none()
+
+    if not user or not verify_password(password, user.password_hash):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Email o contraseña incorrectos",
@@ -67,39 +92,33 @@ async def login(form: LoginRequest, db: Session = Depends(get_db)):
             detail="Usuario desactivado",
         )
 
+    _rehash_if_needed(db, user, password)
+
     token = create_access_token(
         data={"sub": str(user.id), "email": user.email, "role": user.role.value}
     )
     return TokenResponse(access_token=token)
 
 
-@router.post("/login/form", response_model=TokenResponse)
-async def login_form(form: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    """Login compatible con OAuth2PasswordRequestForm (para /docs)."""
-    user = db.execute(select(User).where(User.email == form.username)).scalar_one_or_none()
-
-    if not user or not verify_password(form.password, user.password_hash):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Email o contraseña incorrectos",
-        )
+# ──────────────────────────────────────────────────────────────
+# Endpoints
+# ──────────────────────────────────────────────────────────────
+@router.post("/login", response_model=TokenResponse)
+def login(form: LoginRequest, db: Session = Depends(get_db)):
+    """Login de usuario (email + password)."""
+    return _authenticate(db, form.email, form.password)
 
-    if not user.is_active:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Usuario desactivado",
-        )
 
-    token = create_access_token(
-        data={"sub": str(user.id), "email": user.email, "role": user.role.value}
-    )
-    return TokenResponse(access_token=token)
+@router.post("/login/form", response_model=TokenResponse)
+def login_form(form: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    """Login compatible con OAuth2PasswordRequestForm (para /docs)."""
+    return _authenticate(db, form.username, form.password)
 
 
 @router.post("/register", response_model=UserResponse)
-async def register(form: RegisterRequest, db: Session = Depends(get_db)):
+def register(form: RegisterRequest, db: Session = Depends(get_db)):
     """Registro de nuevo usuario (rol: user)."""
-    existing = db.execute(select(User).where(User.email == form.email)).scalar_one_or_none()
+    existing = db.execute(_EMAIL_EXISTS_STMT, {"email": form.email}).first()
     if existing:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -115,7 +134,7 @@ async def register(form: RegisterRequest, db: Session = Depends(get_db)):
     db.commit()
     db.refresh(user)
 
-    return UserResponse(
+    return UserResponse.model_construct(
         id=user.id,
         email=user.email,
         name=user.name,
@@ -126,24 +145,33 @@ async def register(form: RegisterRequest, db: Session = Depends(get_db)):
 
 
 @router.get("/me", response_model=UserResponse)
-async def get_me(current_user: User = Depends(get_current_user)):
-    """Obtener perfil del usuario actual."""
-    plan_id = None
-    plan_name = None
-    therapies_access = None
-    if current_user.user_plan and current_user.user_plan.plan:
-        plan_id = current_user.user_plan.plan.id
-        plan_name = current_user.user_plan.plan.name
-        therapies_access = current_user.user_plan.plan.therapies_access
-
-    return UserResponse(
+def get_me(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Obtener perfil del usuario actual.
+
+    Saldo y plan se leen de la BD (un SELECT): el User de la caché puede no reflejar
+    créditos o planes cambiados en otro worker.
+    """
+    row = db.execute(
+        select(
+            User.credits_balance,
+            Plan.id.label("plan_id"),
+            Plan.name.label("plan_name"),
+            Plan.therapies_access,
+        )
+        .outerjoin(UserPlan, UserPlan.user_id == User.id)
+        .outerjoin(Plan, Plan.id == UserPlan.plan_id)
+        .where(User.id == current_user.id)
+    ).one()
+
+    # Datos del ORM (ya tipados): sin validación por campo
+    return UserResponse.model_construct(
         id=current_user.id,
         email=current_user.email,
         name=current_user.name,
         role=current_user.role.value,
-        credits_balance=current_user.credits_balance,
-        low_credits=current_user.credits_balance <= 15,
-        plan_id=plan_id,
-        plan_name=plan_name,
-        therapies_access=therapies_access,
+        credits_balance=row.credits_balance,
+        low_credits=row.credits_balance <= 15,
+        plan_id=row.plan_id,
+        plan_name=row.plan_name,
+        therapies_access=row.therapies_access,
     )
@@ -5,16 +5,22 @@ Router para gestión de categorías y modos de luz.
 """
 
 from fastapi import APIRouter, Depends, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, computed_field
 from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy import select, update
 
 from ..db import get_db
 from ..models import User, Category, LightMode
 from ..auth import get_current_user, require_admin
+from ..cache import cached_response, invalidate
 
 router = APIRouter(prefix="/api/categories", tags=["categories"])
 
+# Cambian muy poco y se piden en cada carga de página: respuestas cacheadas.
+# Categorías se invalidan al crear/editar/borrar; los modos de luz son fijos.
+CATEGORIES_CACHE_TTL = 60
+LIGHT_MODES_CACHE_TTL = 300
+
 
 def _slugify(value: str) -> str:
     return value.lower().replace(" ", "_").replace("/", "_")
@@ -26,7 +32,6 @@ def _slugify(value: str) -> str:
 class CategoryOut(BaseModel):
     id: int
     name: str
-    slug: str = ""  # Alias for name (compatibility)
     description: str | None
     color: str
     icon: str
@@ -34,11 +39,11 @@ class CategoryOut(BaseModel):
 
     class Config:
         from_attributes = True
-    
-    def __init__(self, **data):
-        if 'slug' not in data or not data['slug']:
-            data['slug'] = _slugify(data.get('name', ''))
-        super().__init__(**data)
+
+    @computed_field  # Alias for name (compatibility)
+    @property
+    def slug(self) -> str:
+        return _slugify(self.name)
 
 
 class CreateCategoryRequest(BaseModel):
@@ -59,7 +64,6 @@ class UpdateCategoryRequest(BaseModel):
 class LightModeOut(BaseModel):
     id: int
     name: str
-    slug: str = ""  # Alias for name (compatibility)
     display_name: str
     description: str | None
     esp32_command: str
@@ -69,38 +73,50 @@ class LightModeOut(BaseModel):
 
     class Config:
         from_attributes = True
-    
-    def __init__(self, **data):
-        if 'slug' not in data or not data['slug']:
-            data['slug'] = _slugify(data.get('name', ''))
-        super().__init__(**data)
+
+    @computed_field  # Alias for name (compatibility)
+    @property
+    def slug(self) -> str:
+        return _slugify(self.name)
+
+
+# Solo las columnas que expone cada schema (sin hidratar objetos ORM)
+_CATEGORY_COLUMNS = (
+    Category.id, Category.name, Category.description, Category.color, Category.icon, Category.is_active,
+)
+_LIGHT_MODE_COLUMNS = (
+    LightMode.id, LightMode.name, LightMode.display_name, LightMode.description,
+    LightMode.esp32_command, LightMode.color, LightMode.icon, LightMode.is_active,
+)
 
 
 # ──────────────────────────────────────────────────────────────
 # Categories Endpoints (Users can view, Admin can CRUD)
 # ──────────────────────────────────────────────────────────────
 @router.get("", response_model=list[CategoryOut])
-async def list_categories(
+@cached_response("categories", ttl=CATEGORIES_CACHE_TTL)
+def list_categories(
     db: Session = Depends(get_db),
     _: User = Depends(get_current_user),
 ):
     """Listar categorías activas (para usuarios)."""
-    rows = db.execute(select(Category).where(Category.is_active == True)).scalars().all()
-    return list(rows)
+    rows = db.execute(select(*_CATEGORY_COLUMNS).where(Category.is_active == True))
+    return [CategoryOut(**row._mapping) for row in rows]
 
 
 @router.get("/all", response_model=list[CategoryOut])
-async def list_all_categories(
+@cached_response("categories", ttl=CATEGORIES_CACHE_TTL)
+def list_all_categories(
     db: Session = Depends(get_db),
     _: User = Depends(require_admin),
 ):
     """Listar todas las categorías incluyendo inactivas (admin)."""
-    rows = db.execute(select(Category).order_by(Category.id)).scalars().all()
-    return list(rows)
+    rows = db.execute(select(*_CATEGORY_COLUMNS).order_by(Category.id))
+    return [CategoryOut(**row._mapping) for row in rows]
 
 
 @router.post("", response_model=CategoryOut)
-async def create_category(
+def create_category(
     form: CreateCategoryRequest,
     db: Session = Depends(get_db),
     _: User = Depends(require_admin),
@@ -122,11 +138,12 @@ async def create_category(
     db.add(category)
     db.commit()
     db.refresh(category)
+    invalidate("categories")
     return category
 
 
 @router.put("/{category_id}", response_model=CategoryOut)
-async def update_category(
+def update_category(
     category_id: int,
     form: UpdateCategoryRequest,
     db: Session = Depends(get_db),
@@ -157,23 +174,25 @@ async def update_category(
 
     db.commit()
     db.refresh(category)
+    invalidate("categories")
     return category
 
 
 @router.delete("/{category_id}")
-async def delete_category(
+def delete_category(
     category_id: int,
     db: Session = Depends(get_db),
     _: User = Depends(require_admin),
 ):
     """Eliminar categoría (admin). Soft delete."""
-    category = db.get(Category, category_id)
-    if not category:
+    # Soft delete en un solo UPDATE (sin cargar la fila)
+    result = db.execute(
+        update(Category).where(Category.id == category_id).values(is_active=False)
+    )
+    if result.rowcount == 0:
         raise HTTPException(status_code=404, detail="Categoría no encontrada")
-    
-    # Soft delete
-    category.is_active = False
     db.commit()
+    invalidate("categories")
     return {"message": "Categoría desactivada"}
 
 
@@ -181,7 +200,8 @@ async def delete_category(
 # Light Modes Endpoints (Read-only for everyone)
 # ──────────────────────────────────────────────────────────────
 @router.get("/light-modes", response_model=list[LightModeOut])
-async def list_light_modes(
+@cached_response("light_modes", ttl=LIGHT_MODES_CACHE_TTL)
+def list_light_modes(
     db: Session = Depends(get_db),
     _: User = Depends(get_current_user),
 ):
@@ -191,28 +211,29 @@ async def list_light_modes(
     Solo se usan para personalización temporal de sesiones.
     """
     rows = db.execute(
-        select(LightMode).where(LightMode.is_active == True).order_by(LightMode.id)
-    ).scalars().all()
+        select(*_LIGHT_MODE_COLUMNS).where(LightMode.is_active == True).order_by(LightMode.id)
+    ).all()
     
     # If no modes in DB, return hardcoded defaults
     if not rows:
         return get_default_light_modes()
     
-    return list(rows)
+    return [LightModeOut(**row._mapping) for row in rows]
 
 
 @router.get("/light-modes/all", response_model=list[LightModeOut])
-async def list_all_light_modes(
+@cached_response("light_modes", ttl=LIGHT_MODES_CACHE_TTL)
+def list_all_light_modes(
     db: Session = Depends(get_db),
     _: User = Depends(require_admin),
 ):
     """Listar todos los modos de luz (admin)."""
-    rows = db.execute(select(LightMode).order_by(LightMode.id)).scalars().all()
+    rows = db.execute(select(*_LIGHT_MODE_COLUMNS).order_by(LightMode.id)).all()
     
     if not rows:
         return get_default_light_modes()
     
-    return list(rows)
+    return [LightModeOut(**row._mapping) for row in rows]
 
 
 def get_default_light_modes():
@@ -220,14 +241,18 @@ def get_default_light_modes():
     Modos de luz por defecto (hardcoded).
     Estos se usan si no hay modos en la base de datos.
     """
-    return [
-        LightModeOut(id=1, name="general", display_name="Patrón Complejo", description="11 patrones variables", esp32_command="general", color="#06b6d4", icon="🔄", is_active=True),
-        LightModeOut(id=2, name="intermitente", display_name="Intermitente", description="Cambio rápido 500ms", esp32_command="intermitente", color="#f59e0b", icon="⚡", is_active=True),
-        LightModeOut(id=3, name="pausado", display_name="Pausado", description="Cambio lento 1.5s", esp32_command="pausado", color="#8b5cf6", icon="⏸️", is_active=True),
-        LightModeOut(id=4, name="cascada", display_name="Cascada", description="Efecto cascada", esp32_command="cascada", color="#10b981", icon="🌊", is_active=True),
-        LightModeOut(id=5, name="cascrev", display_name="Cascada Reversa", description="Cascada invertida", esp32_command="cascrev", color="#182521", icon="🌊", is_active=True),
-        LightModeOut(id=6, name="rojo", display_name="Solo Rojo", description="Rojo sólido", esp32_command="rojo", color="#ef4444", icon="🔴", is_active=True),
-        LightModeOut(id=7, name="verde", display_name="Solo Verde", description="Verde sólido", esp32_command="verde", color="#22c55e", icon="🟢", is_active=True),
-        LightModeOut(id=8, name="azul", display_name="Solo Azul", description="Azul sólido", esp32_command="azul", color="#3b82f6", icon="🔵", is_active=True),
-        LightModeOut(id=9, name="blanco", display_name="Solo Blanco", description="Blanco sólido", esp32_command="blanco", color="#ffffff", icon="⚪", is_active=True),
-    ]
+    return DEFAULT_LIGHT_MODES
+
+
+# Construidos una sola vez al importar el módulo
+DEFAULT_LIGHT_MODES = [
+    LightModeOut(id=1, name="general", display_name="Patrón Complejo", description="11 patrones variables", esp32_command="general", color="#06b6d4", icon="🔄", is_active=True),
+    LightModeOut(id=2, name="intermitente", display_name="Intermitente", description="Cambio rápido 500ms", esp32_command="intermitente", color="#f59e0b", icon="⚡", is_active=True),
+    LightModeOut(id=3, name="pausado", display_name="Pausado", description="Cambio lento 1.5s", esp32_command="pausado", color="#8b5cf6", icon="⏸️", is_active=True),
+    LightModeOut(id=4, name="cascada", display_name="Cascada", description="Efecto cascada", esp32_command="cascada", color="#10b981", icon="🌊", is_active=True),
+    LightModeOut(id=5, name="cascrev", display_name="Cascada Reversa", description="Cascada invertida", esp32_command="cascrev", color="#182521", icon="🌊", is_active=True),
+    LightModeOut(id=6, name="rojo", display_name="Solo Rojo", description="Rojo sólido", esp32_command="rojo", color="#ef4444", icon="🔴", is_active=True),
+    LightModeOut(id=7, name="verde", display_name="Solo Verde", description="Verde sólido", esp32_command="verde", color="#22c55e", icon="🟢", is_active=True),
+    LightModeOut(id=8, name="azul", display_name="Solo Azul", description="Azul sólido", esp32_command="azul", color="#3b82f6", icon="🔵", is_active=True),
+    LightModeOut(id=9, name="blanco", display_name="Solo Blanco", description="Blanco sólido", esp32_command="blanco", color="#ffffff", icon="⚪", is_active=True),
+]
@@ -1,11 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy import select, update
 
 from ..db import get_db
 from ..models import User, Plan
-from ..auth import require_superadmin
+from ..auth import require_superadmin, clear_user_cache
 
 router = APIRouter(prefix="/api/admin/plans", tags=["admin-plans"])
 
@@ -47,14 +47,14 @@ class UpdatePlanRequest(BaseModel):
 # Endpoints
 # ──────────────────────────────────────────────────────────────
 @router.get("", response_model=list[PlanOut])
-async def list_plans(db: Session = Depends(get_db), _: User = Depends(require_superadmin)):
+def list_plans(db: Session = Depends(get_db), _: User = Depends(require_superadmin)):
     """Listar todos los planes."""
     plans = db.execute(select(Plan)).scalars().all()
     return [PlanOut.model_validate(p) for p in plans]
 
 
 @router.post("", response_model=PlanOut)
-async def create_plan(
+def create_plan(
     form: CreatePlanRequest,
     db: Session = Depends(get_db),
     _: User = Depends(require_superadmin),
@@ -78,7 +78,7 @@ async def create_plan(
 
 
 @router.get("/{plan_id}", response_model=PlanOut)
-async def get_plan(
+def get_plan(
     plan_id: int,
     db: Session = Depends(get_db),
     _: User = Depends(require_superadmin),
@@ -91,7 +91,7 @@ async def get_plan(
 
 
 @router.put("/{plan_id}", response_model=PlanOut)
-async def update_plan(
+def update_plan(
     plan_id: int,
     form: UpdatePlanRequest,
     db: Session = Depends(get_db),
@@ -117,20 +117,22 @@ async def update_plan(
 
     db.commit()
     db.refresh(plan)
+    clear_user_cache()
     return PlanOut.model_validate(plan)
 
 
 @router.delete("/{plan_id}")
-async def delete_plan(
+def delete_plan(
     plan_id: int,
     db: Session = Depends(get_db),
     _: User = Depends(require_superadmin),
 ):
     """Eliminar plan (soft delete: desactivar)."""
-    plan = db.get(Plan, plan_id)
-    if not plan:
+    # Un solo UPDATE (sin cargar la fila)
+    result = db.execute(update(Plan).where(Plan.id == plan_id).values(is_active=False))
+    if result.rowcount == 0:
         raise HTTPException(status_code=404, detail="Plan no encontrado")
-
-    plan.is_active = False
     db.commit()
+    # Los usuarios cacheados llevan su plan cargado
+    clear_user_cache()
     return {"ok": True, "message": "Plan desactivado"}
@@ -1,7 +1,7 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel
-from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import select
+from sqlalchemy.orm import Session, joinedload, raiseload, selectinload
+from sqlalchemy import case, delete, func, select, update
 
 from ..db import get_db
 from ..models import User, Playlist, PlaylistItem, Therapy
@@ -59,9 +59,62 @@ class ReorderItemsRequest(BaseModel):
 # ──────────────────────────────────────────────────────────────
 # Helpers
 # ──────────────────────────────────────────────────────────────
+# Items (uno-a-muchos) con selectinload: una consulta extra en vez del producto
+# playlist × items de un JOIN; la terapia de cada item y el creador (muchos-a-uno) van en JOIN.
+# raiseload("*"): cualquier otra relación que se toque sin cargarla falla en vez de
+# disparar un SELECT silencioso por fila.
+PLAYLIST_LOAD_OPTIONS = (
+    selectinload(Playlist.items).joinedload(PlaylistItem.therapy),
+    joinedload(Playlist.creator),
+    raiseload("*"),
+)
+
+
+def _playlist_with_items_stmt(playlist_id: int):
+    return select(Playlist).where(Playlist.id == playlist_id).options(*PLAYLIST_LOAD_OPTIONS)
+
+
+def _playlist_summary_stmt():
+    """Playlists sin items: conteo y duración total agregados en SQL.
+
+    Misma regla que playlist_to_out: override si es distinto de 0, si no la duración de la terapia.
+    """
+    item_duration = func.coalesce(func.nullif(PlaylistItem.duration_override, 0), Therapy.default_duration_sec)
+    return (
+        select(
+            Playlist.id,
+            Playlist.name,
+            Playlist.created_by,
+            User.name.label("created_by_name"),
+            func.count(PlaylistItem.id).label("items_count"),
+            func.coalesce(func.sum(item_duration), 0).label("total_duration"),
+        )
+        .outerjoin(User, User.id == Playlist.created_by)
+        .outerjoin(PlaylistItem, PlaylistItem.playlist_id == Playlist.id)
+        .outerjoin(Therapy, Therapy.id == PlaylistItem.therapy_id)
+        .group_by(Playlist.id, Playlist.name, Playlist.created_by, Playlist.created_at, User.name)
+    )
+
+
+def summary_to_out(row) -> PlaylistOut:
+    """Fila de _playlist_summary_stmt() → PlaylistOut (sin items).
+
+    model_construct: los valores ya vienen tipados de la BD, no hace falta validarlos.
+    """
+    return PlaylistOut.model_construct(
+        id=row.id,
+        name=row.name,
+        created_by=row.created_by,
+        created_by_name=row.created_by_name,
+        items_count=int(row.items_count),
+        total_duration_min=int(row.total_duration) // 60,
+        items=[],
+    )
+
+
 def playlist_to_out(playlist: Playlist, include_items: bool = False) -> PlaylistOut:
-    """Convertir Playlist a PlaylistOut."""
-    creator = playlist.creator if hasattr(playlist, 'creator') else None
+    """Convertir Playlist a PlaylistOut (model_construct: datos ya tipados por el ORM)."""
+    creator = playlist.creator
     
     items_out = []
     total_duration = 0
@@ -72,7 +125,7 @@ def playlist_to_out(playlist: Playlist, include_items: bool = False) -> Playlist
         total_duration += duration
         
         if include_items:
-            items_out.append(PlaylistItemOut(
+            items_out.append(PlaylistItemOut.model_construct(
                 id=item.id,
                 therapy_id=item.therapy_id,
                 therapy_name=therapy.name,
@@ -81,7 +134,7 @@ def playlist_to_out(playlist: Playlist, include_items: bool = False) -> Playlist
                 color_mode_override=item.color_mode_override,
             ))
     
-    return PlaylistOut(
+    return PlaylistOut.model_construct(
         id=playlist.id,
         name=playlist.name,
         created_by=playlist.created_by,
@@ -92,45 +145,38 @@ def playlist_to_out(playlist: Playlist, include_items: bool = False) -> Playlist
     )
 
 
+def require_playlist(playlist_id: int, db: Session = Depends(get_db)) -> int:
+    """Dependency: 404 si la playlist no existe. Solo consulta el id, no carga la fila."""
+    if db.scalar(select(Playlist.id).where(Playlist.id == playlist_id)) is None:
+        raise HTTPException(status_code=404, detail="Playlist no encontrada")
+    return playlist_id
+
+
 # ──────────────────────────────────────────────────────────────
 # Endpoints
 # ──────────────────────────────────────────────────────────────
 @router.get("", response_model=list[PlaylistOut])
-async def list_playlists(db: Session = Depends(get_db), user: User = Depends(require_auth)):
+def list_playlists(db: Session = Depends(get_db), user: User = Depends(require_auth)):
     """Listar todas las playlists."""
-    stmt = (
-        select(Playlist)
-        .options(
-            joinedload(Playlist.items).joinedload(PlaylistItem.therapy),
-        )
-        .order_by(Playlist.created_at.desc())
-    )
-    playlists = db.execute(stmt).unique().scalars().all()
-    return [playlist_to_out(p) for p in playlists]
+    stmt = _playlist_summary_stmt().order_by(Playlist.created_at.desc())
+    return [summary_to_out(row) for row in db.execute(stmt)]
 
 
 @router.get("/{playlist_id}", response_model=PlaylistOut)
-async def get_playlist(
+def get_playlist(
     playlist_id: int,
     db: Session = Depends(get_db),
     user: User = Depends(require_auth),
 ):
     """Obtener una playlist con sus items."""
-    stmt = (
-        select(Playlist)
-        .where(Playlist.id == playlist_id)
-        .options(
-            joinedload(Playlist.items).joinedload(PlaylistItem.therapy),
-        )
-    )
-    playlist = db.execute(stmt).unique().scalar_one_or_none()
+    playlist = db.execute(_playlist_with_items_stmt(playlist_id)).scalar_one_or_none()
     if not playlist:
         raise HTTPException(status_code=404, detail="Playlist no encontrada")
     return playlist_to_out(playlist, include_items=True)
 
 
 @router.post("", response_model=PlaylistOut)
-async def create_playlist(
+def create_playlist(
     form: CreatePlaylistRequest,
     db: Session = Depends(get_db),
     user: User = Depends(require_auth),
@@ -141,10 +187,10 @@ async def create_playlist(
         created_by=user.id,
     )
     db.add(playlist)
-    db.commit()
-    db.refresh(playlist)
-    
-    return PlaylistOut(
+    # flush asigna id (RETURNING donde el motor lo soporta) y defaults; la respuesta se
+    # arma antes del commit para no releer la fila con refresh()
+    db.flush()
+    out = PlaylistOut(
         id=playlist.id,
         name=playlist.name,
         created_by=playlist.created_by,
@@ -153,22 +199,23 @@ async def create_playlist(
         total_duration_min=0,
         items=[],
     )
+    db.commit()
+    return out
 
 
 @router.put("/{playlist_id}", response_model=PlaylistOut)
-async def update_playlist(
+def update_playlist(
     playlist_id: int,
     form: UpdatePlaylistRequest,
+    include_items: bool = Query(True),
     db: Session = Depends(get_db),
     user: User = Depends(require_auth),
 ):
-    """Actualizar playlist."""
-    stmt = (
-        select(Playlist)
-        .where(Playlist.id == playlist_id)
-        .options(joinedload(Playlist.items).joinedload(PlaylistItem.therapy))
-    )
-    playlist = db.execute(stmt).unique().scalar_one_or_none()
+    """Actualizar playlist.
+
+    Con include_items=false responde sin items (solo conteo y duración), sin cargarlos.
+    """
+    playlist = db.get(Playlist, playlist_id)
     if not playlist:
         raise HTTPException(status_code=404, detail="Playlist no encontrada")
     
@@ -176,26 +223,26 @@ async def update_playlist(
         playlist.name = form.name
     
     db.commit()
-    db.refresh(playlist)
+    if not include_items:
+        return summary_to_out(db.execute(_playlist_summary_stmt().where(Playlist.id == playlist_id)).one())
+
+    # Items en la misma pasada (refresh() los dejaría en lazy load por item)
+    playlist = db.execute(_playlist_with_items_stmt(playlist_id)).scalar_one()
     return playlist_to_out(playlist, include_items=True)
 
 
 @router.delete("/{playlist_id}")
-async def delete_playlist(
+def delete_playlist(
     playlist_id: int,
     db: Session = Depends(get_db),
     user: User = Depends(require_auth),
 ):
     """Eliminar playlist."""
-    playlist = db.get(Playlist, playlist_id)
-    if not playlist:
+    # Items primero y luego la playlist: dos DELETE en bloque, sin cargar filas
+    db.execute(delete(PlaylistItem).where(PlaylistItem.playlist_id == playlist_id))
+    result = db.execute(delete(Playlist).where(Playlist.id == playlist_id))
+    if result.rowcount == 0:
         raise HTTPException(status_code=404, detail="Playlist no encontrada")
-    
-    # Eliminar items primero
-    for item in playlist.items:
-        db.delete(item)
-    
-    db.delete(playlist)
     db.commit()
     return {"ok": True, "message": "Playlist eliminada"}
 
@@ -204,23 +251,22 @@ async def delete_playlist(
 # Items endpoints
 # ──────────────────────────────────────────────────────────────
 @router.post("/{playlist_id}/items", response_model=PlaylistItemOut)
-async def add_item(
-    playlist_id: int,
+def add_item(
     form: AddItemRequest,
     db: Session = Depends(get_db),
     user: User = Depends(require_auth),
+    playlist_id: int = Depends(require_playlist),
 ):
     """Agregar terapia a playlist."""
-    playlist = db.get(Playlist, playlist_id)
-    if not playlist:
-        raise HTTPException(status_code=404, detail="Playlist no encontrada")
-    
-    therapy = db.get(Therapy, form.therapy_id)
-    if not therapy:
+    therapy_name = db.scalar(select(Therapy.name).where(Therapy.id == form.therapy_id))
+    if therapy_name is None:
         raise HTTPException(status_code=404, detail="Terapia no encontrada")
     
-    # Obtener el orden máximo actual
-    max_order = max([item.order for item in playlist.items], default=-1)
+    # Orden máximo actual calculado en SQL (sin cargar los items)
+    max_order = db.execute(
+        select(func.coalesce(func.max(PlaylistItem.order), -1))
+        .where(PlaylistItem.playlist_id == playlist_id)
+    ).scalar_one()
     
     item = PlaylistItem(
         playlist_id=playlist_id,
@@ -230,21 +276,21 @@ async def add_item(
         color_mode_override=form.color_mode_override,
     )
     db.add(item)
-    db.commit()
-    db.refresh(item)
-    
-    return PlaylistItemOut(
+    db.flush()
+    out = PlaylistItemOut(
         id=item.id,
         therapy_id=item.therapy_id,
-        therapy_name=therapy.name,
+        therapy_name=therapy_name,
         order=item.order,
         duration_override=item.duration_override,
         color_mode_override=item.color_mode_override,
     )
+    db.commit()
+    return out
 
 
 @router.put("/{playlist_id}/items/{item_id}", response_model=PlaylistItemOut)
-async def update_item(
+def update_item(
     playlist_id: int,
     item_id: int,
     form: UpdateItemRequest,
@@ -278,38 +324,39 @@ async def update_item(
 
 
 @router.delete("/{playlist_id}/items/{item_id}")
-async def delete_item(
+def delete_item(
     playlist_id: int,
     item_id: int,
     db: Session = Depends(get_db),
     user: User = Depends(require_auth),
 ):
     """Eliminar item de playlist."""
-    item = db.get(PlaylistItem, item_id)
-    if not item or item.playlist_id != playlist_id:
+    # DELETE directo: la pertenencia a la playlist va en el WHERE, sin cargar el item
+    result = db.execute(
+        delete(PlaylistItem).where(PlaylistItem.id == item_id, PlaylistItem.playlist_id == playlist_id)
+    )
+    if result.rowcount == 0:
         raise HTTPException(status_code=404, detail="Item no encontrado")
-    
-    db.delete(item)
     db.commit()
     return {"ok": True, "message": "Item eliminado"}
 
 
 @router.post("/{playlist_id}/reorder")
-async def reorder_items(
-    playlist_id: int,
+def reorder_items(
     form: ReorderItemsRequest,
     db: Session = Depends(get_db),
     user: User = Depends(require_auth),
+    playlist_id: int = Depends(require_playlist),
 ):
     """Reordenar items de playlist."""
-    playlist = db.get(Playlist, playlist_id)
-    if not playlist:
-        raise HTTPException(status_code=404, detail="Playlist no encontrada")
-    
-    for order, item_id in enumerate(form.item_ids):
-        item = db.get(PlaylistItem, item_id)
-        if item and item.playlist_id == playlist_id:
-            item.order = order
+    # Un solo UPDATE ... SET order = CASE id WHEN ... END; el WHERE ignora ids de otras playlists
+    if form.item_ids:
+        new_order = {item_id: order for order, item_id in enumerate(form.item_ids)}
+        db.execute(
+            update(PlaylistItem)
+            .where(PlaylistItem.playlist_id == playlist_id, PlaylistItem.id.in_(new_order))
+            .values(order=case(new_order, value=PlaylistItem.id))
+        )
     
     db.commit()
     return {"ok": True, "message": "Items reordenados"}
@@ -1,13 +1,16 @@
 from datetime import datetime
+import functools
+import json
 
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy.orm import Session, joinedload, raiseload, selectinload
+from sqlalchemy import insert, select, update
 
-from ..db import get_db
-from ..models import User, Therapy, TherapySession, SessionStatus, CreditLedger, ActivityLog
-from ..auth import require_auth
+from ..db import SessionLocal, get_db
+from ..models import User, Therapy, TherapySession, SessionStatus, CreditLedger, ActivityLog, Plan, UserPlan
+from ..auth import require_auth, invalidate_user_cache
+from ..cache import invalidate
 
 router = APIRouter(prefix="/api/sessions", tags=["sessions"])
 
@@ -46,8 +49,20 @@ class SessionOut(BaseModel):
 # ──────────────────────────────────────────────────────────────
 # Helpers
 # ──────────────────────────────────────────────────────────────
+def _write_activity_log(row: dict) -> None:
+    """Inserta el log con su propia sesión corta del pool (fuera de la petición)."""
+    try:
+        with SessionLocal() as db:
+            db.execute(insert(ActivityLog), [row])
+            db.commit()
+        invalidate("analytics")
+    except Exception as e:
+        # El log no es crítico: un fallo aquí no debe afectar a la sesión ya confirmada
+        print(f"⚠️  Log de actividad no registrado ({row.get('action')}): {e}")
+
+
 def log_activity(
-    db: Session,
+    background_tasks: BackgroundTasks,
     user_id: int | None,
     action: str,
     entity_type: str | None = None,
@@ -56,72 +71,103 @@ def log_activity(
     ip_address: str | None = None,
     user_agent: str | None = None,
 ):
-    """Registrar actividad en el log."""
-    log = ActivityLog(
-        user_id=user_id,
-        action=action,
-        entity_type=entity_type,
-        entity_id=entity_id,
-        description=description,
-        ip_address=ip_address,
-        user_agent=user_agent,
-    )
-    db.add(log)
+    """Registrar actividad en el log.
+
+    Se encola como tarea de fondo: la respuesta no espera el INSERT del log, que va
+    en su propia transacción después de enviarla.
+    """
+    background_tasks.add_task(_write_activity_log, {
+        "user_id": user_id,
+        "action": action,
+        "entity_type": entity_type,
+        "entity_id": entity_id,
+        "description": description,
+        "ip_address": ip_address,
+        "user_agent": user_agent,
+    })
+
+
+@functools.lru_cache(maxsize=512)
+def _parse_plan_access(access_value: str | None) -> tuple[str, frozenset[int] | None]:
+    """Interpreta Plan.therapies_access una sola vez por valor distinto.
+
+    Devuelve ("all", None), ("basic", None) o ("ids", ids permitidos).
+    """
+    # Sin plan asignado => básico
+    if not access_value:
+        return "basic", None
+
+    v = str(access_value).strip()
+    if v in {"all", "premium"}:
+        return "all", None
+    if v == "basic":
+        return "basic", None
+
+    # Lista de IDs permitidos (JSON)
+    if v.startswith("["):
+        try:
+            allowed_ids = json.loads(v)
+            if isinstance(allowed_ids, list):
+                return "ids", frozenset(int(x) for x in allowed_ids if str(x).isdigit() or isinstance(x, int))
+        except Exception:
+            pass  # fallback: no bloquear por formato inesperado
+
+    # Fallback: no bloquear
+    return "all", None
 
 
 # ──────────────────────────────────────────────────────────────
 # Endpoints
 # ──────────────────────────────────────────────────────────────
 @router.post("/start", response_model=SessionOut)
-async def start_session(
+def start_session(
     form: StartSessionRequest,
     request: Request,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     user: User = Depends(require_auth),
 ):
     """Iniciar una nueva sesión de terapia."""
-    # Verificar terapia existe
-    therapy = db.get(Therapy, form.therapy_id)
-    if not therapy or not therapy.is_active:
+    # Terapia + acceso del plan + saldo del usuario en una sola consulta. El saldo se lee
+    # de la BD: el User de get_current_user sale de la caché y puede estar desactualizado
+    credits_balance = (
+        select(User.credits_balance).where(User.id == user.id).scalar_subquery().label("credits_balance")
+    )
+    row = db.execute(
+        select(
+            Therapy.id,
+            Therapy.name,
+            Therapy.is_active,
+            Therapy.access_level,
+            Therapy.color_mode,
+            Plan.therapies_access,
+            Plan.is_active.label("plan_is_active"),
+            credits_balance,
+        )
+        .select_from(Therapy)
+        .outerjoin(UserPlan, UserPlan.user_id == user.id)
+        .outerjoin(Plan, Plan.id == UserPlan.plan_id)
+        .where(Therapy.id == form.therapy_id)
+    ).first()
+    if not row or not row.is_active:
         raise HTTPException(status_code=404, detail="Terapia no encontrada")
+    therapy = row
 
-    # Verificar acceso por plan (server-side, para evitar bypass)
-    plan_access = None
-    if user.user_plan and user.user_plan.plan and user.user_plan.plan.is_active:
-        plan_access = user.user_plan.plan.therapies_access
-
-    def _is_allowed_by_plan(access_value: str | None, t: Therapy) -> bool:
-        # Admins siempre pueden
-        if getattr(user, "role", None) and getattr(user.role, "value", None) in {"admin", "superadmin"}:
-            return True
-
-        # Sin plan asignado => básico
-        if not access_value:
-            return (getattr(t, "access_level", None) or "basic") != "premium"
-
-        v = str(access_value).strip()
-        if v in {"all", "premium"}:
-            return True
-        if v == "basic":
-            return (getattr(t, "access_level", None) or "basic") != "premium"
-
-        # Lista de IDs permitidos (JSON)
-        if v.startswith("["):
-            try:
-                allowed_ids = json.loads(v)
-                if isinstance(allowed_ids, list):
-                    return int(t.id) in {int(x) for x in allowed_ids if str(x).isdigit() or isinstance(x, int)}
-            except Exception:
-                return True  # fallback: no bloquear por formato inesperado
-
-        # Fallback: no bloquear
-        return True
-
-    if not _is_allowed_by_plan(plan_access, therapy):
-        raise HTTPException(status_code=403, detail="Terapia no disponible en tu plan")
+    # Verificar acceso por plan (server-side, para evitar bypass). Admins siempre pueden
+    # y con plan "all"/"premium" no hace falta mirar el access_level de la terapia.
+    if getattr(user.role, "value", None) not in {"admin", "superadmin"}:
+        kind, allowed_ids = _parse_plan_access(row.therapies_access if row.plan_is_active else None)
+        if kind == "basic":
+            allowed = (row.access_level or "basic") != "premium"
+        elif kind == "ids":
+            allowed = int(row.id) in allowed_ids
+        else:
+            allowed = True
+        if not allowed:
+            raise HTTPException(status_code=403, detail="Terapia no disponible en tu plan")
     
     # Verificar créditos suficientes (1 crédito por sesión)
-    if user.credits_balance < 1:
+    if (row.credits_balance or 0) < 1:
         raise HTTPException(status_code=400, detail="Créditos insuficientes")
     
     # Crear sesión
@@ -138,7 +184,7 @@ async def start_session(
     
     # Log de actividad
     log_activity(
-        db,
+        background_tasks,
         user_id=user.id,
         action="session_start",
         entity_type="therapy",
@@ -148,10 +194,10 @@ async def start_session(
         user_agent=request.headers.get("user-agent"),
     )
     
-    db.commit()
-    db.refresh(session)
-    
-    return SessionOut(
+    # flush asigna id y defaults (started_at...); la respuesta se arma antes del
+    # commit para no releer la fila con refresh()
+    db.flush()
+    out = SessionOut(
         id=session.id,
         therapy_id=session.therapy_id,
         therapy_name=therapy.name,
@@ -162,20 +208,31 @@ async def start_session(
         status=session.status.value,
         credits_consumed=session.credits_consumed,
     )
+    db.commit()
+    invalidate("analytics")
+    return out
 
 
 @router.post("/{session_id}/end", response_model=SessionOut)
-async def end_session(
+def end_session(
     session_id: int,
     form: EndSessionRequest,
     request: Request,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     user: User = Depends(require_auth),
 ):
     """Finalizar una sesión de terapia."""
-    session = db.get(TherapySession, session_id)
-    if not session:
+    # Sesión + solo el nombre de la terapia (no la fila completa) en una consulta
+    row = db.execute(
+        select(TherapySession, Therapy.name)
+        .outerjoin(Therapy, Therapy.id == TherapySession.therapy_id)
+        .where(TherapySession.id == session_id)
+        .options(raiseload("*"))
+    ).first()
+    if not row:
         raise HTTPException(status_code=404, detail="Sesión no encontrada")
+    session, therapy_name = row
     
     if session.user_id != user.id:
         raise HTTPException(status_code=403, detail="No tienes permiso para esta sesión")
@@ -183,8 +240,6 @@ async def end_session(
     if session.status != SessionStatus.started:
         raise HTTPException(status_code=400, detail="La sesión ya fue finalizada")
     
-    therapy = db.get(Therapy, session.therapy_id)
-    
     # Calcular duración real
     now = datetime.utcnow()
     if form.duration_actual_sec is not None:
@@ -208,35 +263,39 @@ async def end_session(
         credits_to_consume = 1
         session.credits_consumed = credits_to_consume
         
-        # Descontar crédito del usuario
-        user.credits_balance -= credits_to_consume
+        # Descontar crédito del usuario en SQL (atómico): el User cacheado puede traer un
+        # saldo viejo y escribirlo de vuelta pisaría recargas hechas en otro worker
+        db.execute(
+            update(User)
+            .where(User.id == user.id)
+            .values(credits_balance=User.credits_balance - credits_to_consume),
+            execution_options={"synchronize_session": False},
+        )
         
         # Registrar en ledger
         ledger = CreditLedger(
             user_id=user.id,
             delta=-credits_to_consume,
-            reason=f"Sesión completada: {therapy.name if therapy else 'Terapia'}",
+            reason=f"Sesión completada: {therapy_name or 'Terapia'}",
         )
         db.add(ledger)
     
     # Log de actividad
     log_activity(
-        db,
+        background_tasks,
         user_id=user.id,
         action=f"session_{form.status}",
         entity_type="session",
         entity_id=session.id,
-        description=f"Sesión {form.status}: {therapy.name if therapy else 'Terapia'} ({actual_duration // 60} min)",
+        description=f"Sesión {form.status}: {therapy_name or 'Terapia'} ({actual_duration // 60} min)",
         ip_address=request.client.host if request.client else None,
     )
     
-    db.commit()
-    db.refresh(session)
-    
-    return SessionOut(
+    # La sesión ya está cargada: la respuesta sale de memoria, sin refresh() tras el commit
+    out = SessionOut(
         id=session.id,
         therapy_id=session.therapy_id,
-        therapy_name=therapy.name if therapy else "Unknown",
+        therapy_name=therapy_name or "Unknown",
         started_at=session.started_at,
         ended_at=session.ended_at,
         duration_planned_sec=session.duration_planned_sec,
@@ -244,10 +303,16 @@ async def end_session(
         status=session.status.value,
         credits_consumed=session.credits_consumed,
     )
+    user_id = user.id  # el commit expira al usuario; evita recargarlo solo por el id
+    db.commit()
+    invalidate("analytics")
+    if credits_to_consume:
+        invalidate_user_cache(user_id)
+    return out
 
 
 @router.get("/my", response_model=list[SessionOut])
-async def get_my_sessions(
+def get_my_sessions(
     limit: int = 20,
     db: Session = Depends(get_db),
     user: User = Depends(require_auth),
@@ -255,6 +320,7 @@ async def get_my_sessions(
     """Obtener mis sesiones recientes."""
     stmt = (
         select(TherapySession)
+        .options(selectinload(TherapySession.therapy), raiseload("*"))
         .where(TherapySession.user_id == user.id)
         .order_by(TherapySession.started_at.desc())
         .limit(limit)
@@ -262,10 +328,11 @@ async def get_my_sessions(
     
     sessions = db.execute(stmt).scalars().all()
     
+    # model_construct evita validar cada fila (ya tipadas por el ORM)
     items = []
     for s in sessions:
-        therapy = db.get(Therapy, s.therapy_id)
-        items.append(SessionOut(
+        therapy = s.therapy
+        items.append(SessionOut.model_construct(
             id=s.id,
             therapy_id=s.therapy_id,
             therapy_name=therapy.name if therapy else "Unknown",
@@ -281,13 +348,14 @@ async def get_my_sessions(
 
 
 @router.get("/active")
-async def get_active_session(
+def get_active_session(
     db: Session = Depends(get_db),
     user: User = Depends(require_auth),
 ):
     """Verificar si hay una sesión activa."""
     stmt = (
         select(TherapySession)
+        .options(joinedload(TherapySession.therapy), raiseload("*"))
         .where(
             TherapySession.user_id == user.id,
             TherapySession.status == SessionStatus.started,
@@ -301,7 +369,7 @@ async def get_active_session(
     if not session:
         return {"active": False}
     
-    therapy = db.get(Therapy, session.therapy_id)
+    therapy = session.therapy
     
     return {
         "active": True,
@@ -1,7 +1,12 @@
+import hashlib
 import os
+import shutil
 from pathlib import Path
 
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+import orjson
+
+from fastapi import APIRouter, Depends, HTTPException, Request, UploadFile, File
+from fastapi.responses import Response
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
 from sqlalchemy import select
@@ -10,9 +15,14 @@ from ..config import settings
 from ..db import get_db
 from ..models import User, Therapy
 from ..auth import get_current_user, require_admin
+from ..cache import cached_response, invalidate
 
 router = APIRouter(prefix="/api/therapies", tags=["therapies"])
 
+# El listado lo pide cada cliente y solo cambia con escrituras de admin: se cachea ya
+# serializado (bytes) y se invalida en create/update/delete/uploads de este router.
+THERAPIES_CACHE_TTL = 20
+
 
 # ──────────────────────────────────────────────────────────────
 # Schemas
@@ -90,72 +100,133 @@ class UpdateTherapyRequest(BaseModel):
 # ──────────────────────────────────────────────────────────────
 # Helpers
 # ──────────────────────────────────────────────────────────────
+AUDIO_URL_PREFIX = "/media/audio/"
+VIDEO_URL_PREFIX = "/media/video/"
+
+
+def _basename(path: str) -> str:
+    """Nombre de archivo de una ruta guardada, con separador / o \\ (rutas de Windows)."""
+    i = max(path.rfind("/"), path.rfind("\\"))
+    return path[i + 1:] if i >= 0 else path
+
+
 def get_audio_url(path: str | None) -> str | None:
     if not path:
         return None
-    return f"/media/audio/{Path(path).name}"
+    return AUDIO_URL_PREFIX + _basename(path)
 
 
-def therapy_to_out(t: Therapy) -> TherapyOut:
+def therapy_to_dict(t) -> dict:
+    """Terapia (entidad o fila de _THERAPY_COLUMNS) → dict con las claves de TherapyOut."""
     # Legacy audio_url uses audio_corto_path or audio_path
-    audio_url = get_audio_url(t.audio_corto_path) or get_audio_url(t.audio_path)
-    video_url = f"/media/video/{Path(t.video_path).name}" if t.video_path else None
+    audio_corto_url = get_audio_url(t.audio_corto_path)
+    audio_url = audio_corto_url or get_audio_url(t.audio_path)
+    video_url = VIDEO_URL_PREFIX + _basename(t.video_path) if t.video_path else None
     
-    return TherapyOut(
-        id=t.id,
-        name=t.name,
-        description=t.description,
-        category=t.category,
-        access_level=getattr(t, "access_level", None) or "basic",
-        default_duration_sec=t.default_duration_sec,
-        color_mode=t.color_mode,
-        default_intensity=getattr(t, 'default_intensity', None) or 50,
-        media_type=getattr(t, 'media_type', None) or "audio",
-        audio_corto_url=get_audio_url(getattr(t, 'audio_corto_path', None)),
-        audio_mediano_url=get_audio_url(getattr(t, 'audio_mediano_path', None)),
-        audio_largo_url=get_audio_url(getattr(t, 'audio_largo_path', None)),
-        audio_url=audio_url,
-        video_url=video_url,
-        duration_corto_sec=getattr(t, 'duration_corto_sec', None) or 300,
-        duration_mediano_sec=getattr(t, 'duration_mediano_sec', None) or 1200,
-        duration_largo_sec=getattr(t, 'duration_largo_sec', None) or 10800,
-        duration_labels=getattr(t, 'duration_labels', None),
-        arduino_config=t.arduino_config,
-        is_active=t.is_active,
-    )
+    return {
+        "id": t.id,
+        "name": t.name,
+        "description": t.description,
+        "category": t.category,
+        "access_level": t.access_level or "basic",
+        "default_duration_sec": t.default_duration_sec,
+        "color_mode": t.color_mode,
+        "default_intensity": t.default_intensity or 50,
+        "media_type": t.media_type or "audio",
+        "audio_corto_url": audio_corto_url,
+        "audio_mediano_url": get_audio_url(t.audio_mediano_path),
+        "audio_largo_url": get_audio_url(t.audio_largo_path),
+        "audio_url": audio_url,
+        "video_url": video_url,
+        "duration_corto_sec": t.duration_corto_sec or 300,
+        "duration_mediano_sec": t.duration_mediano_sec or 1200,
+        "duration_largo_sec": t.duration_largo_sec or 10800,
+        "duration_labels": t.duration_labels,
+        "arduino_config": t.arduino_config,
+        "is_active": t.is_active,
+    }
+
+
+# Solo las columnas que usa therapy_to_dict (las filas se leen por atributo igual que
+# una entidad): el listado no hidrata objetos ORM ni los registra en la sesión
+_THERAPY_COLUMNS = (
+    Therapy.id, Therapy.name, Therapy.description, Therapy.category, Therapy.access_level,
+    Therapy.default_duration_sec, Therapy.color_mode, Therapy.default_intensity, Therapy.media_type,
+    Therapy.audio_corto_path, Therapy.audio_mediano_path, Therapy.audio_largo_path,
+    Therapy.audio_path, Therapy.video_path,
+    Therapy.duration_corto_sec, Therapy.duration_mediano_sec, Therapy.duration_largo_sec,
+    Therapy.duration_labels, Therapy.arduino_config, Therapy.is_active,
+)
+
+
+def _etag(body: bytes) -> str:
+    """ETag a partir del contenido: igual en todos los workers y cambia con cualquier escritura."""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def _json_or_not_modified(request: Request, body: bytes, etag: str) -> Response:
+    """304 sin cuerpo si el cliente ya tiene esta versión (If-None-Match); si no, el JSON con su ETag."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if etag in candidates or "*" in candidates:
+            return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+@cached_response("therapies", ttl=THERAPIES_CACHE_TTL)
+def _active_therapies_json(db: Session) -> tuple[str, bytes]:
+    """Terapias activas serializadas y su ETag. Se cachean bytes y no el Response: los
+    middlewares (CORS) agregan headers sobre la lista del Response y se acumularían entre peticiones."""
+    rows = db.execute(select(*_THERAPY_COLUMNS).where(Therapy.is_active == True))
+    body = orjson.dumps([therapy_to_dict(row) for row in rows])
+    return _etag(body), body
+
+
+def therapy_to_out(t: Therapy) -> TherapyOut:
+    # model_construct: datos ya tipados por el ORM, no hace falta validarlos
+    return TherapyOut.model_construct(**therapy_to_dict(t))
 
 
 # ──────────────────────────────────────────────────────────────
 # Endpoints públicos (requiere auth)
 # ──────────────────────────────────────────────────────────────
 @router.get("", response_model=list[TherapyOut])
-async def list_therapies(
+def list_therapies(
+    request: Request,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    """Listar terapias activas."""
-    rows = db.execute(select(Therapy).where(Therapy.is_active == True)).scalars().all()
-    return [therapy_to_out(t) for t in rows]
+    """Listar terapias activas.
+
+    Devuelve la respuesta ya serializada con orjson: al retornar un Response FastAPI no
+    pasa por jsonable_encoder ni revalida (response_model queda para la documentación).
+    Con If-None-Match igual al ETag responde 304 sin cuerpo.
+    """
+    etag, body = _active_therapies_json(db)
+    return _json_or_not_modified(request, body, etag)
 
 
 @router.get("/{therapy_id}", response_model=TherapyOut)
-async def get_therapy(
+def get_therapy(
     therapy_id: int,
+    request: Request,
     db: Session = Depends(get_db),
     _: User = Depends(get_current_user),
 ):
-    """Obtener una terapia por ID."""
+    """Obtener una terapia por ID (con ETag / 304 igual que el listado)."""
     therapy = db.get(Therapy, therapy_id)
     if not therapy:
         raise HTTPException(status_code=404, detail="Terapia no encontrada")
-    return therapy_to_out(therapy)
+    body = orjson.dumps(therapy_to_dict(therapy))
+    return _json_or_not_modified(request, body, _etag(body))
 
 
 # ──────────────────────────────────────────────────────────────
 # Endpoints admin
 # ──────────────────────────────────────────────────────────────
 @router.post("", response_model=TherapyOut)
-async def create_therapy(
+def create_therapy(
     form: CreateTherapyRequest,
     db: Session = Depends(get_db),
     _: User = Depends(require_admin),
@@ -173,12 +244,13 @@ async def create_therapy(
     )
     db.add(therapy)
     db.commit()
+    invalidate("therapies")
     db.refresh(therapy)
     return therapy_to_out(therapy)
 
 
 @router.put("/{therapy_id}", response_model=TherapyOut)
-async def update_therapy(
+def update_therapy(
     therapy_id: int,
     form: UpdateTherapyRequest,
     db: Session = Depends(get_db),
@@ -189,42 +261,22 @@ async def update_therapy(
     if not therapy:
         raise HTTPException(status_code=404, detail="Terapia no encontrada")
 
-    if form.name is not None:
-        therapy.name = form.name
-    if form.description is not None:
-        therapy.description = form.description
-    if form.category is not None:
-        therapy.category = form.category
-    if form.access_level is not None:
-        therapy.access_level = form.access_level
-    if form.default_duration_sec is not None:
-        therapy.default_duration_sec = form.default_duration_sec
-    if form.color_mode is not None:
-        therapy.color_mode = form.color_mode
-    if form.default_intensity is not None:
-        therapy.default_intensity = form.default_intensity
-    if form.media_type is not None:
-        therapy.media_type = form.media_type
-    if form.duration_corto_sec is not None:
-        therapy.duration_corto_sec = form.duration_corto_sec
-    if form.duration_mediano_sec is not None:
-        therapy.duration_mediano_sec = form.duration_mediano_sec
-    if form.duration_largo_sec is not None:
-        therapy.duration_largo_sec = form.duration_largo_sec
-    if form.duration_labels is not None:
-        therapy.duration_labels = form.duration_labels
-    if form.arduino_config is not None:
-        therapy.arduino_config = form.arduino_config
-    if form.is_active is not None:
-        therapy.is_active = form.is_active
+    # Solo los campos enviados (exclude_unset). Un null explícito limpia las columnas
+    # nullable; en las NOT NULL se ignora, como antes
+    columns = Therapy.__table__.c
+    for field, value in form.model_dump(exclude_unset=True).items():
+        if value is None and not columns[field].nullable:
+            continue
+        setattr(therapy, field, value)
 
     db.commit()
+    invalidate("therapies")
     db.refresh(therapy)
     return therapy_to_out(therapy)
 
 
 @router.delete("/{therapy_id}")
-async def delete_therapy(
+def delete_therapy(
     therapy_id: int,
     db: Session = Depends(get_db),
     _: User = Depends(require_admin),
@@ -236,35 +288,68 @@ async def delete_therapy(
 
     therapy.is_active = False
     db.commit()
+    invalidate("therapies")
     return {"ok": True, "message": "Terapia desactivada"}
 
 
 # ──────────────────────────────────────────────────────────────
 # Upload media
 # ──────────────────────────────────────────────────────────────
-ALLOWED_AUDIO = {".mp3", ".wav", ".m4a", ".aac", ".ogg", ".flac"}
-ALLOWED_VIDEO = {".mp4", ".webm", ".mov", ".avi", ".mkv"}
+ALLOWED_AUDIO = frozenset({".mp3", ".wav", ".m4a", ".aac", ".ogg", ".flac"})
+ALLOWED_VIDEO = frozenset({".mp4", ".webm", ".mov", ".avi", ".mkv"})
+# Resueltas una vez al importar; main.py las crea en el arranque
+AUDIO_DIR = Path(settings.MEDIA_DIR).resolve() / "audio"
+VIDEO_DIR = Path(settings.MEDIA_DIR).resolve() / "video"
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _upload_ext(filename: str, allowed: frozenset[str]) -> str:
+    """Extensión en minúsculas del archivo subido; 400 si no está permitida."""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in allowed:
+        raise HTTPException(status_code=400, detail=f"Formato no soportado. Permitidos: {', '.join(sorted(allowed))}")
+    return ext
+
+
+def _save_upload(file: UploadFile, target: Path) -> None:
+    """Copia el archivo subido a disco por bloques (memoria constante, sin leerlo entero).
+
+    Se escribe en un .part y se renombra al final: si la copia falla no queda un archivo
+    de media a medias reemplazando al anterior.
+    """
+    max_bytes = settings.MAX_UPLOAD_MB * 1024 * 1024
+    if max_bytes and file.size is not None and file.size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Archivo demasiado grande (máx. {settings.MAX_UPLOAD_MB} MB)")
+
+    part = target.with_name(target.name + ".part")
+    try:
+        with part.open("wb") as out:
+            shutil.copyfileobj(file.file, out, UPLOAD_CHUNK_SIZE)
+        part.replace(target)
+    except BaseException:
+        part.unlink(missing_ok=True)
+        raise
 
 
 def _compute_media_type(t: Therapy) -> str:
     has_audio = bool(
-        getattr(t, "audio_corto_path", None)
-        or getattr(t, "audio_mediano_path", None)
-        or getattr(t, "audio_largo_path", None)
-        or getattr(t, "audio_path", None)
+        t.audio_corto_path
+        or t.audio_mediano_path
+        or t.audio_largo_path
+        or t.audio_path
     )
-    has_video = bool(getattr(t, "video_path", None))
+    has_video = bool(t.video_path)
     if has_audio and has_video:
         return "both"
     if has_video:
         return "video"
     if has_audio:
         return "audio"
-    return getattr(t, "media_type", None) or "audio"
+    return t.media_type or "audio"
 
 
 @router.post("/{therapy_id}/audio")
-async def upload_audio(
+def upload_audio(
     therapy_id: int,
     file: UploadFile = File(...),
     db: Session = Depends(get_db),
@@ -278,27 +363,22 @@ async def upload_audio(
     if not file.filename:
         raise HTTPException(status_code=400, detail="Nombre de archivo requerido")
 
-    ext = os.path.splitext(file.filename)[1].lower()
-    if ext not in ALLOWED_AUDIO:
-        raise HTTPException(status_code=400, detail=f"Formato no soportado. Permitidos: {ALLOWED_AUDIO}")
-
-    media_dir = Path(settings.MEDIA_DIR).resolve() / "audio"
-    media_dir.mkdir(parents=True, exist_ok=True)
+    ext = _upload_ext(file.filename, ALLOWED_AUDIO)
 
-    target = media_dir / f"therapy_{therapy_id}{ext}"
-    content = await file.read()
-    target.write_bytes(content)
+    target = AUDIO_DIR / f"therapy_{therapy_id}{ext}"
+    _save_upload(file, target)
 
     therapy.audio_path = str(target)
     therapy.audio_corto_path = str(target)  # También guarda en audio_corto
     therapy.media_type = _compute_media_type(therapy)
     db.commit()
+    invalidate("therapies")
 
     return {"ok": True, "audio_url": f"/media/audio/{target.name}"}
 
 
 @router.post("/{therapy_id}/audio/{duration_type}")
-async def upload_audio_by_duration(
+def upload_audio_by_duration(
     therapy_id: int,
     duration_type: str,
     file: UploadFile = File(...),
@@ -316,17 +396,11 @@ async def upload_audio_by_duration(
     if not file.filename:
         raise HTTPException(status_code=400, detail="Nombre de archivo requerido")
 
-    ext = os.path.splitext(file.filename)[1].lower()
-    if ext not in ALLOWED_AUDIO:
-        raise HTTPException(status_code=400, detail=f"Formato no soportado. Permitidos: {ALLOWED_AUDIO}")
-
-    media_dir = Path(settings.MEDIA_DIR).resolve() / "audio"
-    media_dir.mkdir(parents=True, exist_ok=True)
+    ext = _upload_ext(file.filename, ALLOWED_AUDIO)
 
     # Nombre único por terapia y tipo de duración
-    target = media_dir / f"therapy_{therapy_id}_{duration_type}{ext}"
-    content = await file.read()
-    target.write_bytes(content)
+    target = AUDIO_DIR / f"therapy_{therapy_id}_{duration_type}{ext}"
+    _save_upload(file, target)
 
     # Guardar en el campo correspondiente
     if duration_type == "corto":
@@ -340,12 +414,13 @@ async def upload_audio_by_duration(
     therapy.media_type = _compute_media_type(therapy)
     
     db.commit()
+    invalidate("therapies")
 
     return {"ok": True, "audio_url": f"/media/audio/{target.name}", "duration_type": duration_type}
 
 
 @router.post("/{therapy_id}/video")
-async def upload_video(
+def upload_video(
     therapy_id: int,
     file: UploadFile = File(...),
     db: Session = Depends(get_db),
@@ -359,19 +434,14 @@ async def upload_video(
     if not file.filename:
         raise HTTPException(status_code=400, detail="Nombre de archivo requerido")
 
-    ext = os.path.splitext(file.filename)[1].lower()
-    if ext not in ALLOWED_VIDEO:
-        raise HTTPException(status_code=400, detail=f"Formato no soportado. Permitidos: {ALLOWED_VIDEO}")
-
-    media_dir = Path(settings.MEDIA_DIR).resolve() / "video"
-    media_dir.mkdir(parents=True, exist_ok=True)
+    ext = _upload_ext(file.filename, ALLOWED_VIDEO)
 
-    target = media_dir / f"therapy_{therapy_id}{ext}"
-    content = await file.read()
-    target.write_bytes(content)
+    target = VIDEO_DIR / f"therapy_{therapy_id}{ext}"
+    _save_upload(file, target)
 
     therapy.video_path = str(target)
     therapy.media_type = _compute_media_type(therapy)
     db.commit()
+    invalidate("therapies")
 
     return {"ok": True, "video_url": f"/media/video/{target.name}"}
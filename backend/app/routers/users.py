@@ -1,11 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, EmailStr
-from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import delete, select, update
 
 from ..db import get_db
 from ..models import User, Role, Plan, UserPlan, CreditLedger
-from ..auth import require_admin, get_password_hash
+from ..auth import require_admin, get_password_hash, invalidate_user_cache
+from ..cache import invalidate
 
 router = APIRouter(prefix="/api/admin/users", tags=["admin-users"])
 
@@ -43,37 +45,59 @@ class AssignPlanRequest(BaseModel):
     plan_id: int
 
 
+# ──────────────────────────────────────────────────────────────
+# Helpers
+# ──────────────────────────────────────────────────────────────
+def _add_credits(db: Session, user_id: int, delta: int) -> None:
+    """Suma delta al saldo con un UPDATE en SQL (atómico, sin leer-modificar-escribir)."""
+    db.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(credits_balance=User.credits_balance + delta),
+        execution_options={"synchronize_session": False},
+    )
+
+
+def _current_credits(db: Session, user_id: int) -> int:
+    """Saldo releído de la BD (incluye los UPDATE de esta transacción)."""
+    return db.scalar(select(User.credits_balance).where(User.id == user_id))
+
+
 # ──────────────────────────────────────────────────────────────
 # Endpoints
 # ──────────────────────────────────────────────────────────────
 @router.get("", response_model=list[UserOut])
-async def list_users(db: Session = Depends(get_db), current_user: User = Depends(require_admin)):
+def list_users(db: Session = Depends(get_db), current_user: User = Depends(require_admin)):
     """Listar todos los usuarios."""
-    query = select(User)
+    # Columnas + nombre del plan en un solo SELECT con JOIN, sin hidratar entidades
+    query = (
+        select(
+            User.id, User.email, User.name, User.role, User.is_active, User.credits_balance,
+            Plan.name.label("plan_name"),
+        )
+        .outerjoin(UserPlan, UserPlan.user_id == User.id)
+        .outerjoin(Plan, Plan.id == UserPlan.plan_id)
+    )
     if current_user.role == Role.admin:
         query = query.where(User.role == Role.user)
-    users = db.execute(query).scalars().all()
-    result = []
-    for u in users:
-        plan_name = None
-        if u.user_plan and u.user_plan.plan:
-            plan_name = u.user_plan.plan.name
-        result.append(
-            UserOut(
-                id=u.id,
-                email=u.email,
-                name=u.name,
-                role=u.role.value,
-                is_active=u.is_active,
-                credits_balance=u.credits_balance,
-                plan_name=plan_name,
-            )
-        )
-    return result
+    result = [
+        {
+            "id": row.id,
+            "email": row.email,
+            "name": row.name,
+            "role": row.role.value,
+            "is_active": row.is_active,
+            "credits_balance": row.credits_balance,
+            "plan_name": row.plan_name,
+        }
+        for row in db.execute(query)
+    ]
+    # Dicts planos serializados directo con orjson, sin jsonable_encoder ni revalidar
+    return ORJSONResponse(result)
 
 
 @router.post("", response_model=UserOut)
-async def create_user(
+def create_user(
     form: CreateUserRequest,
     db: Session = Depends(get_db),
     current_user: User = Depends(require_admin),
@@ -98,31 +122,30 @@ async def create_user(
         role=role,
     )
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    # flush: asigna user.id (y defaults) sin cerrar la transacción; usuario, plan y
+    # ledger se confirman juntos en un solo commit
+    db.flush()
 
     plan_name = None
     # Asignar plan si se proporcionó
     if form.plan_id:
         plan = db.get(Plan, form.plan_id)
         if plan and plan.is_active:
-            # Crear UserPlan
-            user_plan = UserPlan(user_id=user.id, plan_id=plan.id)
-            db.add(user_plan)
             # Agregar créditos del plan
             user.credits_balance += plan.credits_included
-            # Registrar en ledger
-            ledger = CreditLedger(
-                user_id=user.id,
-                delta=plan.credits_included,
-                reason=f"Plan asignado: {plan.name}"
-            )
-            db.add(ledger)
-            db.commit()
-            db.refresh(user)
+            db.add_all([
+                UserPlan(user_id=user.id, plan_id=plan.id),
+                # Registrar en ledger
+                CreditLedger(
+                    user_id=user.id,
+                    delta=plan.credits_included,
+                    reason=f"Plan asignado: {plan.name}"
+                ),
+            ])
             plan_name = plan.name
 
-    return UserOut(
+    # La respuesta sale de los valores en memoria: sin refresh() tras el commit
+    out = UserOut.model_construct(
         id=user.id,
         email=user.email,
         name=user.name,
@@ -131,55 +154,68 @@ async def create_user(
         credits_balance=user.credits_balance,
         plan_name=plan_name,
     )
+    db.commit()
+    invalidate("analytics")
+    return out
 
 
 @router.post("/{user_id}/credits", response_model=UserOut)
-async def update_credits(
+def update_credits(
     user_id: int,
     form: UpdateCreditsRequest,
     db: Session = Depends(get_db),
     current_user: User = Depends(require_admin),
 ):
     """Ajustar créditos de un usuario (+N o -N)."""
-    user = db.get(User, user_id)
+    # populate_existing: si el admin se edita a sí mismo, get() devolvería sin SELECT el User
+    # cacheado que get_current_user dejó en la sesión, con datos posiblemente viejos
+    user = db.get(
+        User, user_id,
+        options=[joinedload(User.user_plan).joinedload(UserPlan.plan)],
+        populate_existing=True,
+    )
     if not user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
     if current_user.role == Role.admin and user.role != Role.user:
         raise HTTPException(status_code=403, detail="No tienes permisos sobre este usuario")
 
-    user.credits_balance += form.delta
+    # Ajuste atómico en SQL: no pisa cambios de saldo hechos por otro request o worker
+    _add_credits(db, user_id, form.delta)
 
     # Registrar en ledger
     ledger = CreditLedger(user_id=user.id, delta=form.delta, reason=form.reason)
     db.add(ledger)
-    db.commit()
-    db.refresh(user)
 
     plan_name = None
     if user.user_plan and user.user_plan.plan:
         plan_name = user.user_plan.plan.name
 
-    return UserOut(
+    out = UserOut.model_construct(
         id=user.id,
         email=user.email,
         name=user.name,
         role=user.role.value,
         is_active=user.is_active,
-        credits_balance=user.credits_balance,
+        credits_balance=_current_credits(db, user_id),
         plan_name=plan_name,
     )
+    db.commit()
+    invalidate_user_cache(user_id)
+    invalidate("analytics")
+    return out
 
 
 @router.post("/{user_id}/plan", response_model=UserOut)
-async def assign_plan(
+def assign_plan(
     user_id: int,
     form: AssignPlanRequest,
     db: Session = Depends(get_db),
     current_user: User = Depends(require_admin),
 ):
     """Asignar plan a usuario (reemplaza el anterior)."""
-    user = db.get(User, user_id)
+    # populate_existing: ver update_credits (el User cacheado del propio admin)
+    user = db.get(User, user_id, populate_existing=True)
     if not user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
@@ -190,9 +226,9 @@ async def assign_plan(
     if not plan:
         raise HTTPException(status_code=404, detail="Plan no encontrado")
 
-    # Eliminar plan anterior si existe
-    if user.user_plan:
-        db.delete(user.user_plan)
+    # Eliminar plan anterior si existe (DELETE directo: no depende de un user_plan en
+    # memoria que otro request ya pudo haber borrado)
+    db.execute(delete(UserPlan).where(UserPlan.user_id == user.id))
 
     # Crear nuevo
     user_plan = UserPlan(user_id=user.id, plan_id=plan.id)
@@ -200,7 +236,7 @@ async def assign_plan(
 
     # Agregar créditos del plan
     if plan.credits_included > 0:
-        user.credits_balance += plan.credits_included
+        _add_credits(db, user.id, plan.credits_included)
         ledger = CreditLedger(
             user_id=user.id,
             delta=plan.credits_included,
@@ -208,15 +244,16 @@ async def assign_plan(
         )
         db.add(ledger)
 
-    db.commit()
-    db.refresh(user)
-
-    return UserOut(
+    out = UserOut.model_construct(
         id=user.id,
         email=user.email,
         name=user.name,
         role=user.role.value,
         is_active=user.is_active,
-        credits_balance=user.credits_balance,
+        credits_balance=_current_credits(db, user_id),
         plan_name=plan.name,
     )
+    db.commit()
+    invalidate_user_cache(user_id)
+    invalidate("analytics")
+    return out
@@ -3,32 +3,113 @@ Seed inicial: crea Plan Básico, Superadmin y LightModes si no existen.
 Se ejecuta en el startup de la aplicación (idempotente).
 """
 
+from contextlib import contextmanager
+
 from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy import func, insert, select, text
+from sqlalchemy.dialects import postgresql, sqlite
 
 from .config import settings
 from .models import Plan, User, Role, LightMode, Category
 from .auth import get_password_hash
 
 
+# ─────────────────────────────────────────────────────────
+# Datos fijos del seed
+# ─────────────────────────────────────────────────────────
+# Se arman una vez al importar; run_seed los pasa tal cual a INSERTs de Core
+_LIGHT_MODE_DATA: tuple[dict, ...] = (
+    dict(name="general", display_name="Patrón Complejo", description="11 patrones variables", esp32_command="general", color="#06b6d4", icon="🔄"),
+    dict(name="intermitente", display_name="Intermitente", description="Cambio rápido 500ms", esp32_command="intermitente", color="#f59e0b", icon="⚡"),
+    dict(name="pausado", display_name="Pausado", description="Cambio lento 1.5s", esp32_command="pausado", color="#8b5cf6", icon="⏸️"),
+    dict(name="cascada", display_name="Cascada", description="Efecto cascada", esp32_command="cascada", color="#10b981", icon="🌊"),
+    dict(name="cascrev", display_name="Cascada Reversa", description="Cascada invertida", esp32_command="cascrev", color="#182521", icon="🌊"),
+    dict(name="rojo", display_name="Solo Rojo", description="Rojo sólido", esp32_command="rojo", color="#ef4444", icon="🔴"),
+    dict(name="verde", display_name="Solo Verde", description="Verde sólido", esp32_command="verde", color="#22c55e", icon="🟢"),
+    dict(name="azul", display_name="Solo Azul", description="Azul sólido", esp32_command="azul", color="#3b82f6", icon="🔵"),
+    dict(name="blanco", display_name="Solo Blanco", description="Blanco sólido", esp32_command="blanco", color="#ffffff", icon="⚪"),
+)
+
+_CATEGORY_DATA: tuple[dict, ...] = (
+    dict(name="Relajación", description="Terapias para reducir estrés y ansiedad", color="#14b8a6", icon="💆"),
+    dict(name="Meditación", description="Sesiones de meditación guiada", color="#8b5cf6", icon="🧘"),
+    dict(name="Energía", description="Terapias para aumentar energía y vitalidad", color="#f59e0b", icon="⚡"),
+    dict(name="Sueño", description="Mejora del descanso y calidad de sueño", color="#3b82f6", icon="😴"),
+    dict(name="Autismo", description="Terapias especializadas para autismo", color="#22c55e", icon="🧩"),
+    dict(name="Frecuencias", description="Terapias basadas en frecuencias específicas", color="#ec4899", icon="🎵"),
+)
+
+
+def _insert_ignore(db: Session, model, rows: list[dict], unique_col: str) -> int:
+    """INSERT multi-fila que omite las filas cuyo valor único ya existe; devuelve las insertadas.
+
+    La BD resuelve el duplicado (ON CONFLICT DO NOTHING / INSERT IGNORE): sin SELECT previo
+    y sin error si otro worker sembró al mismo tiempo.
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(model).values(rows).on_conflict_do_nothing(index_elements=[unique_col])
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(model).values(rows).on_conflict_do_nothing(index_elements=[unique_col])
+    else:
+        stmt = insert(model).values(rows).prefix_with("IGNORE")
+    return db.execute(stmt).rowcount
+
+
+# Clave del lock de BD que serializa el seed entre workers
+SEED_LOCK_KEY = 7_351_029_441
+SEED_LOCK_NAME = "panel_kryon_seed"
+
+
+@contextmanager
+def _seed_lock(db: Session):
+    """Lock de la BD para que con uvicorn --workers N el seed corra de a un worker.
+
+    Los demás esperan y luego encuentran todo sembrado. Va en una conexión propia: los
+    locks de PostgreSQL/MySQL son por conexión y la Session puede cambiarla tras cada commit.
+    SQLite no tiene locks con nombre; ahí alcanza con que los INSERT ignoren duplicados.
+    """
+    engine = db.get_bind()
+    if engine.dialect.name not in ("postgresql", "mysql"):
+        yield
+        return
+
+    with engine.connect() as conn:
+        if engine.dialect.name == "postgresql":
+            conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": SEED_LOCK_KEY})
+        else:
+            # Si vence el timeout se sigue igual: el seed es idempotente
+            conn.execute(text("SELECT GET_LOCK(:n, 60)"), {"n": SEED_LOCK_NAME})
+        try:
+            yield
+        finally:
+            if engine.dialect.name == "postgresql":
+                conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": SEED_LOCK_KEY})
+            else:
+                conn.execute(text("SELECT RELEASE_LOCK(:n)"), {"n": SEED_LOCK_NAME})
+
+
 def run_seed(db: Session) -> None:
-    """Ejecutar seed idempotente."""
+    """Ejecutar seed idempotente (serializado entre workers)."""
+    with _seed_lock(db):
+        _run_seed(db)
+
+
+def _run_seed(db: Session) -> None:
 
     # ─────────────────────────────────────────────────────────
     # Plan Básico
     # ─────────────────────────────────────────────────────────
-    basic_plan = db.execute(select(Plan).where(Plan.name == "Plan Básico")).scalar_one_or_none()
-    if not basic_plan:
-        basic_plan = Plan(
-            name="Plan Básico",
-            description="Plan inicial con acceso básico al sistema.",
-            credits_included=10,
-            therapies_access="all",
-            price=0,
-            is_active=True,
-        )
-        db.add(basic_plan)
-        db.commit()
+    created = _insert_ignore(db, Plan, [dict(
+        name="Plan Básico",
+        description="Plan inicial con acceso básico al sistema.",
+        credits_included=10,
+        therapies_access="all",
+        price=0,
+        is_active=True,
+    )], "name")
+    db.commit()
+    if created:
         print("✅ Seed: Plan Básico creado")
     else:
         print("ℹ️  Seed: Plan Básico ya existe")
@@ -36,11 +117,10 @@ def run_seed(db: Session) -> None:
     # ─────────────────────────────────────────────────────────
     # Superadmin
     # ─────────────────────────────────────────────────────────
-    superadmin = db.execute(
-        select(User).where(User.email == settings.SUPERADMIN_EMAIL)
-    ).scalar_one_or_none()
+    # Aquí sí se consulta antes: evita calcular el hash argon2 en cada arranque
+    superadmin_id = db.scalar(select(User.id).where(User.email == settings.SUPERADMIN_EMAIL))
 
-    if not superadmin:
+    if superadmin_id is None:
         superadmin = User(
             email=settings.SUPERADMIN_EMAIL,
             password_hash=get_password_hash(settings.SUPERADMIN_PASSWORD),
@@ -58,40 +138,23 @@ def run_seed(db: Session) -> None:
     # ─────────────────────────────────────────────────────────
     # Modos de Luz (fijos, no modificables por usuarios)
     # ─────────────────────────────────────────────────────────
-    existing_modes = db.execute(select(LightMode)).scalars().all()
-    if not existing_modes:
-        light_modes = [
-            LightMode(name="general", display_name="Patrón Complejo", description="11 patrones variables", esp32_command="general", color="#06b6d4", icon="🔄"),
-            LightMode(name="intermitente", display_name="Intermitente", description="Cambio rápido 500ms", esp32_command="intermitente", color="#f59e0b", icon="⚡"),
-            LightMode(name="pausado", display_name="Pausado", description="Cambio lento 1.5s", esp32_command="pausado", color="#8b5cf6", icon="⏸️"),
-            LightMode(name="cascada", display_name="Cascada", description="Efecto cascada", esp32_command="cascada", color="#10b981", icon="🌊"),
-            LightMode(name="cascrev", display_name="Cascada Reversa", description="Cascada invertida", esp32_command="cascrev", color="#182521", icon="🌊"),
-            LightMode(name="rojo", display_name="Solo Rojo", description="Rojo sólido", esp32_command="rojo", color="#ef4444", icon="🔴"),
-            LightMode(name="verde", display_name="Solo Verde", description="Verde sólido", esp32_command="verde", color="#22c55e", icon="🟢"),
-            LightMode(name="azul", display_name="Solo Azul", description="Azul sólido", esp32_command="azul", color="#3b82f6", icon="🔵"),
-            LightMode(name="blanco", display_name="Solo Blanco", description="Blanco sólido", esp32_command="blanco", color="#ffffff", icon="⚪"),
-        ]
-        db.add_all(light_modes)
-        db.commit()
-        print("✅ Seed: Modos de luz creados (9 modos)")
+    # Un solo INSERT multi-fila; los modos que ya existen (por nombre) se omiten
+    created = _insert_ignore(db, LightMode, list(_LIGHT_MODE_DATA), "name")
+    db.commit()
+    if created:
+        print(f"✅ Seed: Modos de luz creados ({created} modos)")
     else:
-        print(f"ℹ️  Seed: Modos de luz ya existen ({len(existing_modes)} modos)")
+        print(f"ℹ️  Seed: Modos de luz ya existen ({len(_LIGHT_MODE_DATA)} modos)")
 
     # ─────────────────────────────────────────────────────────
     # Categorías por defecto
     # ─────────────────────────────────────────────────────────
-    existing_categories = db.execute(select(Category)).scalars().all()
+    # Editables desde el panel: se siembran solo con la tabla vacía (un ON CONFLICT por
+    # nombre volvería a crear una categoría por defecto que el admin renombró)
+    existing_categories = db.scalar(select(func.count()).select_from(Category))
     if not existing_categories:
-        default_categories = [
-            Category(name="Relajación", description="Terapias para reducir estrés y ansiedad", color="#14b8a6", icon="💆"),
-            Category(name="Meditación", description="Sesiones de meditación guiada", color="#8b5cf6", icon="🧘"),
-            Category(name="Energía", description="Terapias para aumentar energía y vitalidad", color="#f59e0b", icon="⚡"),
-            Category(name="Sueño", description="Mejora del descanso y calidad de sueño", color="#3b82f6", icon="😴"),
-            Category(name="Autismo", description="Terapias especializadas para autismo", color="#22c55e", icon="🧩"),
-            Category(name="Frecuencias", description="Terapias basadas en frecuencias específicas", color="#ec4899", icon="🎵"),
-        ]
-        db.add_all(default_categories)
+        db.execute(insert(Category), list(_CATEGORY_DATA))
         db.commit()
-        print("✅ Seed: Categorías por defecto creadas (6 categorías)")
+        print(f"✅ Seed: Categorías por defecto creadas ({len(_CATEGORY_DATA)} categorías)")
     else:
-        print(f"ℹ️  Seed: Categorías ya existen ({len(existing_categories)} categorías)")
+        print(f"ℹ️  Seed: Categorías ya existen ({existing_categories} categorías)")
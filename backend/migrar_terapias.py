@@ -11,6 +11,9 @@ USO:
   2. Navega a la carpeta del backend: cd backend
   3. Activa el entorno virtual: source venv/bin/activate (Linux/Mac) o venv\Scripts\activate (Windows)
   4. Ejecuta: python migrar_terapias.py --usb /ruta/al/usb
+     (opcional: --workers N para copiar N archivos a la vez)
+     (opcional: --hardlink si el origen está en el mismo disco que MEDIA_DIR)
+     (opcional: --quiet para mostrar solo avisos y el resumen)
 
 EJEMPLO WINDOWS:
   python migrar_terapias.py --usb E:\panel-kryon
@@ -24,18 +27,91 @@ import sys
 import json
 import shutil
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 # Agregar el directorio actual al path para importar los módulos de la app
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+# Nombres por consulta al buscar terapias ya registradas
+NAME_LOOKUP_CHUNK = 500
+
+# Copias de media simultáneas por defecto: con varias en vuelo el disco trabaja con más
+# cola. copy2 copia en el kernel (sendfile) y libera el GIL, así que los hilos no compiten
+# por Python; en SSD/NVMe se puede subir con --workers.
+MEDIA_COPY_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+
+
+def list_files(directory: Path) -> set[str]:
+    """Nombres de los archivos de una carpeta en una sola lectura (vacío si no existe)."""
+    try:
+        with os.scandir(directory) as entries:
+            return {e.name for e in entries if e.is_file()}
+    except OSError:
+        return set()
+
+
+def media_exists(available: set[str], directory: Path, filename: str) -> bool:
+    """¿Está el archivo en la carpeta de origen?
+
+    Primero contra el listado ya leído (sin stat por archivo en el USB); si no aparece se
+    confirma con el disco: nombres con subcarpeta o sistemas sin distinción de mayúsculas.
+    """
+    return filename in available or (directory / filename).is_file()
+
+
+def copy_media(src: Path, dest: Path, hardlink: bool = False) -> bool:
+    """Copiar un archivo de media; devuelve False si el destino ya era idéntico.
+
+    shutil.copy2 ya usa la copia del kernel (sendfile en Linux, fcopyfile en macOS,
+    CopyFile2 en Windows con Python 3.12+). Lo que se evita aquí es volver a copiar
+    decenas de MB al repetir la migración: copy2 conserva el mtime, así que mismo
+    tamaño y mtime indica que el archivo ya se copió.
+
+    Con hardlink=True se intenta primero un enlace duro (instantáneo y sin ocupar más
+    disco); si origen y destino están en distintos sistemas de archivos se copia.
+    """
+    try:
+        src_stat = src.stat()
+        dest_stat = dest.stat()
+        if src_stat.st_size == dest_stat.st_size and int(src_stat.st_mtime) == int(dest_stat.st_mtime):
+            return False
+    except FileNotFoundError:
+        pass
+    if hardlink:
+        try:
+            dest.unlink(missing_ok=True)
+            os.link(src, dest)
+            return True
+        except OSError:
+            pass  # otro volumen (EXDEV) o FS sin enlaces duros: copia normal
+    shutil.copy2(src, dest)
+    return True
+
+
 def main():
     parser = argparse.ArgumentParser(description="Migrar terapias desde USB")
     parser.add_argument("--usb", required=True, help="Ruta al directorio del USB con los archivos de migración")
     parser.add_argument("--dry-run", action="store_true", help="Solo mostrar qué se haría, sin ejecutar")
+    parser.add_argument(
+        "--hardlink", action="store_true",
+        help="Enlazar en vez de copiar si el origen está en el mismo disco que MEDIA_DIR "
+             "(los archivos de media comparten inodo con el origen: no editarlos allí)",
+    )
+    parser.add_argument(
+        "--quiet", action="store_true",
+        help="No listar cada terapia y archivo; solo avisos y el resumen final",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=MEDIA_COPY_WORKERS,
+        help=f"Copias de archivos simultáneas (por defecto {MEDIA_COPY_WORKERS})",
+    )
     args = parser.parse_args()
 
     usb_path = Path(args.usb)
+    # Detalle por terapia/archivo: con --quiet no se escribe (en terminales lentas o por SSH
+    # miles de líneas pesan); los avisos y el resumen siempre se muestran
+    detail = (lambda *a, **k: None) if args.quiet else print
     
     # Validar rutas
     json_path = usb_path / "migracion" / "therapies.json"
@@ -67,8 +143,10 @@ def main():
     # Importar módulos de la aplicación
     try:
         from app.config import settings
-        from app.db import SessionLocal, engine
+        from app.db import engine
         from app.models import Base, Therapy
+        from sqlalchemy import select
+        import orjson
     except ImportError as e:
         print(f"\n❌ Error importando módulos de la app: {e}")
         print("   Asegúrate de ejecutar este script desde la carpeta 'backend'")
@@ -90,26 +168,52 @@ def main():
     if not args.dry_run:
         Base.metadata.create_all(bind=engine)
     
-    # Procesar terapias
-    session = SessionLocal()
+    # Procesar terapias. Solo Core sobre una conexión (sin Session ni mapper): el script
+    # únicamente consulta nombres e inserta filas
+    therapies_table = Therapy.__table__
+    conn = engine.connect()
     imported = 0
     skipped = 0
     files_copied = 0
     errors = []
+    # Filas a insertar al final en un solo INSERT multi-fila
+    rows: list[dict] = []
+    # Copias pendientes destino → origen (un archivo compartido entre terapias se copia una vez)
+    copies: dict[Path, Path] = {}
     
     try:
+        # Terapias ya registradas: un SELECT ... IN por bloque de nombres en vez de uno por
+        # terapia (bloques para no pasar el límite de parámetros de SQLite en catálogos grandes)
+        names = list({t["name"] for t in therapies})
+        existing_ids: dict[str, int | None] = {}
+        for i in range(0, len(names), NAME_LOOKUP_CHUNK):
+            chunk = names[i:i + NAME_LOOKUP_CHUNK]
+            existing_ids.update(
+                conn.execute(
+                    select(therapies_table.c.name, therapies_table.c.id).where(therapies_table.c.name.in_(chunk))
+                ).all()
+            )
+        
+        # Un solo listado por carpeta del USB en vez de un stat() por archivo
+        audio_available = list_files(audio_path)
+        video_available = list_files(video_path)
+        
         for t in therapies:
             therapy_id = t["id"]
             name = t["name"]
             
             # Verificar si ya existe
-            existing = session.query(Therapy).filter(Therapy.name == name).first()
-            if existing:
-                print(f"⏭️  {name} - ya existe (ID: {existing.id})")
+            if name in existing_ids:
+                if existing_ids[name] is None:
+                    detail(f"⏭️  {name} - repetida en el JSON")
+                else:
+                    detail(f"⏭️  {name} - ya existe (ID: {existing_ids[name]})")
                 skipped += 1
                 continue
+            # Nombre repetido más adelante en el mismo JSON: se omite como si ya existiera
+            existing_ids[name] = None
             
-            print(f"\n{'[DRY-RUN] ' if args.dry_run else ''}📥 Importando: {name}")
+            detail(f"\n{'[DRY-RUN] ' if args.dry_run else ''}📥 Importando: {name}")
             
             # Mapear archivos de media
             audio_corto = None
@@ -119,13 +223,11 @@ def main():
             
             if "audio_files" in t:
                 for dur, filename in t["audio_files"].items():
-                    src = audio_path / filename
-                    if src.exists():
+                    if media_exists(audio_available, audio_path, filename):
+                        src = audio_path / filename
                         dest_file = f"audio/{filename}"
-                        if not args.dry_run:
-                            shutil.copy2(src, audio_dest / filename)
-                        print(f"   ✅ {dur}: {filename}")
-                        files_copied += 1
+                        copies[audio_dest / filename] = src
+                        detail(f"   ✅ {dur}: {filename}")
                         
                         if dur == "corto":
                             audio_corto = dest_file
@@ -134,28 +236,27 @@ def main():
                         elif dur == "largo":
                             audio_largo = dest_file
                     else:
-                        print(f"   ⚠️  {dur}: {filename} - NO ENCONTRADO")
+                        print(f"   ⚠️  {dur}: {filename} - NO ENCONTRADO ({name})")
             
             if "video_files" in t:
                 for dur, filename in t["video_files"].items():
-                    src = video_path / filename
-                    if src.exists():
+                    if media_exists(video_available, video_path, filename):
+                        src = video_path / filename
                         dest_file = f"video/{filename}"
-                        if not args.dry_run:
-                            shutil.copy2(src, video_dest / filename)
-                        print(f"   ✅ video: {filename}")
-                        files_copied += 1
+                        copies[video_dest / filename] = src
+                        detail(f"   ✅ video: {filename}")
                         video = dest_file
                     else:
-                        print(f"   ⚠️  video: {filename} - NO ENCONTRADO")
+                        print(f"   ⚠️  video: {filename} - NO ENCONTRADO ({name})")
             
             # Crear registro en BD
             if not args.dry_run:
+                # orjson (dependencia del backend) serializa más rápido que json.dumps
                 duration_labels_json = None
                 if "duration_labels" in t:
-                    duration_labels_json = json.dumps(t["duration_labels"])
+                    duration_labels_json = orjson.dumps(t["duration_labels"]).decode()
                 
-                therapy = Therapy(
+                rows.append(dict(
                     name=name,
                     description=t.get("description", ""),
                     category=t.get("category", "session"),
@@ -168,14 +269,39 @@ def main():
                     audio_path=audio_corto,  # Legacy compatibility
                     video_path=video,
                     duration_labels=duration_labels_json,
-                    is_active=True
-                )
-                session.add(therapy)
+                    is_active=True,
+                ))
             
             imported += 1
         
+        if args.dry_run:
+            files_copied = len(copies)
+        elif copies:
+            # Las copias son independientes entre sí: se hacen en paralelo
+            print(f"\n📁 Copiando {len(copies)} archivos...")
+            with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+                futures = {pool.submit(copy_media, src, dest, args.hardlink): dest for dest, src in copies.items()}
+                for future in as_completed(futures):
+                    dest = futures[future]
+                    try:
+                        if future.result():
+                            files_copied += 1
+                        else:
+                            detail(f"   ↪️  {dest.name} - ya copiado")
+                    except OSError as e:
+                        errors.append(f"{dest.name}: {e}")
+        
+        if errors:
+            # Sin registrar terapias que apuntarían a archivos que no se copiaron
+            rows.clear()
+            imported = 0
+        
         if not args.dry_run:
-            session.commit()
+            # INSERT de Core con la lista de dicts: SQLAlchemy lo agrupa en sentencias
+            # multi-VALUES (insertmanyvalues) sin crear un objeto ORM por terapia
+            if rows:
+                conn.execute(therapies_table.insert(), rows)
+            conn.commit()
         
         print("\n" + "=" * 60)
         print("   RESUMEN DE MIGRACIÓN")
@@ -191,15 +317,19 @@ def main():
         
         if args.dry_run:
             print("\n⚠️  Este fue un DRY-RUN. Ejecuta sin --dry-run para aplicar cambios.")
+        elif errors:
+            print("\n❌ Hubo errores copiando archivos: no se registró ninguna terapia.")
+            print("   Corrige el problema y vuelve a ejecutar (los archivos ya copiados se omiten).")
+            sys.exit(1)
         else:
             print("\n🎉 ¡Migración completada exitosamente!")
         
     except Exception as e:
-        session.rollback()
+        conn.rollback()
         print(f"\n❌ Error durante la migración: {e}")
         raise
     finally:
-        session.close()
+        conn.close()
 
 
 if __name__ == "__main__":